@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+
+# asyncio version of rcmdclass.Device. Device lookup, credentials, prompt handling and the
+# per device type terminal setup are shared with Device - only the pty I/O is done differently,
+# so that a single event loop can drive thousands of sessions at the same time e.g.
+#
+#     async def run(host):
+#         dev = AsyncDevice(cfgfile=cfgfile, host=host)
+#         await dev.connect()
+#         await dev.do_sendline('show version')
+#         print(dev.do_getbuffer())
+#         await dev.disconnect()
+#
+#     asyncio.run(asyncio.gather(*[run(host) for host in hosts]))
+
+import asyncio
+import codecs
+import os
+import re
+import sys
+import time
+import pexpect
+from rcmdclass import Device, RcmdError, OutputStream, PhaseTimer, SSH, TELNET, SOCAT, BASE_PROMPT, HOST_PROMPT, PASSWORD_PROMPT, LOGIN_FAILED, ENABLE_PROMPT, LOGINTIMEOUT, MORE_PROMPTS, INIT_COMMANDS, PROMPT_OVERLAP, STREAM_TAIL
+
+
+READSIZE = 64 * 1024
+
+
+class AsyncChild(object):
+
+    # Minimal stand-in for the parts of pexpect.spawn that Device uses (send, sendline, expect,
+    # before, match). pexpect is still used to fork the pty, but reads are done by the event loop.
+    # pexpect's own async_=True expect is not used as it is broken on newer Python (asyncio.coroutine).
+
+    def __init__(self, command, args, logfile_read=None):
+        self.proc = pexpect.spawn(command, args, encoding='utf-8', codec_errors='ignore')
+        # The default delays are time.sleep() calls which would stall every session on the loop
+        self.proc.delaybeforesend = None
+        self.proc.ptyproc.delayafterclose = 0
+        self.proc.ptyproc.delayafterterminate = 0
+        self.logfile_read = logfile_read
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        # Output read but not yet matched, as a list of reads - appending to one string on every
+        # read would make a large output quadratic to collect
+        self.chunks = []
+        self.before = None
+        self.after = None
+        self.match = None
+        self.eof = False
+        self.event = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self.fd = self.proc.child_fd
+        self.loop.add_reader(self.fd, self.on_readable)
+
+
+    def on_readable(self):
+        try:
+            data = os.read(self.fd, READSIZE)
+        except OSError:
+            # Linux returns EIO on the pty master once the child has exited
+            data = b''
+        if data:
+            text = self.decoder.decode(data)
+            if text:
+                self.chunks.append(text)
+            if self.logfile_read is not None:
+                self.logfile_read.write(text)
+                self.logfile_read.flush()
+        else:
+            self.eof = True
+            self.loop.remove_reader(self.fd)
+        self.event.set()
+
+
+    @property
+    def pending(self):
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0] if self.chunks else ''
+
+
+    @pending.setter
+    def pending(self, value):
+        self.chunks = [value] if value else []
+
+
+    def take(self):
+        # Everything read but not yet matched, leaving nothing pending
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+    def unread(self, data):
+        # Hand unmatched output back for the next expect()
+        if data:
+            self.chunks.insert(0, data)
+        return True
+
+
+    def search(self, compiled):
+        best = None
+        for idx, regex in compiled:
+            m = regex.search(self.pending)
+            if m is not None and (best is None or m.start() < best[1].start()):
+                best = (idx, m)
+        return best
+
+
+    async def expect(self, patterns, timeout=30):
+        compiled = []
+        eofidx = None
+        timeoutidx = None
+        for idx, pattern in enumerate(patterns):
+            if pattern is pexpect.EOF:
+                eofidx = idx
+            elif pattern is pexpect.TIMEOUT:
+                timeoutidx = idx
+            else:
+                compiled.append((idx, re.compile(pattern, re.DOTALL)))
+
+        end_time = self.loop.time() + timeout
+        while True:
+            found = self.search(compiled)
+            if found is not None:
+                idx, m = found
+                self.before = self.pending[:m.start()]
+                self.after = m.group(0)
+                self.match = m
+                self.pending = self.pending[m.end():]
+                return idx
+            if self.eof:
+                self.before = self.pending
+                self.after = pexpect.EOF
+                self.match = None
+                self.pending = ''
+                if eofidx is None:
+                    raise pexpect.EOF('End Of File (EOF).')
+                return eofidx
+            remaining = end_time - self.loop.time()
+            if remaining <= 0:
+                self.before = self.pending
+                self.after = pexpect.TIMEOUT
+                self.match = None
+                if timeoutidx is None:
+                    raise pexpect.TIMEOUT('Timeout exceeded.')
+                return timeoutidx
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+
+    async def wait(self, timeout):
+        # Wait up to timeout for more data (or EOF) to arrive in pending
+        self.event.clear()
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return True
+
+
+    def send(self, s):
+        return self.proc.send(s)
+
+
+    def sendline(self, s=''):
+        return self.proc.sendline(s)
+
+
+    def close(self):
+        if not self.eof:
+            self.loop.remove_reader(self.fd)
+            self.eof = True
+        self.proc.close(force=True)
+        return True
+
+
+class AsyncDevice(Device):
+
+    async def connect(self, debug=False, timeout=45, enablemode=False, smartprompt=True, pki=False, mux=False, timings=False):
+        self.debug = debug
+        self.timeout = timeout
+        self.pki = pki
+        self.mux = mux
+        self.timer = PhaseTimer() if timings else None
+        self.connected = False
+
+        if self.conn == 'S':
+            await self.do_spawn_ssh()
+        elif self.conn == 'T':
+            await self.do_spawn_telnet()
+        else:
+            raise RcmdError('ERROR: Invalid connection type')
+
+        if enablemode or self.dtype == 'F':
+            await self.do_enable()
+
+        if self.debug:
+            print('\nDEBUG> Login stages - ' + ', '.join(f'{stage} {secs:.3f}s' for stage, secs in self.login_timings))
+
+        # The fingerprint cache is SQLite - read and written on the default executor so that a
+        # slow or locked DB does not stall every other session on the loop
+        loop = asyncio.get_running_loop()
+        fingerprint = await loop.run_in_executor(None, self.cached_fingerprint)
+        try:
+            await self.setup(fingerprint, smartprompt)
+        except RcmdError as e:
+            if fingerprint is None or e.value != 'ERROR: Timeout encountered':
+                raise
+            # The cached prompt (or dtype) no longer fits the device - forget it and learn again
+            await loop.run_in_executor(None, self.forget_fingerprint)
+            fingerprint = None
+            await self.setup(None, smartprompt)
+
+        await loop.run_in_executor(None, self.save_fingerprint, fingerprint, smartprompt)
+
+        self.connected = True
+
+        return True
+
+
+    async def setup(self, fingerprint, smartprompt):
+        if smartprompt:
+            if fingerprint is not None and fingerprint.prompt is not None:
+                self.prompt = fingerprint.prompt
+            else:
+                self.prompt = BASE_PROMPT
+                await self.do_set_prompt()
+            self.phase('set_prompt')
+
+        if self.osdetect:
+            if fingerprint is not None and fingerprint.dtype is not None:
+                self.dtype = fingerprint.dtype
+                self.paging = fingerprint.paging
+                await self.init_device()
+            else:
+                await self.os_detect()
+            self.phase('os_detect')
+        else:
+            await self.init_device()
+            self.phase('init')
+
+        return True
+
+
+    async def os_detect(self):
+        got_prompt = False
+        output = ''
+        self.paging = False
+
+        # Required to prevent Arista EOS from sending control characters in prompt
+        await self.do_sendline('terminal length 0')
+
+        self.child.sendline('show version')
+
+        while got_prompt is False:
+            myexp = await self.child.expect([self.prompt, MORE_PROMPTS, pexpect.EOF, pexpect.TIMEOUT], timeout=self.timeout)
+            if myexp == 0:
+                output = output + self.child.before
+                got_prompt = True
+            elif myexp == 1:
+                output = output + self.child.before
+                self.paging = True
+                self.child.send(' ')
+            elif myexp == 2:
+                raise RcmdError('ERROR: EOF encountered')
+            elif myexp == 3:
+                raise RcmdError('ERROR: Timeout encountered')
+            else:
+                raise RcmdError('ERROR: Unknown expect error')
+
+        self.dtype = self.detect_dtype(output)
+        await self.init_device()
+
+        return True
+
+
+    async def init_device(self, dtype=None):
+        if dtype is None:
+            dtype = self.dtype
+        if dtype not in INIT_COMMANDS:
+            raise RcmdError('ERROR: Unknown device type')
+        for send, line in INIT_COMMANDS[dtype]:
+            if send == 'sendline':
+                await self.do_sendline(line)
+            else:
+                self.child.send(line)
+        return True
+
+
+    def do_spawn(self, command, args):
+        if self.debug:
+            self.child = AsyncChild(command, args, sys.stdout)
+        else:
+            self.child = AsyncChild(command, args)
+        self.time_reads()
+        return True
+
+
+    async def do_spawn_ssh(self):
+        self.login_start()
+        self.do_spawn(SSH, self.ssh_args())
+        self.login_stage('spawn')
+        await self.do_login()
+        return True
+
+
+    async def do_spawn_telnet(self):
+        self.login_start()
+        if self.pserver is None:
+            self.do_spawn(TELNET, [self.ip])
+        else:
+            arglist = ['-,rawer']
+            arg2 = f'socks4:{self.pserver}:{self.ip}:23,socksport={self.pport}'
+            arglist.append(arg2)
+            self.do_spawn(SOCAT, arglist)
+        self.login_stage('spawn')
+        await self.do_login()
+        return True
+
+
+    async def do_login(self):
+        while True:
+            myexp = await self.child.expect(self.login_patterns(), timeout=LOGINTIMEOUT)
+            if self.login_event(myexp):
+                return True
+
+
+    async def do_enable(self):
+        if self.lastprompt is not None and self.lastprompt.rstrip().endswith('#'):
+            return True
+        self.child.sendline('enable')
+        myexp = await self.child.expect([PASSWORD_PROMPT, HOST_PROMPT, pexpect.EOF, pexpect.TIMEOUT], timeout=LOGINTIMEOUT)
+        if myexp == 0:
+            self.child.sendline(self.enable_password)
+            myexp = await self.child.expect([ENABLE_PROMPT, PASSWORD_PROMPT, LOGIN_FAILED, pexpect.EOF, pexpect.TIMEOUT], timeout=LOGINTIMEOUT)
+            if myexp == 1 or myexp == 2:
+                raise RcmdError('ERROR: Enable failed')
+            elif myexp == 3:
+                raise RcmdError('ERROR: EOF encountered')
+            elif myexp == 4:
+                raise RcmdError('ERROR: Timeout encountered')
+        elif myexp == 1:
+            pass
+        elif myexp == 2:
+            raise RcmdError('ERROR: EOF encountered')
+        elif myexp == 3:
+            raise RcmdError('ERROR: Timeout encountered')
+        else:
+            raise RcmdError('ERROR: Unknown expect error')
+        self.buffer = self.child.before
+        self.login_stage('enable')
+        return True
+
+
+    async def do_set_prompt(self):
+        self.child.sendline('')
+        await self.do_expect_prompt(self.timeout)
+        self.learn_prompt(self.child.match.group(0))
+        return True
+
+
+    async def do_expect(self, myexpect, mytimeout):
+        myexp = await self.child.expect([myexpect, pexpect.EOF, pexpect.TIMEOUT], timeout=mytimeout)
+        if myexp == 0:
+            pass
+        elif myexp == 1:
+            raise RcmdError('ERROR: EOF encountered')
+        elif myexp == 2:
+            raise RcmdError('ERROR: Timeout encountered')
+        else:
+            raise RcmdError('ERROR: Unknown expect error')
+        self.buffer = self.child.before
+        return True
+
+
+    async def do_expect_prompt(self, mytimeout):
+        # Same as Device.do_expect_prompt - only the new data plus the last PROMPT_OVERLAP
+        # characters before it are searched, and the output is only joined up once
+        regex = self.get_regex(self.prompt)
+        chunks = []
+        size = 0
+        tail = ''
+        data = self.child.take()
+        end_time = self.child.loop.time() + mytimeout
+        while True:
+            window = tail + data
+            m = regex.search(window)
+            chunks.append(data)
+            if m is not None:
+                start = size - len(tail) + m.start()
+                self.buffer = ''.join(chunks)[:start]
+                self.child.unread(window[m.end():])
+                self.child.before = self.buffer
+                self.child.after = m.group(0)
+                self.child.match = m
+                return True
+            size += len(data)
+            tail = window[-PROMPT_OVERLAP:]
+            data = await self.read_chunk(end_time)
+
+
+    async def read_chunk(self, end_time):
+        # Output that arrived since the last read, waiting for some if there is none yet
+        while True:
+            data = self.child.take()
+            if data:
+                return data
+            if self.child.eof:
+                raise RcmdError('ERROR: EOF encountered')
+            remaining = end_time - self.child.loop.time()
+            if remaining <= 0:
+                raise RcmdError('ERROR: Timeout encountered')
+            await self.child.wait(remaining)
+
+
+    async def do_expectraw(self, myexpect, mytimeout):
+        myexp = await self.child.expect([myexpect, pexpect.EOF, pexpect.TIMEOUT], timeout=mytimeout)
+        if myexp == 0:
+            self.buffer = self.child.before
+        return myexp
+
+
+    async def do_sendline(self, line):
+        self.command_start()
+        self.child.sendline(line)
+        await self.do_expect_prompt(self.timeout)
+        self.command_done(line)
+        return True
+
+
+    async def do_sendline_batch(self, lines, depth, times=None):
+        outputs = []
+        sent = 0
+        self.command_start()
+        while len(outputs) < len(lines):
+            todo = lines[sent:len(outputs) + depth]
+            if todo:
+                self.child.send(''.join(line + os.linesep for line in todo))
+                sent += len(todo)
+            await self.do_expect_prompt(self.timeout)
+            self.command_done(lines[len(outputs)])
+            outputs.append(self.do_getbuffer())
+            if times is not None:
+                times.append(time.monotonic())
+        return outputs
+
+
+    async def do_sendline_stream(self, line, fout):
+        self.command_start()
+        self.child.sendline(line)
+        await self.do_expect_stream(self.prompt, self.timeout, OutputStream(fout))
+        self.command_done(line)
+        return True
+
+
+    async def do_expect_stream(self, myexpect, mytimeout, stream):
+        regex = self.get_regex(myexpect)
+        end_time = self.child.loop.time() + mytimeout
+        tail = ''
+        data = self.child.take()
+        while True:
+            window = tail + data
+            m = regex.search(window)
+            if m is not None:
+                stream.write(window[:m.start()])
+                stream.close()
+                self.child.unread(window[m.end():])
+                self.child.before = ''
+                self.child.after = m.group(0)
+                self.child.match = m
+                self.buffer = ''
+                return True
+            # Only the last STREAM_TAIL characters are held back, in case a prompt is split across reads
+            if len(window) > STREAM_TAIL:
+                stream.write(window[:-STREAM_TAIL])
+                window = window[-STREAM_TAIL:]
+            tail = window
+            data = await self.read_chunk(end_time)
+
+
+    async def do_sendline_setprompt(self, line):
+        self.command_start()
+        self.child.sendline(line)
+        self.prompt = BASE_PROMPT
+        await self.do_expect_prompt(self.timeout)
+        await self.do_set_prompt()
+        self.command_done(line)
+        return True
+
+
+    async def disconnect(self):
+        self.child.sendline('exit')
+        # Give the session a moment to close cleanly before releasing the pty
+        await self.child.expect([pexpect.EOF, pexpect.TIMEOUT], timeout=5)
+        self.close()
+        return True
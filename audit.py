@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+
+# Fleet-wide version of check-ip.py, check-hostname.py and check-dtype.py. The DB-only checks run
+# as one pass over the selected rows (one config parse, one DB load), the login checks run
+# concurrently with one session per device covering both the hostname and the dtype. Each
+# discrepancy is printed and, with -j, written as a JSON line e.g.
+#
+#   {"host": "rtr1", "ip": "10.1.1.1", "check": "dtype", "db": "C", "found": "N",
+#    "detail": "Device type mismatch (DB == C but detected == N)"}
+#
+# check is one of
+#   missing   - host in the hostfile or mgmtfile is not in the DB
+#   ip        - MgmtIP in the DB is not the one in the mgmtfile
+#   duplicate - hostname is in the DB more than once (in different case)
+#   dtype/conn/proxy/auth - DeviceType, ConnMethod, ProxyID or AuthID in the DB is not valid
+#   login     - unable to log in
+#   hostname  - hostname in the prompt is not the one in the DB
+#   dtype     - device type detected by OS detection is not the one in the DB
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import signal
+from rcmdclass import RcmdError, INIT_COMMANDS, OS_SIGNATURES, load_config, get_inventory, search_rows
+from rcmd import load_hostfile
+from jsonsink import JsonSink
+from profiling import run_main
+
+
+WORKERS = 50
+
+# Device types OS detection can tell apart - the others (e.g. L, T) only get the hostname checked
+DETECTABLE = {dtype for _, dtype, _ in OS_SIGNATURES}
+
+
+def sigint_handler(signum, frame):
+    print(f'\nQuitting script - {signum} {frame}')
+    sys.exit(1)
+
+
+class AuditReport(object):
+
+    def __init__(self, path=None):
+        self.sink = None if path is None else JsonSink(path)
+        self.count = 0
+
+
+    def add(self, host, ip, check, db, found, detail):
+        print(f'{host} - {detail}')
+        if self.sink is not None:
+            self.sink.write({'host': host, 'ip': ip, 'check': check, 'db': db, 'found': found, 'detail': detail})
+        self.count += 1
+        return True
+
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
+        return True
+
+
+def select_rows(config, hosts=None, select=None, report=None):
+    # Selected Devices rows (the whole table if neither is given), each once
+    if config.dbpath is None:
+        raise RcmdError('ERROR: Unable to get DB file from CFG file')
+    inventory = get_inventory(config.dbpath)
+    if hosts is None and select is None:
+        return list(inventory.get_rows())
+
+    rows = []
+    seen = set()
+    for host in hosts or []:
+        row = inventory.get_host(host)
+        if row is None:
+            report.add(host, None, 'missing', None, None, 'Device does not exist in DB')
+        elif row[0].lower() not in seen:
+            seen.add(row[0].lower())
+            rows.append(row)
+    if select is not None:
+        db = sqlite3.connect(config.dbpath)
+        for row in search_rows(db, select.split(' ')):
+            if row[0].lower() not in seen:
+                seen.add(row[0].lower())
+                rows.append(row)
+        db.close()
+    return rows
+
+
+def db_checks(config, rows, expected, report):
+    # check-ip.py for every (hostname, ip) in expected, plus checks of the rows themselves -
+    # the DB is only read once, whatever the number of devices
+    try:
+        db = sqlite3.connect(f'file:{config.dbpath}?mode=ro', uri=True)
+        duplicates = dict(db.execute('SELECT lower(Hostname), group_concat(Hostname, \' \') FROM Devices GROUP BY lower(Hostname) HAVING count(*) > 1').fetchall())
+        mismatches = []
+        if expected:
+            # Compared in SQLite as a join against a temporary table of the expected IPs
+            db.execute('CREATE TEMP TABLE Expected (Hostname TEXT, MgmtIP TEXT)')
+            db.executemany('INSERT INTO Expected VALUES (?, ?)', expected)
+            mismatches = db.execute('SELECT e.Hostname, e.MgmtIP, d.MgmtIP FROM Expected e LEFT JOIN Devices d ON d.Hostname = e.Hostname COLLATE NOCASE WHERE d.MgmtIP IS NULL OR d.MgmtIP <> e.MgmtIP ORDER BY e.rowid').fetchall()
+        db.close()
+    except sqlite3.Error:
+        raise RcmdError('ERROR: Unable to read Devices table from DB')
+
+    for host, mgmtip, dbip in mismatches:
+        if dbip is None:
+            report.add(host, mgmtip, 'missing', None, mgmtip, 'Device does not exist in DB')
+        else:
+            report.add(host, dbip, 'ip', dbip, mgmtip, f'MgmtIP mismatch (DB == {dbip} but expected == {mgmtip})')
+
+    valid = []
+    for row in rows:
+        host, ip, dtype, conn, proxy, authid = row
+        problems = []
+        if host.lower() in duplicates:
+            problems.append(('duplicate', host, duplicates[host.lower()], f'Hostname more than once in DB ({duplicates[host.lower()]})'))
+        if dtype not in INIT_COMMANDS:
+            problems.append(('dtype', dtype, None, f'Invalid DeviceType in DB - {dtype}'))
+        if conn not in ('S', 'T'):
+            problems.append(('conn', conn, None, f'Invalid ConnMethod in DB - {conn}'))
+        if proxy != 0 and proxy not in config.proxies:
+            problems.append(('proxy', proxy, None, f'Invalid ProxyID in DB - no [Proxy{proxy}] section in cfgfile'))
+        if authid not in config.auths:
+            problems.append(('auth', authid, None, f'Invalid AuthID in DB - no [Auth{authid}] section in cfgfile'))
+        for check, dbvalue, found, detail in problems:
+            report.add(host, ip, check, dbvalue, found, detail)
+        # Only rows that can be connected to go on to the login checks (a duplicate still can)
+        if all(problem[0] == 'duplicate' for problem in problems):
+            valid.append(row)
+    return valid
+
+
+async def login_check(config, row, timeout, debug):
+    # One session for both checks - returns (hostname in prompt, detected dtype or None)
+    from asyncrcmd import AsyncDevice
+    from discover import prompt_hostname
+    detect = row[2] in DETECTABLE
+    dev = AsyncDevice(config=config, row=row, osdetect=detect)
+    # Always detect from the device, not from an earlier connect's fingerprint
+    dev.use_fingerprint = False
+    try:
+        await dev.connect(debug, timeout)
+    except BaseException:
+        dev.close()
+        raise
+    try:
+        hostname = prompt_hostname(dev.prompt)
+        dtype = dev.dtype if detect else None
+    finally:
+        await dev.disconnect()
+    return hostname, dtype
+
+
+async def login_checks(config, rows, workers, timeout, report, debug):
+    # Up to workers sessions at a time, and no more than maxsessions through any proxy
+    import asyncio
+    semaphore = asyncio.Semaphore(workers)
+    proxies = {proxy: asyncio.Semaphore(record.maxsessions) for proxy, record in config.proxies.items() if record.maxsessions}
+
+    async def one(row):
+        host, ip, dtype, _, proxy, _ = row
+        proxylimit = proxies.get(proxy)
+        try:
+            if proxylimit is not None:
+                await proxylimit.acquire()
+            try:
+                async with semaphore:
+                    hostname, found = await login_check(config, row, timeout, debug)
+            finally:
+                if proxylimit is not None:
+                    proxylimit.release()
+        except RcmdError as e:
+            if e.value == 'ERROR: Unknown device type':
+                report.add(host, ip, 'dtype', dtype, None, f'Device type mismatch (DB == {dtype} but detected == unknown)')
+            else:
+                report.add(host, ip, 'login', None, None, e.value)
+            return False
+        except Exception as e:  # pylint: disable=broad-except
+            # e.g. pexpect failing to spawn - one device should not stop the audit
+            report.add(host, ip, 'login', None, None, f'ERROR: {e}')
+            return False
+        ok = True
+        if hostname != host.lower():
+            report.add(host, ip, 'hostname', host, hostname, f'Hostname mismatch (DB == {host.upper()} but detected == {hostname.upper()})')
+            ok = False
+        if found is not None and found != dtype:
+            report.add(host, ip, 'dtype', dtype, found, f'Device type mismatch (DB == {dtype} but detected == {found})')
+            ok = False
+        return ok
+
+    return await asyncio.gather(*(one(row) for row in rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='Audit the device DB - check-ip, check-hostname and check-dtype for many devices at once.')
+    parser.add_argument('-i', '--cfgfile', required=True, help='Config file.')
+    parser.add_argument('-f', '--hostfile', default=None, help='Audit the hosts in this file (one per line). Default is the whole DB.')
+    parser.add_argument('-s', '--select', default=None, help='Audit all hosts in DB matching all of the space separated terms. Default is the whole DB.')
+    parser.add_argument('-m', '--mgmtfile', default=None, help='check-ip - file of "hostname,ip" lines to compare with the MgmtIP in the DB.')
+    parser.add_argument('-l', '--login', action='store_true', default=False, help='check-hostname/check-dtype - log in to each device and compare the hostname in the prompt and the detected device type with the DB.')
+    parser.add_argument('-w', '--workers', default=WORKERS, type=int, help=f'Number of concurrent sessions for --login (default {WORKERS})')
+    parser.add_argument('-t', '--timeout', default=45, type=int, help='Timeout for commands (default 45 seconds)')
+    parser.add_argument('-j', '--json', default=None, help='Also write one JSON line per discrepancy to this file.')
+    parser.add_argument('-d', '--debug', action='store_true', default=False, help='Display debugs output.')
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    signal.signal(signal.SIGINT, sigint_handler)
+
+    os.environ['TERM'] = 'vt100'
+
+    start = time.time()
+    report = None
+    try:
+        config = load_config(args.cfgfile)
+        hosts = None if args.hostfile is None else load_hostfile(args.hostfile)
+        expected = []
+        if args.mgmtfile is not None:
+            from discover import load_pairs
+            expected = load_pairs(args.mgmtfile)
+        report = AuditReport(args.json)
+        rows = select_rows(config, hosts, args.select, report)
+        valid = db_checks(config, rows, expected, report)
+        if args.login:
+            import asyncio
+            asyncio.run(login_checks(config, valid, args.workers, args.timeout, report, args.debug))
+    except RcmdError as e:
+        print(e.value)
+        sys.exit(1)
+    finally:
+        if report is not None:
+            try:
+                report.close()
+            except RcmdError as e:
+                print(e.value)
+                sys.exit(1)
+
+    print(f'!!! {len(rows)} devices audited{" (with login)" if args.login else ""} in {time.time() - start:.1f}s - {report.count} discrepancies !!!')
+    if report.count:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run_main(main)
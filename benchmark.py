@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+
+# Local performance benchmarks for rcmdclass.Device - no network devices needed, the devices are
+# simulated by fakedevice.py.
+#
+#   prompt   - CPU time per MB of command output spent finding the prompt, with pexpect's expect()
+#              (do_expect) and with the tail-anchored matcher (do_expect_prompt)
+#   bytes    - CPU time per MB to collect command output and write it to a logfile, in text mode
+#              and in bytes mode (connect(binary=True))
+#   sessions - login latency, commands/sec, MB/s of output and client memory per session with 1,
+#              100 and 1,000 concurrent sessions (AsyncDevice, or Device in a thread per session),
+#              across the device types given by -t
+
+import os
+import sys
+import time
+import shutil
+import asyncio
+import tempfile
+import argparse
+import subprocess
+import concurrent.futures
+import rcmdclass
+import asyncrcmd
+import fakedevice
+from rcmdclass import Device
+from asyncrcmd import AsyncDevice
+from profiling import run_main
+
+
+CFGFILE = '''[Auth1]
+username=bench
+password=bench
+'''
+
+
+def setup(workdir, chunk, pause):
+    cfgfile = os.path.join(workdir, 'bench.ini')
+    with open(cfgfile, 'w') as f:
+        f.write(CFGFILE)
+    # Run in place of ssh, so gets ssh's arguments - settings are passed in the environment
+    os.environ['FAKEDEV_CHUNK'] = str(chunk)
+    os.environ['FAKEDEV_PAUSE'] = str(pause)
+    rcmdclass.SSH = os.path.abspath(fakedevice.__file__)
+    return cfgfile
+
+
+def bench_prompt(cfgfile, sizes, runs):
+    dev = Device(cfgfile=cfgfile, customhost='bench-rtr,L-bench,L,S,0,1')
+    dev.connect(timeout=300)
+    print(f'{"MB".rjust(6)} {"pexpect CPU s/MB".rjust(18)} {"tail CPU s/MB".rjust(15)} {"speedup".rjust(8)}')
+    for size in sizes:
+        nbytes = int(size * 1024 * 1024)
+        results = {}
+        for method in ('pexpect', 'tail'):
+            best = None
+            for _ in range(runs):
+                dev.child.sendline(f'show bytes {nbytes}')
+                start = time.process_time()
+                if method == 'pexpect':
+                    dev.do_expect(dev.prompt, dev.timeout)
+                else:
+                    dev.do_expect_prompt(dev.timeout)
+                cpu = time.process_time() - start
+                if len(dev.buffer) < nbytes:
+                    raise rcmdclass.RcmdError(f'ERROR: Short output ({len(dev.buffer)} < {nbytes})')
+                best = cpu if best is None else min(best, cpu)
+            results[method] = best / size
+        print(f'{size:6g} {results["pexpect"]:18.4f} {results["tail"]:15.4f} {results["pexpect"] / results["tail"]:7.1f}x')
+    dev.disconnect()
+    return True
+
+
+def bench_bytes(cfgfile, workdir, sizes, runs):
+    print(f'{"MB".rjust(6)} {"text CPU s/MB".rjust(15)} {"bytes CPU s/MB".rjust(16)} {"speedup".rjust(8)}')
+    devs = {}
+    for binary in (False, True):
+        devs[binary] = Device(cfgfile=cfgfile, customhost='bench-rtr,L-bench,L,S,0,1')
+        devs[binary].connect(timeout=300, binary=binary)
+    logfile = os.path.join(workdir, 'bench.log')
+    for size in sizes:
+        nbytes = int(size * 1024 * 1024)
+        results = {}
+        for binary, dev in devs.items():
+            best = None
+            for _ in range(runs):
+                with open(logfile, 'wb' if binary else 'w') as fout:
+                    start = time.process_time()
+                    dev.do_sendline(f'show bytes {nbytes}')
+                    fout.write(dev.do_getbuffer_bytes() if binary else dev.do_getbuffer())
+                    cpu = time.process_time() - start
+                best = cpu if best is None else min(best, cpu)
+            results[binary] = best / size
+        print(f'{size:6g} {results[False]:15.4f} {results[True]:16.4f} {results[False] / results[True]:7.1f}x')
+    for dev in devs.values():
+        dev.disconnect()
+    return True
+
+
+def start_server(workdir, latency):
+    # One fakedevice.py for all the sessions, each reached through a connector script run as ssh
+    server = subprocess.Popen([sys.executable, fakedevice.__file__, '--serve', '--pause', '0', '--latency', str(latency)], stdout=subprocess.PIPE)
+    port = int(server.stdout.readline())
+    connector = fakedevice.connector_script(os.path.join(workdir, 'connect'), port)
+    rcmdclass.SSH = connector
+    asyncrcmd.SSH = connector
+    return server
+
+
+def rss():
+    # Resident memory of this process in KB
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def sim_devices(devclass, cfgfile, count, dtypes):
+    devs = []
+    for i in range(count):
+        dtype = dtypes[i % len(dtypes)]
+        devs.append(devclass(cfgfile=cfgfile, customhost=f'sim{i},{dtype}-{i},{dtype},S,0,1'))
+    return devs
+
+
+async def async_sessions(cfgfile, count, dtypes, commands, size):
+    # (login times, seconds running the commands, bytes of output, client KB per session)
+    base = rss()
+    devs = sim_devices(AsyncDevice, cfgfile, count, dtypes)
+
+    async def login(dev):
+        start = time.monotonic()
+        await dev.connect(timeout=600)
+        return time.monotonic() - start
+
+    async def run(dev):
+        nbytes = 0
+        for _ in range(commands):
+            await dev.do_sendline(f'show bytes {size}')
+            nbytes += len(dev.buffer)
+        return nbytes
+
+    logins = await asyncio.gather(*[login(dev) for dev in devs])
+    start = time.monotonic()
+    nbytes = sum(await asyncio.gather(*[run(dev) for dev in devs]))
+    elapsed = time.monotonic() - start
+    memory = (rss() - base) / count
+    await asyncio.gather(*[dev.disconnect() for dev in devs])
+    return logins, elapsed, nbytes, memory
+
+
+def thread_sessions(cfgfile, count, dtypes, commands, size):
+    base = rss()
+    devs = sim_devices(Device, cfgfile, count, dtypes)
+
+    def login(dev):
+        start = time.monotonic()
+        dev.connect(timeout=600)
+        return time.monotonic() - start
+
+    def run(dev):
+        nbytes = 0
+        for _ in range(commands):
+            dev.do_sendline(f'show bytes {size}')
+            nbytes += len(dev.buffer)
+        return nbytes
+
+    def logout(dev):
+        dev.disconnect()
+        dev.child.close(force=True)
+        return True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=count) as pool:
+        logins = list(pool.map(login, devs))
+        start = time.monotonic()
+        nbytes = sum(pool.map(run, devs))
+        elapsed = time.monotonic() - start
+        memory = (rss() - base) / count
+        list(pool.map(logout, devs))
+    return logins, elapsed, nbytes, memory
+
+
+def bench_sessions(workdir, cfgfile, counts, dtypes, commands, size, latency, engine):
+    server = start_server(workdir, latency)
+    print(f'{"sessions".rjust(8)} {"login avg s".rjust(12)} {"login p95 s".rjust(12)} {"cmds/s".rjust(9)} {"MB/s".rjust(8)} {"KB/session".rjust(11)}')
+    try:
+        for count in counts:
+            if engine == 'async':
+                logins, elapsed, nbytes, memory = asyncio.run(async_sessions(cfgfile, count, dtypes, commands, size))
+            else:
+                logins, elapsed, nbytes, memory = thread_sessions(cfgfile, count, dtypes, commands, size)
+            print(f'{count:8d} {sum(logins) / count:12.3f} {percentile(logins, 95):12.3f} {count * commands / elapsed:9.1f} {nbytes / elapsed / 1048576:8.2f} {memory:11.0f}')
+    finally:
+        server.terminate()
+        server.wait()
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='Local performance benchmarks for rcmdclass.Device.')
+    parser.add_argument('bench', choices=['prompt', 'bytes', 'sessions'], help='''prompt - CPU time per MB spent finding the prompt (pexpect vs tail-anchored matcher)
+bytes - CPU time per MB to collect and log output (text vs bytes mode)
+sessions - login latency, commands/sec, MB/s and memory per session with many concurrent sessions''')
+    parser.add_argument('-m', '--sizes', default='1,4,16', help='prompt/bytes - comma separated output sizes in MB (default 1,4,16)')
+    parser.add_argument('-k', '--chunk', default=4096, type=int, help='prompt/bytes - size of each write by the fake device in bytes (default 4096)')
+    parser.add_argument('-p', '--pause', default=0.0002, type=float, help='prompt/bytes - pause between writes by the fake device in seconds, like output arriving over a network (default 0.0002)')
+    parser.add_argument('-n', '--sessions', default='1,100,1000', help='sessions - comma separated numbers of concurrent sessions (default 1,100,1000)')
+    parser.add_argument('-t', '--dtypes', default='CNEFJALTP', help='sessions - device types to simulate, spread evenly over the sessions (default CNEFJALTP)')
+    parser.add_argument('-c', '--commands', default=10, type=int, help='sessions - commands run per session (default 10)')
+    parser.add_argument('-s', '--size', default=16384, type=int, help='sessions - bytes of output per command (default 16384)')
+    parser.add_argument('-l', '--latency', default=0.0, type=float, help='sessions - seconds the fake devices take to act on input (default 0)')
+    parser.add_argument('-e', '--engine', default='async', choices=['async', 'thread'], help='sessions - AsyncDevice on one event loop, or Device in a thread per session (default async)')
+    parser.add_argument('-r', '--runs', default=3, type=int, help='prompt/bytes - runs per measurement, the best is reported (default 3)')
+    args = parser.parse_args()
+
+    os.environ['TERM'] = 'vt100'
+    workdir = tempfile.mkdtemp(prefix='rcmdbench-')
+    try:
+        cfgfile = setup(workdir, args.chunk, args.pause)
+        if args.bench == 'prompt':
+            bench_prompt(cfgfile, [float(size) for size in args.sizes.split(',')], args.runs)
+        elif args.bench == 'bytes':
+            bench_bytes(cfgfile, workdir, [float(size) for size in args.sizes.split(',')], args.runs)
+        elif args.bench == 'sessions':
+            bench_sessions(workdir, cfgfile, [int(count) for count in args.sessions.split(',')], args.dtypes, args.commands, args.size, args.latency, args.engine)
+    except rcmdclass.RcmdError as e:
+        print(e.value)
+        sys.exit(1)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    run_main(main)
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
 
@@ -7,18 +7,19 @@ import sys
 import re
 import getopt
 from rcmdclass import Device, RcmdError
+from profiling import run_main
 
 
 def usage():
-    print 'Usage:\n\t', sys.argv[0], '-i cfgfile [options] host'
-    print '''
+    print('Usage:\n\t', sys.argv[0], '-i cfgfile [options] host')
+    print('''
         -i cfgfile      Config file
         host            Hostname of device to connect to (MUST exist in device DB)
 
         Options:
         -d              Debug mode
         -t timeout      Define timeout for commands (default 45 seconds)
-'''
+''')
     sys.exit(1)
 
 
@@ -28,9 +29,6 @@ def main():
     debug = False
     chgprompt = False
 
-    reload(sys)
-    sys.setdefaultencoding('utf-8')
-
     try:
         opts, args = getopt.getopt(sys.argv[1:], 'i:t:d')
     except getopt.GetoptError:
@@ -54,14 +52,16 @@ def main():
         host = args[0]
 
     if re.search('^[#!]', host):
-        print 'Skipping - %s' %(host)
+        print(f'Skipping - {host}')
         sys.exit(1)
 
     try:
         dev = Device(cfgfile=cfgfile, host=host, osdetect=True)
     except RcmdError as e:
-        print e.value, '-', host
+        print(f'{e.value} - {host}')
         sys.exit(1)
+    # Always detect from the device, not from an earlier connect's fingerprint
+    dev.use_fingerprint = False
 
     if dev.conn == 'S':
         method = 'SSH'
@@ -75,18 +75,18 @@ def main():
     try:
         dev.connect(debug, timeout)
     except RcmdError as e:
-        print e.value, '-', dev.host
+        print(f'{e.value} - {dev.host}')
         sys.exit(1)
 
     detected_type = dev.dtype
 
     if dbtype != detected_type:
-        print '%s - Device type mismatch (DB == %s but detected == %s)' %(dev.host, dbtype, detected_type)
+        print(f'{dev.host} - Device type mismatch (DB == {dbtype} but detected == {detected_type})')
     else:
-        print '%s - %s - OK' %(dev.host, dev.dtype)
+        print(f'{dev.host} - {dev.dtype} - OK')
 
     dev.disconnect()
 
 
 if __name__ == '__main__':
-    main()
+    run_main(main)
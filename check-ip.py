@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
 
@@ -7,18 +7,19 @@ import sys
 import re
 import getopt
 from rcmdclass import Device, RcmdError
+from profiling import run_main
 
 
 def usage():
-    print 'Usage:\n\t', sys.argv[0], '-i cfgfile -m Mgmt-IP [options] host'
-    print '''
+    print('Usage:\n\t', sys.argv[0], '-i cfgfile -m Mgmt-IP [options] host')
+    print('''
         -i cfgfile      Config file
         -m Mgmt-IP      Management IP to compare
         host            Hostname of device to check management IP (MUST exist in device DB)
 
         Options:
         -d              Debug mode
-'''
+''')
     sys.exit(1)
 
 
@@ -27,9 +28,6 @@ def main():
     mgmtip = None
     debug = False
 
-    reload(sys)
-    sys.setdefaultencoding('utf-8')
-
     try:
         opts, args = getopt.getopt(sys.argv[1:], 'i:m:d')
     except getopt.GetoptError:
@@ -53,20 +51,20 @@ def main():
         host = args[0]
 
     if re.search('^[#!]', host):
-        print 'Skipping - %s' %(host)
+        print(f'Skipping - {host}')
         sys.exit(1)
 
     try:
         dev = Device(cfgfile=cfgfile, host=host)
     except RcmdError as e:
-        print e.value, '-', host
+        print(f'{e.value} - {host}')
         sys.exit(1)
 
     if mgmtip == dev.ip:
-        print '%s OK' %(host)
+        print(f'{host} OK')
     else:
-        print '%s mgmtip == %s, dev.ip == %s' %(host, mgmtip, dev.ip)
+        print(f'{host} mgmtip == {mgmtip}, dev.ip == {dev.ip}')
 
 
 if __name__ == '__main__':
-    main()
+    run_main(main)
@@ -1,13 +1,34 @@
-#!/bin/env python
+#!/usr/bin/env python3
 
 # pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
 
 import os
 import sys
 import re
+import csv
+import time
+import sqlite3
+import asyncio
 import argparse
+import concurrent.futures
 import signal
-from rcmdclass import Device, RcmdError
+from rcmdclass import RcmdError, load_config
+from asyncrcmd import AsyncDevice
+from profiling import run_main
+
+
+STAGGER = 0.5  # seconds between starting one (proxy, method) attempt and the next
+WORKERS = 50  # bulk mode - devices discovered at the same time
+BATCH = 100  # bulk mode - Devices rows written per transaction
+
+DEVICES_TABLE = '''CREATE TABLE IF NOT EXISTS Devices (
+    Hostname   TEXT PRIMARY KEY ASC NOT NULL UNIQUE,
+    MgmtIP     TEXT NOT NULL UNIQUE,
+    DeviceType TEXT NOT NULL,
+    ConnMethod TEXT NOT NULL,
+    ProxyID    INT  NOT NULL,
+    AuthID     INT
+)'''
 
 
 def sigint_handler(signum, frame):
@@ -15,16 +36,334 @@ def sigint_handler(signum, frame):
     sys.exit(1)
 
 
+def prompt_hostname(prompt):
+    # Hostname from a learned prompt regex e.g. \r\nrtr1\S*[#>%\$] or \r\nuser@rtr1\S*[#>%\$]
+    hostname = re.sub(r'\\r|\\n|\\S.*|\r|\n|\\', '', prompt)
+    if re.search(r'@', hostname):
+        hostname = hostname.split(r'@')[1]
+    return hostname.lower()
+
+
+async def attempt(config, host, ip, proxy, method, auth, timeout, debug):
+    dev = AsyncDevice(config=config, customhost=f'{host},{ip},C,{method},{proxy},{auth}', osdetect=True)
+    # Always detect from the device, not from an earlier connect's fingerprint
+    dev.use_fingerprint = False
+    if debug:
+        print(f'!!! Connecting to {dev.host} ({dev.ip}) using {"SSH" if method == "S" else "Telnet"} ({proxy}) !!!')
+    try:
+        await dev.connect(debug, timeout)
+    except BaseException as e:
+        # Failed, or cancelled because another attempt got there first
+        dev.close()
+        if debug and isinstance(e, Exception):
+            print(f'{e.value if isinstance(e, RcmdError) else f"ERROR: {e}"} - {host} {ip} ({proxy})')
+        raise
+    return dev
+
+
+async def race(config, host, ip, proxies, auth, timeout, stagger=STAGGER, debug=False):
+    # Happy eyeballs - the (proxy, method) attempts are started stagger seconds apart, or as soon
+    # as the one before fails, in the order given. The first to log in wins and the rest are
+    # cancelled. Returns the connected AsyncDevice.
+    candidates = [(proxy, method) for proxy in proxies for method in ['S', 'T']]
+    order = {}
+    pending = set()
+    winner = None
+    error = None
+    try:
+        while candidates or pending:
+            if candidates:
+                proxy, method = candidates.pop(0)
+                task = asyncio.ensure_future(attempt(config, host, ip, proxy, method, auth, timeout, debug))
+                order[task] = len(order)
+                pending.add(task)
+            done, pending = await asyncio.wait(pending, timeout=stagger if candidates else None, return_when=asyncio.FIRST_COMPLETED)
+            # Earlier candidates are preferred if more than one finished at once
+            for task in sorted(done, key=order.get):
+                if task.exception() is None:
+                    if winner is None:
+                        winner = task.result()
+                    else:
+                        # Also logged in, but too late
+                        task.result().close()
+                elif isinstance(task.exception(), RcmdError):
+                    # Logged in, but the device type is not known - no point trying other ways
+                    if task.exception().value == 'ERROR: Unknown device type':
+                        error = task.exception()
+                # Any other failure (e.g. pexpect unable to spawn ssh for this proxy) is only
+                # this candidate's - the others may still get in
+            if winner is not None or error is not None:
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    if error is not None:
+        raise error
+    if winner is None:
+        raise RcmdError(f'ERROR: Unable to discover {host} - {ip}')
+    return winner
+
+
+def check_ids(config, proxies, auth):
+    # Bad auth/proxy IDs would otherwise just look like failed attempts
+    config.get_auth(auth)
+    for proxy in proxies:
+        if proxy != 0:
+            config.get_proxy(proxy)
+    return True
+
+
+async def detect(config, host, ip, proxies, auth, timeout, stagger, debug):
+    # Returns the Devices row for the device, with the hostname taken from its prompt
+    dev = await race(config, host, ip, proxies, auth, timeout, stagger, debug)
+    try:
+        row = (prompt_hostname(dev.prompt), dev.ip, dev.dtype, dev.conn, dev.proxy, dev.authid)
+    finally:
+        await dev.disconnect()
+    return row
+
+
+async def discover(config, host, ip, proxies, auth, timeout, stagger, debug):
+    try:
+        check_ids(config, proxies, auth)
+    except RcmdError as e:
+        print(f'{e.value} - {host}')
+        return False
+
+    try:
+        row = await detect(config, host, ip, proxies, auth, timeout, stagger, debug)
+    except RcmdError as e:
+        if e.value == 'ERROR: Unknown device type':
+            print(f'{e.value} - {host} {ip}')
+        else:
+            print(e.value)
+        return False
+
+    if host.lower() != row[0]:
+        sys.stdout.write(f'Hostname mismatch (Provided == {host.lower()} but detected == {row[0]}) - ')
+    print(','.join(str(field) for field in row))
+    return True
+
+
+def load_pairs(hostfile):
+    # Bulk mode hostfile - "hostname,ip" (or "hostname ip") per line
+    try:
+        hostf = open(hostfile, 'r')
+    except IOError:
+        raise RcmdError('ERROR: Unable to open hostfile')
+    pairs = []
+    for lineno, line in enumerate(hostf, 1):
+        line = line.strip()
+        # Ignore blank lines and lines starting with # or ! as comments
+        if not line or re.match('[#!]', line):
+            continue
+        fields = re.split(r'[,\s]+', line)
+        if len(fields) != 2:
+            hostf.close()
+            raise RcmdError(f'ERROR: Invalid line {lineno} in hostfile (should be hostname,ip) - {line}')
+        pairs.append((fields[0], fields[1]))
+    hostf.close()
+    return pairs
+
+
+class BulkReport(object):
+
+    # Bulk mode report of what was not written to the DB, as CSV - Status,Hostname,MgmtIP,Detail
+    #   mismatch - logged in, but the prompt shows another hostname. Detail is the detected row.
+    #   conflict - the MgmtIP is already in the DB under another hostname
+    #   failed   - unable to log in, or unknown device type
+
+    def __init__(self, path):
+        try:
+            self.f = open(path, 'w', newline='')
+        except IOError:
+            raise RcmdError('ERROR: Unable to open report file')
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(['Status', 'Hostname', 'MgmtIP', 'Detail'])
+        self.counts = {'mismatch': 0, 'conflict': 0, 'failed': 0}
+
+
+    def add(self, status, host, ip, detail):
+        self.writer.writerow([status, host, ip, detail])
+        self.counts[status] += 1
+        return True
+
+
+    def close(self):
+        self.f.close()
+        return True
+
+
+class DevicesWriter(object):
+
+    # Bulk mode - upserts discovered devices into the Devices table, batch rows per transaction.
+    # An existing row with the same hostname (any case) is updated in place, keeping its hostname.
+    # Batches are written on a thread of their own, one at a time, so a locked Devices DB holds up
+    # the writes but not the discoveries on the event loop.
+
+    def __init__(self, path, report, batch=BATCH):
+        try:
+            self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.db.execute(DEVICES_TABLE)
+        except sqlite3.Error:
+            raise RcmdError('ERROR: Unable to open Devices table in DB')
+        self.report = report
+        self.batch = batch
+        self.rows = []
+        self.added = 0
+        self.updated = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
+    async def add(self, host, row):
+        self.rows.append((host, row))
+        if len(self.rows) >= self.batch:
+            await self.flush()
+        return True
+
+
+    async def flush(self):
+        rows, self.rows = self.rows, []
+        if rows:
+            conflicts = await asyncio.get_running_loop().run_in_executor(self.executor, self.write, rows)
+            self.add_conflicts(conflicts)
+        return True
+
+
+    def write(self, rows):
+        # Returns [(host, ip, detail)] for rows whose MgmtIP is already in the DB under another hostname
+        conflicts = []
+        try:
+            with self.db:
+                for host, row in rows:
+                    try:
+                        cursor = self.db.execute('UPDATE Devices SET MgmtIP = ?, DeviceType = ?, ConnMethod = ?, ProxyID = ?, AuthID = ? WHERE Hostname = ? COLLATE NOCASE', row[1:] + row[:1])
+                        if cursor.rowcount:
+                            self.updated += 1
+                        else:
+                            self.db.execute('INSERT INTO Devices VALUES (?, ?, ?, ?, ?, ?)', row)
+                            self.added += 1
+                    except sqlite3.IntegrityError:
+                        # Only this statement is rolled back, the rest of the batch still goes in
+                        other = self.db.execute('SELECT Hostname FROM Devices WHERE MgmtIP = ?', (row[1],)).fetchone()
+                        conflicts.append((host, row[1], f'MgmtIP already in DB as {other[0] if other else "unknown"} - {",".join(str(field) for field in row)}'))
+        except sqlite3.Error:
+            raise RcmdError('ERROR: Unable to write Devices table to DB')
+        return conflicts
+
+
+    def add_conflicts(self, conflicts):
+        for host, ip, detail in conflicts:
+            self.report.add('conflict', host, ip, detail)
+        return True
+
+
+    def close(self):
+        # After the event loop has finished - waits for a batch still being written (e.g. after
+        # Ctrl-C), then writes what is left
+        self.executor.shutdown(wait=True)
+        rows, self.rows = self.rows, []
+        try:
+            self.add_conflicts(self.write(rows))
+        finally:
+            self.db.close()
+        return True
+
+
+async def bulk(config, pairs, proxies, auth, timeout, stagger, workers, writer, report, debug):
+    # Discovers up to workers devices at the same time, each racing its proxy/method attempts
+    semaphore = asyncio.Semaphore(workers)
+
+    async def one(host, ip):
+        async with semaphore:
+            try:
+                row = await detect(config, host, ip, proxies, auth, timeout, stagger, debug)
+            except RcmdError as e:
+                report.add('failed', host, ip, e.value)
+                return False
+            except Exception as e:  # pylint: disable=broad-except
+                # e.g. pexpect failing to spawn - one device should not stop the run
+                report.add('failed', host, ip, f'ERROR: {e}')
+                return False
+        line = ','.join(str(field) for field in row)
+        if host.lower() != row[0]:
+            report.add('mismatch', host, ip, line)
+            return False
+        print(line)
+        if writer is not None:
+            await writer.add(host, row)
+        return True
+
+    results = await asyncio.gather(*(one(host, ip) for host, ip in pairs))
+    return results.count(True)
+
+
+def bulk_main(cfgfile, hostfile, reportfile, nodb, proxies, auth, timeout, stagger, workers, batch, debug):
+    if reportfile is None:
+        reportfile = f'{hostfile}.report.csv'
+    try:
+        config = load_config(cfgfile)
+        if not nodb and config.dbpath is None:
+            raise RcmdError('ERROR: Unable to get DB file from CFG file')
+        check_ids(config, proxies, auth)
+        pairs = load_pairs(hostfile)
+    except RcmdError as e:
+        print(e.value)
+        return False
+
+    start = time.time()
+    report = None
+    writer = None
+    try:
+        report = BulkReport(reportfile)
+        if not nodb:
+            writer = DevicesWriter(config.dbpath, report, batch)
+        discovered = asyncio.run(bulk(config, pairs, proxies, auth, timeout, stagger, workers, writer, report, debug))
+    except RcmdError as e:
+        print(e.value)
+        return False
+    finally:
+        # Devices discovered before a failure or Ctrl-C still go in
+        try:
+            if writer is not None:
+                writer.close()
+        except RcmdError as e:
+            print(e.value)
+        if report is not None:
+            report.close()
+
+    counts = report.counts
+    dbmsg = 'not written to DB' if writer is None else f'{writer.added} added to DB, {writer.updated} updated'
+    print(f'!!! {len(pairs)} devices in {time.time() - start:.1f}s - {discovered} discovered ({dbmsg}), {counts["mismatch"]} hostname mismatches, {counts["conflict"]} DB conflicts, {counts["failed"]} failed - see {reportfile} !!!')
+    return sum(counts.values()) == 0
+
+
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='Run OS discovery on remote device.')
     parser.add_argument('-i', '--cfgfile', required=True, help='Config file.')
-    parser.add_argument('--host', required=True, help='Hostname of device to connect to.')
-    parser.add_argument('--ip', required=True, help='Management IP of device to connect to.')
+    parser.add_argument('--host', default=None, help='Hostname of device to connect to.')
+    parser.add_argument('--ip', default=None, help='Management IP of device to connect to.')
     parser.add_argument('-d', '--debug', action='store_true', default=False, help='Display debugs output.')
-    parser.add_argument('-p', '--proxy', action='append', type=int, help='Proxy to use (specify multiple times to cycle thru list).')
+    parser.add_argument('-p', '--proxy', action='append', type=int, help='Proxy to use (specify multiple times to try a list - SSH then telnet for each, in order).')
     parser.add_argument('-a', '--auth', default=1, type=int, help='Auth ID to use. Default is 1.')
     parser.add_argument('-t', '--timeout', default=45, type=int, help='Timeout for commands (default 45 seconds)')
+    parser.add_argument('-s', '--stagger', default=STAGGER, type=float, help=f'Seconds between starting each proxy/method attempt, or as soon as the previous one fails - attempts run at the same time and the first to log in is used (default {STAGGER})')
+    parser.add_argument('-f', '--hostfile', default=None, help='Bulk mode - file of devices to discover, one "hostname,ip" per line. Discovered devices are added to (or updated in) the Devices table of the DB.')
+    parser.add_argument('-w', '--workers', default=WORKERS, type=int, help=f'Bulk mode - number of devices discovered at the same time (default {WORKERS})')
+    parser.add_argument('-b', '--batch', default=BATCH, type=int, help=f'Bulk mode - number of devices written to the DB per transaction (default {BATCH})')
+    parser.add_argument('-r', '--report', default=None, help='Bulk mode - CSV file for hostname mismatches, DB conflicts and failures (default <hostfile>.report.csv)')
+    parser.add_argument('-n', '--nodb', action='store_true', default=False, help='Bulk mode - only print the discovered devices, do not write them to the DB.')
     args = parser.parse_args()
+    if args.hostfile is not None:
+        if args.host is not None or args.ip is not None:
+            parser.error('--host/--ip cannot be used with --hostfile')
+        if args.workers < 1:
+            parser.error('--workers must be at least 1')
+        if args.batch < 1:
+            parser.error('--batch must be at least 1')
+    elif args.host is None or args.ip is None:
+        parser.error('--host and --ip are required unless --hostfile is used')
     cfgfile = args.cfgfile
     host = args.host
     ip = args.ip
@@ -34,62 +373,26 @@ def main():
         proxylist = [0]
     auth = args.auth
     timeout = args.timeout
+    stagger = args.stagger
 
     signal.signal(signal.SIGINT, sigint_handler)
 
     os.environ['TERM'] = 'vt100'
 
-    for proxy in proxylist:
-        for connmethod in ['S', 'T']:
-            customhost = f'{host},{ip},C,{connmethod},{proxy},{auth}'
-            try:
-                dev = Device(cfgfile=cfgfile, customhost=customhost, osdetect=True)
-            except RcmdError as e:
-                print( f'{e.value} - {host}')
-                sys.exit(1)
-            if debug:
-                if dev.conn == 'S':
-                    method = 'SSH'
-                elif dev.conn == 'T':
-                    method = 'Telnet'
-                else:
-                    method = 'Unknown'
-                print(f'!!! Connecting to {dev.host} ({dev.ip}) using {method} ({proxy}) !!!')
-            try:
-                dev.connect(debug, timeout)
-            except RcmdError as e:
-                if e.value == 'ERROR: Unknown device type':
-                    print(f'{e.value} - {host} {ip} ({proxy})')
-                    sys.exit(1)
-                if debug:
-                    print(f'{e.value} - {host} {ip} ({proxy})')
-            if dev.connected:
-                break
-        if dev.connected:
-            break
+    if args.hostfile is not None:
+        if not bulk_main(cfgfile, args.hostfile, args.report, args.nodb, proxylist, auth, timeout, stagger, args.workers, args.batch, debug):
+            sys.exit(1)
+        return
 
-    if not dev.connected:
-        print(f'ERROR: Unable to discover {host} - {ip}')
+    try:
+        config = load_config(cfgfile)
+    except RcmdError as e:
+        print(f'{e.value} - {host}')
         sys.exit(1)
 
-    devprompt = dev.prompt
-    #print devprompt
-    #dev.dump_hex(devprompt)
-    detected_hostname = re.sub(r'\\r|\\n|\\S.*|\r|\n|\\', '', devprompt)
-    #print detected_hostname
-    #dev.dump_hex(detected_hostname)
-    if re.search(r'@', detected_hostname):
-        aa = detected_hostname.split(r'@')
-        detected_hostname = aa[1]
-
-    dev.host = dev.host.lower()
-    detected_hostname = detected_hostname.lower()
-    if dev.host != detected_hostname:
-        sys.stdout.write(f'Hostname mismatch (Provided == {dev.host} but detected == {detected_hostname}) - ')
-    print(f'{detected_hostname},{dev.ip},{dev.dtype},{dev.conn},{dev.proxy},{dev.authid}')
-
-    dev.disconnect()
+    if not asyncio.run(discover(config, host, ip, proxylist, auth, timeout, stagger, debug)):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
-    main()
+    run_main(main)
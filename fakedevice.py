@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements, too-many-instance-attributes, too-many-return-statements
+
+# Local fake network device for testing and benchmarking rcmdclass.Device without real gear.
+#
+# Mimics the login (ssh password or telnet username/password prompts), enable, paging
+# (MORE_PROMPTS), show version and prompt style of each device type (C/N/E/F/J/A/L/T/P), with
+# configurable latency, output sizes and output pacing. It can be run two ways:
+#
+#   - in place of ssh/telnet (rcmdclass.SSH = '.../fakedevice.py'), one process per session.
+#     It takes the ssh/telnet arguments, with the device type from $FAKEDEV_DTYPE, or from the
+#     target if it looks like <dtype>-<anything> (e.g. a custom host with IP "J-0001").
+#   - as a server (--serve) handling any number of sessions in one process. Sessions connect to
+#     it through connector_script(), a small shell script used in place of ssh, which passes its
+#     arguments on as the first line.
+#
+# Device commands understood (anything else just gets the prompt back, like a config line):
+#   show version              - OS signature as matched by rcmdclass.OS_SIGNATURES
+#   show lines N              - N lines of routing table like output
+#   show bytes N              - N bytes of routing table like output
+#   show tech-support         - --size bytes of output
+#   enable, configure/conf t, end, exit/quit/logout, terminal length 0 and the other paging
+#   off commands in rcmdclass.INIT_COMMANDS
+
+import os
+import sys
+import asyncio
+import argparse
+
+
+PAGE_LENGTH = 24
+WRITE_BLOCK = 64 * 1024
+ROW = '10.{0}.{1}.0/24 via 192.168.{1}.1, GigabitEthernet0/{2}, 1d02h'
+
+# Per device type: prompts (user, privileged, config)
+PROMPTS = {
+    'C': ('{host}>', '{host}#', '{host}(config)#'),
+    'N': ('{host}#', '{host}#', '{host}(config)#'),
+    'E': ('{host}/Admin#', '{host}/Admin#', '{host}/Admin(config)#'),
+    'F': ('{host}>', '{host}#', '{host}(config)#'),
+    'J': ('{user}@{host}>', '{user}@{host}>', '{user}@{host}#'),
+    'A': ('{host}>', '{host}#', '{host}(config)#'),
+    'L': ('{user}@{host}:~$ ', '{user}@{host}:~$ ', '{user}@{host}:~$ '),
+    'T': ('{user}@({host})(tmos)#', '{user}@({host})(tmos)#', '{user}@({host})(tmos)#'),
+    'P': ('{user}@{host}> ', '{user}@{host}> ', '{user}@{host}# '),
+}
+# Paging prompt (None - never pages)
+MORE = {
+    'C': ' --More-- ',
+    'N': ' --More-- ',
+    'E': ' --More-- ',
+    'F': '<--- More --->',
+    'J': '---(more)---',
+    'A': ' --More-- ',
+    'L': None,
+    'T': None,
+    'P': None,
+}
+# Paging off command (types not listed never page)
+PAGING_OFF = {
+    'C': 'terminal length 0',
+    'N': 'terminal length 0',
+    'E': 'terminal length 0',
+    'F': 'terminal pager 0',
+    'J': 'set cli screen-length 0',
+    'A': 'terminal length 0',
+}
+# show version text, as matched by rcmdclass.OS_SIGNATURES
+VERSIONS = {
+    'C': 'Cisco IOS Software, C3900 Software (C3900-UNIVERSALK9-M), Version 15.7(3)M5, RELEASE SOFTWARE (fc1)',
+    'N': 'Cisco Nexus Operating System (NX-OS) Software\nTAC support: http://www.cisco.com/tac',
+    'E': 'Cisco Application Control Software (ACSW)\nTAC support: http://www.cisco.com/tac',
+    'F': 'Cisco Adaptive Security Appliance Software Version 9.8(4)\nFirepower Extensible Operating System Version 2.2(2.97)',
+    'J': 'Hostname: {host}\nModel: mx480\nJUNOS Software Release [15.1R7.9]',
+    'A': 'Arista DCS-7050TX-64-R\nSoftware image version: 4.20.11M',
+    'L': 'Linux {host} 5.15.0-91-generic #101-Ubuntu SMP x86_64 GNU/Linux',
+    'T': 'Sys::Version\nMain Package\n  Product     BIG-IP\n  Version     15.1.10',
+    'P': 'hostname: {host}\nmodel: PA-5220\nsw-version: 10.1.11',
+}
+
+
+class FakeSession(object):
+
+    def __init__(self, reader, writer, args, options):
+        self.reader = reader
+        self.writer = writer
+        self.options = options
+        # ssh is called with -l user, telnet/socat without
+        self.telnet = '-l' not in args
+        self.user = args[args.index('-l') + 1] if not self.telnet else None
+        target = args[-1] if args else 'sim'
+        if len(target) > 2 and target[1] == '-' and target[0] in PROMPTS:
+            self.dtype = target[0]
+        else:
+            self.dtype = options.dtype
+        self.host = 'sim-' + ''.join(c if c.isalnum() else '-' for c in target).lower()
+        self.privileged = self.dtype in ('N', 'E', 'J', 'L', 'T', 'P')
+        self.config = False
+        self.paging = MORE[self.dtype] is not None
+        self.pending = bytearray()
+
+
+    def prompt(self):
+        if self.config:
+            style = 2
+        elif self.privileged:
+            style = 1
+        else:
+            style = 0
+        return '\r\n' + PROMPTS[self.dtype][style].format(host=self.host, user=self.user or 'admin')
+
+
+    async def write(self, text):
+        data = text.encode()
+        if not self.options.pause:
+            self.writer.write(data)
+            await self.writer.drain()
+            return True
+        # --chunk bytes at a time, like output arriving over a slow link
+        for start in range(0, len(data), self.options.chunk):
+            self.writer.write(data[start:start+self.options.chunk])
+            await self.writer.drain()
+            await asyncio.sleep(self.options.pause)
+        return True
+
+
+    async def read(self):
+        # Next chunk of input, delivered --latency seconds after it arrived (like a round trip)
+        data = await self.reader.read(4096)
+        if not data:
+            raise EOFError
+        if self.options.latency:
+            await asyncio.sleep(self.options.latency)
+        return data
+
+
+    async def readkey(self):
+        if not self.pending:
+            self.pending += await self.read()
+        key = self.pending[:1]
+        del self.pending[:1]
+        return key
+
+
+    async def readline(self, echo=True):
+        # A line of input - echoed by the device (the client's terminal is in raw mode), not the pty
+        while True:
+            ends = [pos for pos in (self.pending.find(b'\r'), self.pending.find(b'\n')) if pos >= 0]
+            if ends:
+                idx = min(ends)
+                line = bytes(self.pending[:idx])
+                # \r\n counts as one line end
+                if self.pending[idx:idx+2] == b'\r\n':
+                    del self.pending[:idx+2]
+                else:
+                    del self.pending[:idx+1]
+                line = line.replace(b'\x1b', b'').decode('utf-8', 'ignore')
+                if echo:
+                    await self.write(line + '\r\n')
+                return line
+            self.pending += await self.read()
+
+
+    async def login(self):
+        if self.options.login_delay:
+            await asyncio.sleep(self.options.login_delay)
+        if self.options.hostkey and not self.telnet:
+            await self.write("The authenticity of host 'sim' can't be established.\r\nED25519 key fingerprint is SHA256:3fR8sTmTz0bDq1yBZbVh0n5cM9pJk2Xo4i7uW6eLqYc.\r\nAre you sure you want to continue connecting (yes/no/[fingerprint])? ")
+            if await self.readline() != 'yes':
+                await self.write('Host key verification failed.\r\n')
+                return False
+        for _ in range(3):
+            if self.telnet:
+                await self.write('\r\nUser Access Verification\r\n\r\nUsername: ')
+                self.user = await self.readline()
+            await self.write('Password: ')
+            password = await self.readline(echo=False)
+            if self.options.password is None or password == self.options.password:
+                if self.dtype == 'L':
+                    await self.write('\r\nLast login: Mon Jan  8 10:12:44 2024 from 10.0.0.1')
+                await self.write('\r\n' + self.prompt())
+                return True
+            if self.options.reject is not None:
+                await self.write(f'\r\n{self.options.reject}\r\n')
+            elif self.telnet:
+                await self.write('\r\n% Login invalid\r\n')
+            else:
+                await self.write('\r\nPermission denied, please try again.\r\n')
+        return False
+
+
+    async def enable(self):
+        if self.privileged:
+            await self.write(self.prompt())
+            return True
+        await self.write('Password: ')
+        password = await self.readline(echo=False)
+        if self.options.enable is None or password == self.options.enable:
+            self.privileged = True
+        elif self.dtype == 'F':
+            await self.write('\r\nInvalid password')
+        else:
+            await self.write('\r\n% Bad secrets\r\n')
+        await self.write(self.prompt())
+        return True
+
+
+    def lines(self, count):
+        for i in range(count):
+            yield ROW.format(i // 256 % 256, i % 256, i % 48)
+
+
+    def sized(self, size):
+        # Lines adding up to size bytes (with \r\n)
+        for line in self.lines(size):
+            if size <= 0:
+                return
+            line = line[:max(0, size - 2)]
+            size -= len(line) + 2
+            yield line
+
+
+    async def output(self, lines):
+        # Send the lines of a command's output, a page at a time if paging is on
+        if not self.paging:
+            block = []
+            size = 0
+            for line in lines:
+                block.append(line)
+                size += len(line) + 2
+                if size >= WRITE_BLOCK:
+                    await self.write('\r\n'.join(block) + '\r\n')
+                    block = []
+                    size = 0
+            if block:
+                await self.write('\r\n'.join(block) + '\r\n')
+            return True
+        count = 0
+        for line in lines:
+            if count == PAGE_LENGTH - 1:
+                await self.write(MORE[self.dtype])
+                key = await self.readkey()
+                # Erase the paging prompt like the real thing
+                await self.write('\r' + ' ' * len(MORE[self.dtype]) + '\r')
+                if key not in (b' ', b'\r', b'\n'):
+                    return True
+                count = 0
+            await self.write(line + '\r\n')
+            count += 1
+        return True
+
+
+    async def command(self, line):
+        # Returns False when the session should end
+        cmd = line.split()
+        if not cmd:
+            pass
+        elif cmd[0] in ('exit', 'quit', 'logout') and not self.config:
+            return False
+        elif cmd[0] in ('exit', 'end') and self.config:
+            self.config = False
+        elif cmd[0] == 'enable' and not self.config:
+            return await self.enable()
+        elif cmd[0] in ('configure', 'conf', 'edit'):
+            self.config = True
+        elif line.strip() == PAGING_OFF.get(self.dtype):
+            self.paging = False
+        elif cmd[:2] == ['show', 'version']:
+            text = VERSIONS[self.dtype].format(host=self.host)
+            version = [''] + text.split('\n') + [''] + [f'  {self.host} uptime is 1 year, 2 weeks, {i} hours' for i in range(40)]
+            await self.output(version)
+        elif len(cmd) == 3 and cmd[:2] == ['show', 'lines'] and cmd[2].isdigit():
+            await self.output(self.lines(int(cmd[2])))
+        elif len(cmd) == 3 and cmd[:2] == ['show', 'bytes'] and cmd[2].isdigit():
+            await self.output(self.sized(int(cmd[2])))
+        elif cmd[0] == 'show' and len(cmd) > 1 and cmd[1].startswith('tech'):
+            await self.output(self.sized(self.options.size))
+        await self.write(self.prompt())
+        return True
+
+
+    async def run(self):
+        try:
+            if await self.login():
+                while await self.command(await self.readline()):
+                    pass
+        except (EOFError, ConnectionError):
+            pass
+        finally:
+            self.writer.close()
+        return True
+
+
+async def serve(options):
+    async def session(reader, writer):
+        # First line from connector_script() is the ssh/telnet command line
+        args = (await reader.readline()).decode().split()
+        await FakeSession(reader, writer, args, options).run()
+
+    server = await asyncio.start_server(session, '127.0.0.1', options.port, limit=1024 * 1024, backlog=4096)
+    port = server.sockets[0].getsockname()[1]
+    print(port, flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+async def standalone(options, args):
+    # One session on stdin/stdout (the pty). Like sshd's pty - no local echo or output
+    # processing, the device does its own echo and sends \r\n itself.
+    import termios
+    if os.isatty(0):
+        attrs = termios.tcgetattr(0)
+        attrs[1] &= ~termios.OPOST
+        attrs[3] &= ~(termios.ECHO | termios.ICANON | termios.ISIG)
+        termios.tcsetattr(0, termios.TCSANOW, attrs)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(0, 'rb', 0))
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, os.fdopen(1, 'wb', 0))
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    await FakeSession(reader, writer, args, options).run()
+
+
+def connector_script(path, port):
+    # Writes a script to use in place of ssh/telnet (rcmdclass.SSH/TELNET) that connects the
+    # session to a fakedevice.py --serve on port. bash/stty/cat only - far lighter than a
+    # Python process per session when running thousands of them.
+    with open(path, 'w') as f:
+        f.write(f'''#!/bin/bash
+stty raw -echo
+exec 3<>/dev/tcp/127.0.0.1/{port} 4<&0
+echo "$@" >&3
+cat <&4 >&3 &
+cat <&3
+kill $! 2>/dev/null
+''')
+    os.chmod(path, 0o700)
+    return path
+
+
+def options_parser():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='Fake network device for testing and benchmarking rcmd without real devices.')
+    parser.add_argument('--serve', action='store_true', default=False, help='Run as a server for many sessions (see connector_script()) instead of one session on stdin/stdout.')
+    parser.add_argument('--port', default=0, type=int, help='--serve - TCP port on 127.0.0.1 (default any free port, printed on startup)')
+    parser.add_argument('--dtype', default=os.environ.get('FAKEDEV_DTYPE', 'C'), choices=sorted(PROMPTS), help='Device type when not given by the target (default $FAKEDEV_DTYPE or C)')
+    parser.add_argument('--latency', default=float(os.environ.get('FAKEDEV_LATENCY', '0')), type=float, help='Seconds before input is acted on, like a network round trip (default $FAKEDEV_LATENCY or 0)')
+    parser.add_argument('--login-delay', default=float(os.environ.get('FAKEDEV_LOGIN_DELAY', '0')), type=float, help='Seconds before the first login prompt, like the ssh handshake (default $FAKEDEV_LOGIN_DELAY or 0)')
+    parser.add_argument('--size', default=int(os.environ.get('FAKEDEV_SIZE', str(1024 * 1024))), type=int, help='Bytes of output for show tech-support (default $FAKEDEV_SIZE or 1 MB)')
+    parser.add_argument('--chunk', default=int(os.environ.get('FAKEDEV_CHUNK', '4096')), type=int, help='Bytes per write when --pause is set (default $FAKEDEV_CHUNK or 4096)')
+    parser.add_argument('--pause', default=float(os.environ.get('FAKEDEV_PAUSE', '0')), type=float, help='Seconds between writes of --chunk bytes (default $FAKEDEV_PAUSE or 0 - no pacing)')
+    parser.add_argument('--password', default=os.environ.get('FAKEDEV_PASSWORD'), help='Login password (default $FAKEDEV_PASSWORD, any password if not set)')
+    parser.add_argument('--reject', default=os.environ.get('FAKEDEV_REJECT'), help='Message for a wrong login password e.g. "% Authentication failed" (default $FAKEDEV_REJECT, else "% Login invalid" for telnet and "Permission denied, please try again." for ssh)')
+    parser.add_argument('--hostkey', action='store_true', default=bool(os.environ.get('FAKEDEV_HOSTKEY')), help='ssh - ask to accept an unknown host key before the password (default on if $FAKEDEV_HOSTKEY is set)')
+    parser.add_argument('--enable', default=os.environ.get('FAKEDEV_ENABLE'), help='Enable password (default $FAKEDEV_ENABLE, any password if not set)')
+    return parser
+
+
+def main():
+    if '--serve' in sys.argv[1:] or sys.argv[1:] in (['-h'], ['--help']):
+        options = options_parser().parse_args()
+        try:
+            asyncio.run(serve(options))
+        except KeyboardInterrupt:
+            pass
+        return
+    # In place of ssh/telnet - the arguments are ssh's/telnet's, settings come from the environment
+    options = options_parser().parse_args([])
+    asyncio.run(standalone(options, sys.argv[1:]))
+
+
+if __name__ == '__main__':
+    main()
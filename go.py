@@ -1,17 +1,18 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string
 
 
 import sys
 import getopt
-import ConfigParser
+import configparser
 import sqlite3
 import pexpect
 import os
 import time
 import readline
 import threading
+from rcmdclass import search_rows
 
 SSH = '/usr/bin/ssh'
 TELNET = '/usr/bin/telnet'
@@ -25,21 +26,21 @@ HostList = []
 HostDict = {}
 
 def usage():
-    print 'Usage:\n\t', sys.argv[0], '-i cfgfile [options] host'
-    print '''
+    print('Usage:\n\t', sys.argv[0], '-i cfgfile [options] host')
+    print('''
         -i cfgfile      Config file
         host            Hostname of device to connect to (MUST exist in device DB)
 
         Options:
         -l logfile      Define a logfile to send output to
-'''
+''')
     sys.exit(1)
 
 def do_spawn_ssh(myip, myusername, mypassword, mysshconfig=''):
     if mysshconfig != '':
-        mychild = pexpect.spawn(SSH, ['-F', mysshconfig, '-l', myusername, myip])
+        mychild = pexpect.spawn(SSH, ['-F', mysshconfig, '-l', myusername, myip], encoding='utf-8', codec_errors='ignore')
     else:
-        mychild = pexpect.spawn(SSH, ['-l', myusername, myip])
+        mychild = pexpect.spawn(SSH, ['-l', myusername, myip], encoding='utf-8', codec_errors='ignore')
     mychild.maxread = MAXREAD
     do_expect(mychild, passwordPrompt, 10)
     time.sleep(1)
@@ -48,24 +49,24 @@ def do_spawn_ssh(myip, myusername, mypassword, mysshconfig=''):
 
 def do_spawn_telnet(myip, myusername, mypassword, mypserver='', mypport=''):
     if mypserver == '':
-        mychild = pexpect.spawn(TELNET, [myip])
+        mychild = pexpect.spawn(TELNET, [myip], encoding='utf-8', codec_errors='ignore')
     else:
         arglist = ['-,rawer']
         arg2 = 'socks4:%s:%s:23,socksport=%s' %(mypserver, myip, mypport)
         arglist.append(arg2)
-        mychild = pexpect.spawn(SOCAT, arglist)
+        mychild = pexpect.spawn(SOCAT, arglist, encoding='utf-8', codec_errors='ignore')
     mychild.maxread = MAXREAD
     myexp = mychild.expect(['sername:', 'ogin:', pexpect.EOF, pexpect.TIMEOUT], timeout=10)
     if myexp == 0 or myexp == 1:
         pass
     elif myexp == 2:
-        print 'ERROR: EOF encountered - %s' %(host)
+        print('ERROR: EOF encountered - %s' %(host))
         sys.exit(1)
     elif myexp == 3:
-        print 'ERROR: Timeout encountered - %s' %(host)
+        print('ERROR: Timeout encountered - %s' %(host))
         sys.exit(1)
     else:
-        print 'ERROR: Unknown expect error - %s' %(host)
+        print('ERROR: Unknown expect error - %s' %(host))
         sys.exit(1)
     mychild.sendline(myusername)
     do_expect(mychild, passwordPrompt, 10)
@@ -78,13 +79,13 @@ def do_expect(mychild, myexpect, mytimeout):
     if myexp == 0:
         pass
     elif myexp == 1:
-        print 'ERROR: EOF encountered - %s' %(host)
+        print('ERROR: EOF encountered - %s' %(host))
         sys.exit(1)
     elif myexp == 2:
-        print 'ERROR: Timeout encountered - %s' %(host)
+        print('ERROR: Timeout encountered - %s' %(host))
         sys.exit(1)
     else:
-        print 'ERROR: Unknown expect error - %s' %(host)
+        print('ERROR: Unknown expect error - %s' %(host))
         sys.exit(1)
     return True
 
@@ -116,32 +117,26 @@ for opt, arg in opts:
 if len(args) < 1:
     usage()
 
-hostregex = 'Hostname NOT NULL'
-for i in args:
-    hostregex += ' AND Hostname LIKE "%%%s%%"' %(i)
-
 try:
     cfgf = open(cfgfile, 'r')
 except IOError:
-    print 'ERROR: Unable to open cfgfile - %s' %(host)
+    print('ERROR: Unable to open cfgfile - %s' %(args))
     sys.exit(1)
 cfgf.close()
 
-config = ConfigParser.ConfigParser()
+config = configparser.ConfigParser()
 config.read(cfgfile)
 
 SQLDB = config.get('DevicesDB', 'path')
 if SQLDB == None:
-    print 'ERROR: Unable to get DB file from CFG file - %s' %(host)
+    print('ERROR: Unable to get DB file from CFG file - %s' %(args))
     sys.exit(1)
 
 db = sqlite3.connect(SQLDB)
-cursor = db.cursor()
-sqlquery = 'SELECT * FROM Devices WHERE %s ORDER BY Hostname ASC' %(hostregex)
-cursor.execute(sqlquery)
-rows = cursor.fetchall()
+# Same ranked, parameterised (and indexed, see searchindex.py) search as rcmd.py
+rows = search_rows(db, args)
 if len(rows) == 0:
-    print 'ERROR: Device does not exist in DB - %s' %(args)
+    print('ERROR: Device does not exist in DB - %s' %(args))
     sys.exit(1)
 elif len(rows) == 1:
     host = rows[0][0]    
@@ -152,7 +147,7 @@ elif len(rows) == 1:
     authid = rows[0][5]
 else:
     idx = 1
-    print '   0 QUIT'
+    print('   0 QUIT')
     for row in rows:
         host = row[0]
         ip = row[1]
@@ -168,12 +163,12 @@ else:
         HostDict['proxy'] = proxy
         HostDict['authid'] = authid
         HostList.append(HostDict.copy())
-        print "%s %s %s" %(str(idx).rjust(4), host.ljust(28), ip)
+        print("%s %s %s" %(str(idx).rjust(4), host.ljust(28), ip))
         idx += 1
-    inidx = raw_input('Enter selection (default is 1): ')
+    inidx = input('Enter selection (default is 1): ')
     isvalid = False
     if inidx == '0':
-        print 'Exiting'
+        print('Exiting')
         sys.exit(0)
     else:
         if inidx == '':
@@ -196,7 +191,7 @@ authsection = 'Auth' + str(authid)
 
 try:
     include_auth = config.get(authsection, 'include_auth')
-except ConfigParser.NoOptionError:
+except configparser.NoOptionError:
     username = config.get(authsection, 'username')
     password = config.get(authsection, 'password')
 else:
@@ -205,7 +200,7 @@ else:
 
 try:
     enable_password = config.get(authsection, 'enable_password')
-except ConfigParser.NoOptionError:
+except configparser.NoOptionError:
     enable_password = password
 
 if proxy != 0:
@@ -223,7 +218,7 @@ elif conn == 'T':
 else:
     method = 'Unknown'
 
-print '!!! Connecting to %s (%s) via %s !!!' %(host, ip, method)
+print('!!! Connecting to %s (%s) via %s !!!' %(host, ip, method))
 
 if conn == 'S':
     if proxy != 0:
@@ -236,7 +231,7 @@ elif conn == 'T':
     else:
         child = do_spawn_telnet(ip, username, password)
 else:
-    print 'ERROR: Invalid connection type - %s' %(host)
+    print('ERROR: Invalid connection type - %s' %(host))
     sys.exit(1)
 
 do_expect(child, prompt, timeout)
@@ -253,7 +248,7 @@ if logfile != '':
     try:
         fout = open(logfile, 'wb')
     except IOError:
-        print 'ERROR: Error opening logfile - %s' %(host)
+        print('ERROR: Error opening logfile - %s' %(host))
         sys.exit(1)
     child.logfile_read = fout
 
@@ -261,9 +256,9 @@ while True:
     child.interact()
     time.sleep(0.5)
     if child.isalive() == True:
-        print "\nEntering CLI (\"quit\" to quit CLI)"
+        print("\nEntering CLI (\"quit\" to quit CLI)")
         while True:
-            line = raw_input('CLI >> ')
+            line = input('CLI >> ')
             if line == 'quit':
                 break
             if line == 'a':
@@ -274,7 +269,7 @@ while True:
                 exitFlag = 1
     else:
         break
-    print "Exiting CLI"
+    print("Exiting CLI")
     child.sendline('')
 
 exitFlag = 1
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+
+# JSON lines result sink for rcmd.py (-j) - one record per (host, command) e.g.
+#
+#   {"host": "rtr1", "ip": "10.1.1.1", "command": "show clock", "start": 1700000000.12,
+#    "duration": 0.084, "status": "ok", "size": 31, "output": "..."}
+#
+# status is ok, timeout, eof or error (with the message in "error"). A record with "command": null
+# is a failure to connect/log in. Records are queued by any number of sessions and written by one
+# background thread in batches, with an fsync at most every FSYNC_INTERVAL seconds and on close.
+# If the writer thread fails (e.g. disk full) the error is raised by the next write() or close().
+
+import os
+import json
+import time
+import queue
+import threading
+from rcmdclass import RcmdError
+
+
+FSYNC_INTERVAL = 1.0
+BATCH_SIZE = 1000
+
+
+def error_status(value):
+    # Status for an RcmdError message
+    if 'Timeout' in value:
+        return 'timeout'
+    if 'EOF' in value:
+        return 'eof'
+    return 'error'
+
+
+class JsonSink(object):
+
+    def __init__(self, path, interval=FSYNC_INTERVAL, batchsize=BATCH_SIZE):
+        try:
+            self.fout = open(path, 'a')
+        except IOError:
+            raise RcmdError('ERROR: Error opening JSON output file')
+        self.interval = interval
+        self.batchsize = batchsize
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+
+    def check(self):
+        if self.error is not None:
+            raise RcmdError(f'ERROR: Error writing JSON output file - {self.error}')
+        return True
+
+
+    def write(self, record):
+        self.check()
+        self.queue.put(record)
+        return True
+
+
+    def record(self, dev, command, start, duration, status='ok', output=None, size=None, error=None):
+        record = {'host': dev.host, 'ip': dev.ip, 'command': command, 'start': round(start, 3), 'duration': round(duration, 3), 'status': status}
+        if error is not None:
+            record['error'] = error
+        if output is not None:
+            if size is None:
+                size = len(output)
+            if not isinstance(output, str):
+                output = bytes(output).decode('utf-8', 'ignore')
+            record['output'] = output
+        if size is not None:
+            record['size'] = size
+        return self.write(record)
+
+
+    def writer(self):
+        try:
+            self.write_batches()
+        except Exception as e:  # pylint: disable=broad-except
+            # Kept for write()/close() to raise - records queued after this are not written
+            self.error = e
+
+
+    def write_batches(self):
+        last_sync = time.monotonic()
+        dirty = False
+        done = False
+        while not done:
+            # Wait for the first record, or until an fsync is due
+            try:
+                records = [self.queue.get(timeout=self.interval)]
+            except queue.Empty:
+                records = []
+            while len(records) < self.batchsize:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in records:
+                done = True
+                records = records[:records.index(None)]
+            if records:
+                self.fout.write(''.join(json.dumps(record) + '\n' for record in records))
+                dirty = True
+            if dirty and (done or time.monotonic() - last_sync >= self.interval):
+                self.fout.flush()
+                os.fsync(self.fout.fileno())
+                last_sync = time.monotonic()
+                dirty = False
+
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            self.fout.close()
+        except OSError as e:
+            if self.error is None:
+                self.error = e
+        return self.check()
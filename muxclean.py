@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+
+
+import sys
+import argparse
+from rcmdclass import RcmdError, load_config, mux_cleanup
+from profiling import run_main
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='Clean up SSH ControlMaster sockets used by rcmd.py -M.')
+    parser.add_argument('-i', '--cfgfile', required=True, help='Config file.')
+    parser.add_argument('-x', '--exit', action='store_true', default=False, help='Also stop all running masters.')
+    args = parser.parse_args()
+
+    try:
+        config = load_config(args.cfgfile)
+    except RcmdError as e:
+        print(e.value)
+        sys.exit(1)
+
+    removed, stopped = mux_cleanup(config.muxdir, args.exit)
+    for path in removed:
+        print(f'Removed stale socket - {path}')
+    for path in stopped:
+        print(f'Stopped master - {path}')
+
+
+if __name__ == '__main__':
+    run_main(main)
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+
+# Compressed, content-addressed store for command output collected by rcmd.py (--store).
+#
+# Each output is split into chunks on line boundaries chosen from the content itself, so an
+# output that only differs by a few lines from an earlier one (or from another device's) shares
+# all but the changed chunks with it. Chunks are zlib compressed and kept once under
+# objects/<sha256[:2]>/<sha256[2:]>. index.db records every (host, command, timestamp) with the
+# list of chunks making up the output and the sha256 of the whole output.
+#
+# Delta mode (rcmd.py --delta) compares each new output with the previous one for the same host
+# and command by sha256, and only builds a line diff when they differ.
+
+import os
+import sys
+import time
+import math
+import zlib
+import difflib
+import sqlite3
+import hashlib
+import argparse
+import threading
+from rcmdclass import RcmdError
+from profiling import run_main
+
+
+STORE_DIR = os.environ.get('RCMD_STORE', os.path.expanduser('~/.rcmd/store'))
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 1024 * 1024
+CHUNK_MASK = 0x7f  # a line ends a chunk (once past MIN_CHUNK) when crc32(line) & CHUNK_MASK == 0
+
+
+class OutputWriter(object):
+
+    # Returned by OutputStore.writer() - takes the output a piece at a time (str or bytes, e.g. as
+    # fout for Device.do_sendline_stream), never holding more than MAX_CHUNK of it
+
+    def __init__(self, store, host, command, timestamp):
+        self.store = store
+        self.host = host
+        self.command = command
+        self.timestamp = timestamp
+        self.chunk = bytearray()
+        self.line = bytearray()
+        self.chunks = []
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self.hexdigest = None
+
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.size += len(data)
+        self.digest.update(data)
+        start = 0
+        while True:
+            idx = data.find(b'\n', start)
+            if idx < 0:
+                self.line += data[start:]
+                break
+            self.line += data[start:idx+1]
+            self.end_line()
+            start = idx + 1
+        if len(self.line) >= MAX_CHUNK:
+            self.end_line()
+        return len(data)
+
+
+    def end_line(self):
+        self.chunk += self.line
+        if len(self.chunk) >= MAX_CHUNK or (len(self.chunk) >= MIN_CHUNK and zlib.crc32(self.line) & CHUNK_MASK == 0):
+            self.chunks.append(self.store.put_chunk(self.chunk))
+            self.chunk = bytearray()
+        self.line = bytearray()
+        return True
+
+
+    def flush(self):
+        return True
+
+
+    def close(self):
+        self.chunk += self.line
+        if self.chunk:
+            self.chunks.append(self.store.put_chunk(self.chunk))
+        self.chunk = bytearray()
+        self.line = bytearray()
+        self.hexdigest = self.digest.hexdigest()
+        self.timestamp = self.store.add_record(self.host, self.command, self.timestamp, self.size, self.hexdigest, self.chunks)
+        return True
+
+
+class OutputStore(object):
+
+    def __init__(self, path=STORE_DIR):
+        self.path = path
+        self.objects = os.path.join(path, 'objects')
+        try:
+            os.makedirs(self.objects, exist_ok=True)
+            # One connection shared by all threads (fleet mode), serialised by self.lock
+            self.db = sqlite3.connect(os.path.join(path, 'index.db'), check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS Outputs (
+                Hostname  TEXT NOT NULL,
+                Command   TEXT NOT NULL,
+                Timestamp REAL NOT NULL,
+                Size      INT  NOT NULL,
+                Digest    TEXT NOT NULL,
+                Chunks    TEXT NOT NULL,
+                PRIMARY KEY (Hostname, Command, Timestamp)
+            )''')
+            self.db.commit()
+        except (OSError, sqlite3.Error) as e:
+            raise RcmdError(f'ERROR: Unable to open output store - {e}')
+        self.lock = threading.Lock()
+
+
+    def close(self):
+        self.db.close()
+        return True
+
+
+    def chunk_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+
+    def put_chunk(self, data):
+        # Returns the chunk's id - only written if no identical chunk is stored already
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}'
+            with open(tmp, 'wb') as f:
+                f.write(zlib.compress(data))
+            os.replace(tmp, path)
+        return digest
+
+
+    def get_chunk(self, digest):
+        try:
+            with open(self.chunk_path(digest), 'rb') as f:
+                return zlib.decompress(f.read())
+        except (OSError, zlib.error):
+            raise RcmdError(f'ERROR: Missing or corrupt chunk in output store - {digest}')
+
+
+    def add_record(self, host, command, timestamp, size, digest, chunks):
+        # Returns the timestamp the output was stored under - never replaces an earlier output, e.g.
+        # of the same command run twice with the same timestamp, the new one goes just after it
+        with self.lock:
+            while True:
+                try:
+                    self.db.execute('INSERT INTO Outputs VALUES (?, ?, ?, ?, ?, ?)', (host, command, timestamp, size, digest, ' '.join(chunks)))
+                    break
+                except sqlite3.IntegrityError:
+                    timestamp = math.nextafter(timestamp, math.inf)
+            self.db.commit()
+        return timestamp
+
+
+    def writer(self, host, command, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        return OutputWriter(self, host, command, timestamp)
+
+
+    def put(self, host, command, data, timestamp=None):
+        # Returns (sha256 of the output, timestamp it was stored under)
+        writer = self.writer(host, command, timestamp)
+        writer.write(data)
+        writer.close()
+        return writer.hexdigest, writer.timestamp
+
+
+    def find(self, host, command, timestamp=None):
+        # Latest record at or before timestamp - (timestamp, size, digest, chunks) or None
+        if timestamp is None:
+            timestamp = float('inf')
+        with self.lock:
+            row = self.db.execute('SELECT Timestamp, Size, Digest, Chunks FROM Outputs WHERE Hostname = ? AND Command = ? AND Timestamp <= ? ORDER BY Timestamp DESC LIMIT 1', (host, command, timestamp)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], row[2], row[3].split()
+
+
+    def previous(self, host, command, timestamp):
+        # Latest record from before timestamp (e.g. the start of this run) or None
+        return self.find(host, command, math.nextafter(timestamp, -math.inf))
+
+
+    def iter_output(self, host, command, timestamp=None):
+        # Output a chunk at a time, for writing out large outputs without holding them
+        record = self.find(host, command, timestamp)
+        if record is None:
+            raise RcmdError(f'ERROR: No output stored for {host} - {command}')
+        for digest in record[3]:
+            yield self.get_chunk(digest)
+
+
+    def get(self, host, command, timestamp=None):
+        return b''.join(self.iter_output(host, command, timestamp))
+
+
+    def compare(self, host, command, previous, digest, timestamp, data=None):
+        # Unified diff of the output stored at timestamp (or data, if given) against previous (a
+        # find() record, or None for no earlier output). None if the digests are the same.
+        if previous is not None and previous[2] == digest:
+            return None
+        if data is None:
+            data = self.get(host, command, timestamp)
+        if isinstance(data, str):
+            data = data.encode()
+        if previous is None:
+            old = b''
+            oldname = f'{host} {command} (no previous output)'
+        else:
+            old = b''.join(self.get_chunk(chunk) for chunk in previous[3])
+            oldname = f'{host} {command} {format_time(previous[0])}'
+        newname = f'{host} {command} {format_time(timestamp)}'
+        diff = difflib.unified_diff(old.decode('utf-8', 'ignore').splitlines(), data.decode('utf-8', 'ignore').splitlines(), oldname, newname, lineterm='')
+        return '\n'.join(diff)
+
+
+    def history(self, host=None, command=None):
+        # [(host, command, timestamp, size, digest)] oldest first
+        sql = 'SELECT Hostname, Command, Timestamp, Size, Digest FROM Outputs'
+        where = []
+        params = []
+        if host is not None:
+            where.append('Hostname = ?')
+            params.append(host)
+        if command is not None:
+            where.append('Command = ?')
+            params.append(command)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        with self.lock:
+            return self.db.execute(sql + ' ORDER BY Timestamp, Hostname, Command', params).fetchall()
+
+
+    def stats(self):
+        # (outputs, logical bytes, chunks, stored bytes)
+        with self.lock:
+            outputs, logical = self.db.execute('SELECT COUNT(*), COALESCE(SUM(Size), 0) FROM Outputs').fetchone()
+        chunks = 0
+        stored = 0
+        for entry in os.scandir(self.objects):
+            if entry.is_dir():
+                for blob in os.scandir(entry.path):
+                    chunks += 1
+                    stored += blob.stat().st_size
+        return outputs, logical, chunks, stored
+
+
+def parse_time(value):
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise RcmdError('ERROR: Time should be in the format YYYY-MM-DD[ HH:MM[:SS]]')
+
+
+def format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='Query the output store written by rcmd.py --store.')
+    parser.add_argument('action', choices=['list', 'get', 'stats'], help='''list - list stored outputs (filtered by -H/-C)
+get - write an output to stdout (latest, or latest at or before -t)
+stats - number of outputs and space used''')
+    parser.add_argument('-d', '--store', default=STORE_DIR, help=f'Output store directory (default {STORE_DIR}, or $RCMD_STORE)')
+    parser.add_argument('-H', '--host', default=None, help='Hostname.')
+    parser.add_argument('-C', '--command', default=None, help='Command, as it appears in the cmdfile.')
+    parser.add_argument('-t', '--time', default=None, help='get - latest output at or before this time (YYYY-MM-DD[ HH:MM[:SS]])')
+    args = parser.parse_args()
+
+    if args.action == 'get' and (args.host is None or args.command is None):
+        parser.error('get needs -H and -C')
+
+    try:
+        store = OutputStore(args.store)
+        if args.action == 'list':
+            for host, command, timestamp, size, digest in store.history(args.host, args.command):
+                print(f'{format_time(timestamp)}  {host.ljust(28)} {str(size).rjust(10)}  {digest[:12]}  {command}')
+        elif args.action == 'get':
+            timestamp = None
+            if args.time is not None:
+                timestamp = parse_time(args.time)
+            for data in store.iter_output(args.host, args.command, timestamp):
+                sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+        else:
+            outputs, logical, chunks, stored = store.stats()
+            ratio = stored / logical * 100 if logical else 0
+            print(f'{outputs} outputs, {logical} bytes - stored as {chunks} chunks, {stored} bytes ({ratio:.1f}%)')
+        store.close()
+    except RcmdError as e:
+        print(e.value)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run_main(main)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+
+# --profile PREFIX for all the entry points (rcmd.py, rcmdtool.py <subcommand>, discover.py etc.)
+# Runs the script's main() under cProfile and a stack sampler, then writes
+#
+#   PREFIX.pstats    - cProfile stats of every thread merged, timed in CPU time of each thread
+#                      (time.thread_time), for python -m pstats, snakeviz etc.
+#   PREFIX.collapsed - stacks of all threads sampled every SAMPLE_INTERVAL seconds, in collapsed
+#                      format ("thread;outer;...;inner count"), for flamegraph.pl or speedscope.
+#                      Wall clock, so time waiting on the devices shows up as well.
+#
+# and prints the functions in rcmdclass using the most CPU to stderr. Only sys is imported
+# unless --profile is given, as run_main() runs on every invocation.
+
+import sys
+
+
+SAMPLE_INTERVAL = 0.005
+TOP_FUNCTIONS = 15
+
+
+class Profiler(object):
+
+    # cProfile only sees the thread it is enabled in - each thread started while profiling
+    # (fleet mode workers, broker sessions) gets its own, merged at the end
+
+    def __init__(self):
+        import threading
+        self.profiles = []
+        self.lock = threading.Lock()
+
+
+    def new_profile(self):
+        import time
+        import cProfile
+        profile = cProfile.Profile(time.thread_time)
+        with self.lock:
+            self.profiles.append(profile)
+        return profile
+
+
+    def thread_start(self, frame, event, arg):
+        # threading.setprofile() hook - called first thing in each new thread, which then switches
+        # to a cProfile of its own
+        self.new_profile().enable()
+
+
+    def start(self):
+        import threading
+        threading.setprofile(self.thread_start)
+        self.new_profile().enable()
+        return True
+
+
+    def stop(self):
+        import threading
+        threading.setprofile(None)
+        self.profiles[0].disable()
+        return True
+
+
+    def stats(self):
+        import pstats
+        with self.lock:
+            return pstats.Stats(*self.profiles)
+
+
+class Sampler(object):
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        import threading
+        self.interval = interval
+        self.stacks = {}
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+
+    def start(self):
+        self.thread.start()
+        return True
+
+
+    def run(self):
+        import os
+        import threading
+        ident = threading.get_ident()
+        while not self.done.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if tid == ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(tid, str(tid)))
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        return True
+
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f'{stack} {count}\n')
+        return True
+
+
+def print_top(stats, fout, module='rcmdclass.py', count=TOP_FUNCTIONS):
+    # stats.stats is {(file, line, function): (primitive calls, calls, tottime, cumtime, callers)}
+    total = sum(entry[2] for entry in stats.stats.values())
+    funcs = [(key, entry) for key, entry in stats.stats.items() if key[0].endswith(module)]
+    own = sum(entry[2] for _, entry in funcs)
+    share = own / total * 100 if total else 0
+    fout.write(f'\n!!! Profile - {total:.3f}s CPU, {own:.3f}s ({share:.1f}%) in {module} itself. Top functions in {module}: !!!\n')
+    fout.write(f'{"tottime".rjust(9)} {"cumtime".rjust(9)} {"calls".rjust(9)}  function\n')
+    for (_, line, name), entry in sorted(funcs, key=lambda item: item[1][2], reverse=True)[:count]:
+        fout.write(f'{entry[2]:9.3f} {entry[3]:9.3f} {entry[1]:9d}  {name}:{line}\n')
+    return True
+
+
+def profile_prefix():
+    # Takes --profile PREFIX (or --profile=PREFIX) out of sys.argv, so the script's own option
+    # parsing never sees it. None if not given.
+    for idx, arg in enumerate(sys.argv[1:], 1):
+        if arg == '--profile':
+            if idx + 1 >= len(sys.argv):
+                print('ERROR: --profile needs a file prefix')
+                sys.exit(2)
+            prefix = sys.argv[idx + 1]
+            del sys.argv[idx:idx + 2]
+            return prefix
+        if arg.startswith('--profile='):
+            del sys.argv[idx]
+            return arg[len('--profile='):]
+    return None
+
+
+def run_main(main):
+    prefix = profile_prefix()
+    if prefix is None:
+        return main()
+
+    profiler = Profiler()
+    sampler = Sampler()
+    sampler.start()
+    profiler.start()
+    try:
+        return main()
+    finally:
+        profiler.stop()
+        sampler.stop()
+        stats = profiler.stats()
+        stats.dump_stats(f'{prefix}.pstats')
+        sampler.write(f'{prefix}.collapsed')
+        print_top(stats, sys.stderr)
+        sys.stderr.write(f'!!! Profile written to {prefix}.pstats and {prefix}.collapsed !!!\n')
@@ -3,16 +3,365 @@
 # pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
 
 
+import io
 import os
 import sys
 import re
+import time
 import argparse
-from rcmdclass import Device, RcmdError
+import threading
+from rcmdclass import Device, RcmdError, ProxyScheduler, BASE_PROMPT, load_config, resolve_devices
+from rcmdbroker import broker_request
+from outstore import OutputStore
+from jsonsink import JsonSink, error_status
+from timings import TimingPrinter, get_exporter
+from profiling import run_main
+
+
+def load_cmdfile(cmdfile):
+    try:
+        cmdf = open(cmdfile, 'r')
+    except IOError:
+        raise RcmdError('ERROR: Unable to open cmdfile')
+    cmds = [cmd.rstrip() for cmd in cmdf]
+    cmdf.close()
+    return cmds
+
+
+def load_hostfile(hostfile):
+    try:
+        hostf = open(hostfile, 'r')
+    except IOError:
+        raise RcmdError('ERROR: Unable to open hostfile')
+    hosts = []
+    for line in hostf:
+        host = line.strip()
+        # Ignore blank lines and lines starting with # or ! as comments
+        if host and not re.match('[#!]', host):
+            hosts.append(host)
+    hostf.close()
+    return hosts
+
+
+def write_log(fout, *parts):
+    # Text parts (headers etc) are encoded when the logfile is opened in binary mode (-b)
+    if fout is not None:
+        binary = not isinstance(fout, io.TextIOBase)
+        for part in parts:
+            if binary and isinstance(part, str):
+                part = part.encode()
+            fout.write(part)
+    return True
+
+
+class Tee(object):
+
+    # File-like object writing to all of files (None entries are skipped), counting what was written
+
+    def __init__(self, *files):
+        self.files = [f for f in files if f is not None]
+        self.size = 0
+
+
+    def write(self, data):
+        self.size += len(data)
+        for f in self.files:
+            f.write(data)
+        return len(data)
+
+
+def write_output(fout, line, output):
+    if fout is not None:
+        header = f'\n### {line} ###\n'
+        write_log(fout, header + '\n', output, '\n')
+        fout.flush()
+    return True
+
+
+def run_commands(dev, cmds, fout=None, debug=False, pipeline=0, stream=False, store=None, delta=False, sink=None):
+    chgprompt = False
+    # Each output is stored with the time it was saved. Delta mode compares with the output from
+    # before the run started, so a command repeated in the cmdfile is not compared with itself.
+    runstart = time.time()
+    changed = []
+    unchanged = []
+    # Bytes mode output is written to the logfile as is, without being decoded
+    getbuffer = dev.do_getbuffer_bytes if dev.binary else dev.do_getbuffer
+    # Plain commands waiting to be sent together (pipeline mode only)
+    batch = []
+    # Commands sent and not completed yet - (line, start time, start monotonic) for the JSON sink
+    inflight = []
+
+    def send(lines):
+        inflight[:] = [(line, time.time(), time.monotonic()) for line in lines]
+
+    def flush():
+        if not batch:
+            return
+        send(batch)
+        # Splitting the output needs the exact prompt - the generic prompt could match inside the output
+        if len(batch) > 1 and dev.prompt != BASE_PROMPT:
+            times = []
+            outputs = dev.do_sendline_batch(batch, pipeline, times)
+        else:
+            times = []
+            outputs = []
+            for line in batch:
+                dev.do_sendline(line)
+                outputs.append(getbuffer())
+                times.append(time.monotonic())
+        # Pipelined commands are timed from when the previous one completed
+        start = inflight[0][2]
+        for line, output, end in zip(batch, outputs, times):
+            save(line, output, inflight[0][1] + start - inflight[0][2], end - start)
+            start = end
+        del batch[:]
+        del inflight[:]
+
+    def save(line, output, start=None, duration=None):
+        if sink is not None:
+            if start is None:
+                start = inflight[0][1]
+                duration = time.monotonic() - inflight[0][2]
+            sink.record(dev, line, start, duration, output=output)
+        if delta:
+            previous = store.previous(dev.host, line, runstart)
+            digest, timestamp = store.put(dev.host, line, output)
+            report(line, store.compare(dev.host, line, previous, digest, timestamp, output))
+            return
+        write_output(fout, line, output)
+        if store is not None:
+            store.put(dev.host, line, output)
+
+    def report(line, diff):
+        # Delta mode - only commands whose output changed since the last run go to fout, as a diff
+        if diff is None:
+            unchanged.append(line)
+        else:
+            changed.append(line)
+            write_log(fout, f'\n### {line} ### CHANGED\n\n', diff, '\n')
+            if fout is not None:
+                fout.flush()
+
+    def streamed(line, size):
+        # JSON sink record for a streamed command - the output itself only went to fout/store
+        if sink is not None:
+            sink.record(dev, line, inflight[0][1], time.monotonic() - inflight[0][2], size=size)
+        del inflight[:]
+
+    try:
+        for line in cmds:
+            # Ignore lines starting with # or ! as comments
+            if re.search(r'^[^#!]', line):
+                # Asterisk (*) at the beginning of the line means the next command will change the prompt
+                if re.search(r'^[*]', line):
+                    flush()
+                    chgprompt = True
+                # @ at the beginning of the line - send with timeout while not expecting standard prompt. @,timeout,send_string,expect_string
+                elif re.search(r'^@', line):
+                    flush()
+                    match = re.search(r'^@,(\d+),(.+),(.+)', line)
+                    if match:
+                        n = match.group(1)
+                        try:
+                            waitsec = int(n)
+                        except ValueError:
+                            raise RcmdError('ERROR: Value after @ needs to be an integer')
+                        send_string = match.group(2)
+                        expect_string = match.group(3)
+                    else:
+                        raise RcmdError('ERROR: @ should be in the format :- @,timeout,send_string,expect_string')
+                    if debug:
+                        print(f'\n>>DEBUG: waitsec - {waitsec}, send_string - {send_string}, expect_string - {expect_string}\n')
+                    send([send_string])
+                    dev.do_sendline_noexpect(send_string)
+                    dev.do_expect(expect_string, waitsec)
+                    if sink is not None:
+                        sink.record(dev, send_string, inflight[0][1], time.monotonic() - inflight[0][2], output=getbuffer())
+                    del inflight[:]
+                elif chgprompt is True:
+                    send([line])
+                    dev.do_sendline_setprompt(line)
+                    chgprompt = False
+                    save(line, getbuffer())
+                    del inflight[:]
+                elif pipeline > 1:
+                    batch.append(line)
+                elif stream:
+                    send([line])
+                    # Output goes straight to fout as it arrives instead of being collected first
+                    if delta:
+                        previous = store.previous(dev.host, line, runstart)
+                        writer = store.writer(dev.host, line)
+                        dev.do_sendline_stream(line, writer)
+                        writer.close()
+                        streamed(line, writer.size)
+                        report(line, store.compare(dev.host, line, previous, writer.hexdigest, writer.timestamp))
+                        continue
+                    write_log(fout, f'\n### {line} ###\n\n')
+                    writer = None
+                    if store is not None:
+                        writer = store.writer(dev.host, line)
+                    tee = Tee(fout, writer)
+                    dev.do_sendline_stream(line, tee)
+                    if writer is not None:
+                        writer.close()
+                    streamed(line, tee.size)
+                    write_log(fout, '\n')
+                    if fout is not None:
+                        fout.flush()
+                else:
+                    send([line])
+                    dev.do_sendline(line)
+                    save(line, getbuffer())
+                    del inflight[:]
+
+        flush()
+    except RcmdError as e:
+        # Record the commands that were cut short
+        if sink is not None:
+            for line, start, mstart in inflight:
+                sink.record(dev, line, start, time.monotonic() - mstart, error_status(e.value), error=e.value)
+        raise
+
+    if delta:
+        print(f'!!! {dev.host}: {len(changed)} changed, {len(unchanged)} unchanged !!!')
+
+    return True
+
+
+def export_timings(dev, exporters):
+    if dev.timer is not None:
+        for exporter in exporters:
+            exporter.export(dev)
+    return True
+
+
+def run_host(dev, cmds, logfile=None, debug=False, timeout=45, enablemode=False, smartprompt=True, pki=False, mux=False, pipeline=0, stream=False, binary=False, store=None, delta=False, sink=None, exporters=None):
+    if dev.conn == 'S':
+        method = 'SSH'
+    elif dev.conn == 'T':
+        method = 'Telnet'
+    else:
+        method = 'Unknown'
+
+    print(f'!!! Connecting to {dev.host} ({dev.ip}) using {method} !!!')
+
+    start = time.time()
+    mstart = time.monotonic()
+    try:
+        dev.connect(debug, timeout, enablemode, smartprompt, pki, mux, binary, bool(exporters))
+        dev.do_sendline('')
+    except RcmdError as e:
+        if sink is not None:
+            sink.record(dev, None, start, time.monotonic() - mstart, error_status(e.value), error=e.value)
+        export_timings(dev, exporters)
+        raise
+
+    fout = None
+    try:
+        if logfile is not None:
+            try:
+                fout = open(logfile, 'wb' if binary else 'w')
+            except IOError:
+                raise RcmdError('ERROR: Error opening logfile')
+
+        try:
+            run_commands(dev, cmds, fout, debug, pipeline, stream, store, delta, sink)
+            trailer = f'\n!!! Completed     {dev.host} {dev.ip}) !!!'
+            write_log(fout, trailer + '\n')
+        finally:
+            if fout is not None:
+                fout.close()
+            export_timings(dev, exporters)
+        print(trailer)
+
+        dev.disconnect()
+    finally:
+        # disconnect() only sends exit - the pty is closed here too, or a fleet run keeps one open
+        # per finished host until it runs out of file descriptors
+        dev.close()
+
+    return True
+
+
+def run_host_broker(cfgfile, host, cmds, logfile=None, timeout=45, enablemode=False, smartprompt=True, pki=False, osdetect=False, pipeline=0):
+    # Run the commands on a warm session from rcmdbroker.py. Returns False if no broker is running.
+    request = {'cfgfile': os.path.abspath(cfgfile), 'host': host, 'cmds': cmds, 'timeout': timeout, 'enable': enablemode, 'smart': smartprompt, 'pki': pki, 'osdetect': osdetect, 'pipeline': pipeline}
+    response = broker_request(request)
+    if response is None:
+        return False
+    if not response['ok']:
+        raise RcmdError(response['error'])
+
+    print(f'!!! Connected to {response["host"]} ({response["ip"]}) using session broker !!!')
+
+    trailer = f'\n!!! Completed     {response["host"]} {response["ip"]}) !!!'
+    if logfile is not None:
+        try:
+            fout = open(logfile, 'w')
+        except IOError:
+            raise RcmdError('ERROR: Error opening logfile')
+        fout.write(response['output'])
+        fout.write(trailer + '\n')
+        fout.close()
+    print(trailer)
+
+    return True
+
+
+def run_fleet(devices, failed, cmds, config, logdir=None, workers=10, debug=False, timeout=45, enablemode=False, smartprompt=True, pki=False, mux=False, pipeline=0, stream=False, binary=False, store=None, delta=False, sink=None, exporters=None):
+    # Hosts that could not be resolved (see resolve_devices) count as failed
+    failed = list(failed)
+    succeeded = []
+
+    if logdir is not None:
+        os.makedirs(logdir, exist_ok=True)
+
+    # Devices are handed out round-robin across proxies, honouring each proxy's maxsessions
+    scheduler = ProxyScheduler(devices, config)
+    count = len(devices)
+    # The scheduler now holds the only reference to each Device, so a finished one can be freed
+    devices.clear()
+
+    def worker():
+        while True:
+            dev = scheduler.get()
+            if dev is None:
+                return
+            logfile = None
+            if logdir is not None:
+                logfile = os.path.join(logdir, f'{dev.host}.log')
+            try:
+                run_host(dev, cmds, logfile, debug, timeout, enablemode, smartprompt, pki, mux, pipeline, stream, binary, store, delta, sink, exporters)
+            except Exception as e:  # pylint: disable=broad-except
+                # Not just RcmdError - e.g. pexpect failing to spawn ssh must not end this worker
+                # and leave the rest of its devices unrun
+                error = e.value if isinstance(e, RcmdError) else f'ERROR: {e}'
+                print(f'{error} - {dev.host}')
+                failed.append((dev.host, error))
+                dev.close()
+            else:
+                succeeded.append(dev.host)
+            finally:
+                scheduler.done(dev)
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, count))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(f'\n!!! Summary: {len(succeeded)} succeeded, {len(failed)} failed !!!')
+    for host, error in sorted(failed):
+        print(f'FAILED {host} - {error}')
+
+    return not failed
 
 
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='Run CLI commands on remote device.')
-    parser.add_argument('host', help='Remote host to connect to.')
+    parser.add_argument('host', nargs='?', default=None, help='Remote host to connect to.')
     parser.add_argument('-c', '--cmdfile', required=True, help='Commands file.')
     parser.add_argument('-i', '--cfgfile', required=True, help='Config file.')
     parser.add_argument('-d', '--debug', action='store_true', default=False, help='Display debugs output.')
@@ -22,6 +371,20 @@ def main():
     parser.add_argument('-l', '--log', default=None, help='Logfile to send output to.')
     parser.add_argument('-t', '--timeout', default=45, help='Timeout for commands (default 45 seconds)')
     parser.add_argument('-p', '--pki', action='store_true', default=False, help='Use PKI for authentication (SSH only).')
+    parser.add_argument('-M', '--mux', action='store_true', default=False, help='Reuse SSH connections with OpenSSH ControlMaster/ControlPersist (SSH only).')
+    parser.add_argument('-P', '--pipeline', default=0, type=int, help='Send up to this many commands without waiting for the prompt in between (read-only commands only, needs smart prompt). Commands after * and @ lines are still run one at a time.')
+    parser.add_argument('-S', '--stream', action='store_true', default=False, help='Write command output to the logfile as it arrives instead of holding it in memory (for large outputs e.g. show tech-support). Does not use the session broker.')
+    parser.add_argument('-b', '--bytes', action='store_true', default=False, help='Bytes mode - handle output as raw bytes and write it to the logfile without decoding/re-encoding (less CPU per session). Does not apply to the session broker.')
+    parser.add_argument('--store', default=None, help='Also save each command output to this output store directory (see outstore.py). Does not use the session broker.')
+    parser.add_argument('--delta', action='store_true', default=False, help='Delta mode (needs --store) - only write commands whose output changed since the last stored run to the logfile, as a unified diff.')
+    parser.add_argument('-j', '--json', default=None, help='Also write one JSON line per host and command (timings, status and output) to this file. Does not use the session broker.')
+    parser.add_argument('-T', '--timings', action='store_true', default=False, help='Print a per-host breakdown of the time spent logging in (per login stage), in enable, prompt detection, device setup and the commands. Does not use the session broker.')
+    parser.add_argument('--timings-export', action='append', default=[], help='Also export the per-phase/per-command timings and byte counts - json:FILE (JSON lines) or prom:FILE (Prometheus textfile). Can be given more than once. Does not use the session broker.')
+    parser.add_argument('-f', '--hostfile', default=None, help='Fleet mode - file with list of hosts to connect to (one per line).')
+    parser.add_argument('-s', '--select', default=None, help='Fleet mode - connect to all hosts in DB matching all of the space separated terms.')
+    parser.add_argument('-w', '--workers', default=10, type=int, help='Fleet mode - number of concurrent sessions (default 10)')
+    parser.add_argument('--nobroker', action='store_true', default=False, help='Do not use a running rcmdbroker.py, always connect directly.')
+    parser.add_argument('-o', '--logdir', default=None, help='Fleet mode - directory to write per-host logfiles (<host>.log) to.')
     parser.add_argument('--custom', default=None, help='''Define a custom host entry to use. The format is hostname,IP,type,method,proxy,auth
         hostname - hostname of custom host
         IP - management IP to connect to custom host
@@ -41,110 +404,117 @@ def main():
     logfile = args.log
     timeout = int(args.timeout)
     pki = args.pki
+    mux = args.mux
+    hostfile = args.hostfile
+    select = args.select
+    workers = args.workers
+    logdir = args.logdir
+    nobroker = args.nobroker
+    pipeline = args.pipeline
+    stream = args.stream
+    binary = args.bytes
+    storedir = args.store
+    delta = args.delta
+    jsonfile = args.json
+    timings = args.timings
+    exports = args.timings_export
 
-    chgprompt = False
+    if stream and pipeline > 1:
+        parser.error('--stream cannot be used with --pipeline')
+    if delta and storedir is None:
+        parser.error('--delta needs --store')
 
-    if re.match('[#!]', host):
-        print(f'Skipping - {host}')
-        sys.exit(1)
+    fleet = hostfile is not None or select is not None
 
-    try:
-        cmdf = open(cmdfile, 'r')
-    except IOError:
-        print(f'ERROR: Unable to open cmdfile - {host}')
+    if fleet:
+        if host is not None or customhost is not None:
+            parser.error('host/--custom cannot be used with --hostfile/--select')
+        if workers < 1:
+            parser.error('--workers must be at least 1')
+    elif host is None and customhost is None:
+        parser.error('host is required unless --custom, --hostfile or --select is used')
+    elif host is None:
+        host = customhost
+
+    if not fleet and re.match('[#!]', host):
+        print(f'Skipping - {host}')
         sys.exit(1)
 
     try:
-        if customhost is not None:
-            host = customhost
-            dev = Device(cfgfile=cfgfile, customhost=customhost, osdetect=osdetect)
-        else:
-            dev = Device(cfgfile=cfgfile, host=host, osdetect=osdetect)
+        cmds = load_cmdfile(cmdfile)
     except RcmdError as e:
         print(f'{e.value} - {host}')
         sys.exit(1)
 
-    if dev.conn == 'S':
-        method = 'SSH'
-    elif dev.conn == 'T':
-        method = 'Telnet'
-    else:
-        method = 'Unknown'
-
-    print(f'!!! Connecting to {dev.host} ({dev.ip}) using {method} !!!')
-
     os.environ['TERM'] = 'vt100'
 
+    store = None
+    sink = None
+    exporters = []
     try:
-        dev.connect(debug, timeout, enablemode, smartprompt, pki)
+        if storedir is not None:
+            store = OutputStore(storedir)
+        if jsonfile is not None:
+            sink = JsonSink(jsonfile)
+        if timings:
+            exporters.append(TimingPrinter())
+        for spec in exports:
+            exporters.append(get_exporter(spec))
     except RcmdError as e:
-        print(f'{e.value} - {dev.host}')
+        print(e.value)
         sys.exit(1)
 
+    # The JSON sink and timing exporters write on close - make sure they are closed on every exit
     try:
-        dev.do_sendline('')
-    except RcmdError as e:
-        print(f'{e.value} - {dev.host}')
-        sys.exit(1)
+        if fleet:
+            try:
+                hosts = None
+                if hostfile is not None:
+                    hosts = load_hostfile(hostfile)
+                # One config parse and one DB query for the whole fleet
+                config = load_config(cfgfile)
+                devices, failed = resolve_devices(hosts=hosts, hostregex=select, osdetect=osdetect, config=config)
+            except RcmdError as e:
+                print(e.value)
+                sys.exit(1)
+            if not run_fleet(devices, failed, cmds, config, logdir, workers, debug, timeout, enablemode, smartprompt, pki, mux, pipeline, stream, binary, store, delta, sink, exporters):
+                sys.exit(1)
+            return
 
-    if logfile is not None:
-        try:
-            fout = open(logfile, 'w')
-        except IOError:
-            print(f'ERROR: Error opening logfile - {host}')
-            sys.exit(1)
+        # Use an already logged in session from the session broker when one is running
+        if customhost is None and not debug and not nobroker and not stream and store is None and sink is None and not exporters:
+            try:
+                if run_host_broker(cfgfile, host, cmds, logfile, timeout, enablemode, smartprompt, pki, osdetect, pipeline):
+                    return
+            except RcmdError as e:
+                print(f'{e.value} - {host}')
+                sys.exit(1)
 
-    for cmd in cmdf:
-        line = cmd.rstrip()
-        # Ignore lines starting with # or ! as comments
-        if re.search(r'^[^#!]', line):
-            # Asterisk (*) at the beginning of the line means the next command will change the prompt
-            if re.search(r'^[*]', line):
-                chgprompt = True
-            # @ at the beginning of the line - send with timeout while not expecting standard prompt. @,timeout,send_string,expect_string
-            elif re.search(r'^@', line):
-                match = re.search(r'^@,(\d+),(.+),(.+)', line)
-                if match:
-                    n = match.group(1)
-                    try:
-                        waitsec = int(n)
-                    except ValueError:
-                        print('ERROR: Value after @ needs to be an integer')
-                        sys.exit(1)
-                    send_string = match.group(2)
-                    expect_string = match.group(3)
-                else:
-                    print('ERROR: @ should be in the format :- @,timeout,send_string,expect_string')
-                    sys.exit(1)
-                if debug:
-                    print(f'\n>>DEBUG: waitsec - {waitsec}, send_string - {send_string}, expect_string - {expect_string}\n')
-                dev.do_sendline_noexpect(send_string)
-                dev.do_expect(expect_string, waitsec)
+        try:
+            if customhost is not None:
+                dev = Device(cfgfile=cfgfile, customhost=customhost, osdetect=osdetect)
             else:
-                try:
-                    if chgprompt is True:
-                        dev.do_sendline_setprompt(line)
-                        chgprompt = False
-                    else:
-                        dev.do_sendline(line)
-                except RcmdError as e:
-                    print(f'{e.value} - {dev.host}')
-                    sys.exit(1)
-                header = f'\n### {line} ###\n'
-                output = dev.do_getbuffer()
-                if logfile is not None:
-                    fout.write(header + '\n')
-                    fout.write(output + '\n')
-                    fout.flush()
-
-    trailer = f'\n!!! Completed     {dev.host} {dev.ip}) !!!'
-    if logfile is not None:
-        fout.write(trailer + '\n')
-        fout.close()
-    print(trailer)
+                dev = Device(cfgfile=cfgfile, host=host, osdetect=osdetect)
+        except RcmdError as e:
+            print(f'{e.value} - {host}')
+            sys.exit(1)
 
-    dev.disconnect()
+        try:
+            run_host(dev, cmds, logfile, debug, timeout, enablemode, smartprompt, pki, mux, pipeline, stream, binary, store, delta, sink, exporters)
+        except RcmdError as e:
+            print(f'{e.value} - {dev.host}')
+            sys.exit(1)
+    finally:
+        failed = False
+        for output in ([] if sink is None else [sink]) + exporters:
+            try:
+                output.close()
+            except RcmdError as e:
+                print(e.value)
+                failed = True
+        if failed:
+            sys.exit(1)
 
 
 if __name__ == '__main__':
-    main()
+    run_main(main)
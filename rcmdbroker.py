@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+
+# Session broker - keeps logged in Device sessions warm and runs command batches on them for
+# clients (rcmd.py) over a Unix socket, so repeat runs against the same device skip the login.
+#
+# Protocol is one JSON request line per connection, answered with one JSON response:
+#   request  - {"cfgfile": ..., "host": ..., "cmds": [...], "timeout": 45, "enable": false, "smart": true, "pki": false, "osdetect": false, "pipeline": 0}
+#   response - {"ok": true, "host": ..., "ip": ..., "conn": ..., "output": ..., "reused": true} or {"ok": false, "error": ...}
+
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import threading
+import collections
+from rcmdclass import Device, RcmdError, load_config, get_inventory
+from profiling import run_main
+
+
+BROKER_SOCKET = os.environ.get('RCMD_BROKER', os.path.expanduser('~/.rcmd/broker.sock'))
+MAX_SESSIONS = 100
+IDLE_TIMEOUT = 300
+KEEPALIVE = 60
+BROKER_MARGIN = 10  # seconds on top of the request's own timeouts before a client gives up on the broker
+
+
+class Session(object):
+
+    def __init__(self, key):
+        self.key = key
+        self.dev = None
+        self.lock = threading.Lock()
+        self.closed = False
+        self.last_used = time.monotonic()
+        self.last_activity = self.last_used
+
+
+class SessionBroker(object):
+
+    def __init__(self, maxsessions=MAX_SESSIONS, idletimeout=IDLE_TIMEOUT, keepalive=KEEPALIVE, debug=False):
+        self.maxsessions = maxsessions
+        self.idletimeout = idletimeout
+        self.keepalive = keepalive
+        self.debug = debug
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def log(self, msg):
+        if self.debug:
+            print(f'DEBUG> {msg}')
+
+
+    def checkout(self, request):
+        # Returns (session, reused) with session.lock held and a connected Device in session.dev
+        key = (os.path.abspath(request['cfgfile']), request['host'].lower(), request.get('enable', False), request.get('smart', True), request.get('pki', False), request.get('osdetect', False))
+        while True:
+            with self.lock:
+                session = self.sessions.get(key)
+                if session is None:
+                    session = Session(key)
+                    self.sessions[key] = session
+                self.sessions.move_to_end(key)
+            session.lock.acquire()
+            # The session may have been closed (idle/evicted/failed) while we waited for it
+            if not session.closed:
+                break
+            session.lock.release()
+
+        self.evict()
+
+        reused = session.dev is not None
+        if not reused:
+            dev = None
+            try:
+                # The broker looks up many hosts over its life - keep a snapshot of the Devices table
+                config = load_config(request['cfgfile'])
+                if config.dbpath is not None:
+                    get_inventory(config.dbpath)
+                dev = Device(config=config, host=request['host'], osdetect=request.get('osdetect', False))
+                dev.connect(False, request.get('timeout', 45), request.get('enable', False), request.get('smart', True), request.get('pki', False))
+                dev.do_sendline('')
+            except BaseException:
+                # Not just RcmdError (e.g. pexpect failing to spawn) - the session must not stay
+                # registered with its lock held, or every later request for it would block
+                if dev is not None:
+                    dev.close()
+                self.close(session)
+                session.lock.release()
+                raise
+            session.dev = dev
+            self.log(f'Connected {dev.host}')
+        session.dev.timeout = request.get('timeout', 45)
+        session.last_used = time.monotonic()
+        return session, reused
+
+
+    def close(self, session):
+        # Caller must hold session.lock
+        session.closed = True
+        with self.lock:
+            if self.sessions.get(session.key) is session:
+                del self.sessions[session.key]
+        if session.dev is not None:
+            self.log(f'Closing {session.dev.host}')
+            try:
+                session.dev.disconnect()
+                session.dev.child.close(force=True)
+            except Exception:  # pylint: disable=broad-except
+                pass
+            session.dev = None
+        return True
+
+
+    def evict(self):
+        # Close least recently used idle sessions beyond maxsessions
+        with self.lock:
+            excess = len(self.sessions) - self.maxsessions
+            candidates = list(self.sessions.values())
+        for session in candidates:
+            if excess <= 0:
+                break
+            if session.lock.acquire(blocking=False):
+                self.close(session)
+                session.lock.release()
+                excess -= 1
+        return True
+
+
+    def run(self, request):
+        from rcmd import run_commands
+        import io
+
+        cmds = request['cmds']
+        session, reused = self.checkout(request)
+        dev = session.dev
+        fout = io.StringIO()
+        try:
+            run_commands(dev, cmds, fout, pipeline=request.get('pipeline', 0))
+        except Exception:
+            self.close(session)
+            raise
+        finally:
+            session.last_used = time.monotonic()
+            session.last_activity = session.last_used
+            # Prompt changing (*) and raw (@) commands can leave the session in another mode
+            # (e.g. config mode), so don't hand it to the next client
+            if not session.closed and any(line.startswith(('*', '@')) for line in cmds):
+                self.close(session)
+            session.lock.release()
+
+        return {'ok': True, 'host': dev.host, 'ip': dev.ip, 'conn': dev.conn, 'output': fout.getvalue(), 'reused': reused}
+
+
+    def housekeeping(self):
+        # Runs forever - closes idle sessions and keeps the others alive
+        while True:
+            time.sleep(min(self.keepalive, self.idletimeout, 10))
+            with self.lock:
+                sessions = list(self.sessions.values())
+            now = time.monotonic()
+            for session in sessions:
+                if not session.lock.acquire(blocking=False):
+                    continue
+                try:
+                    if session.closed or session.dev is None:
+                        continue
+                    if now - session.last_used > self.idletimeout:
+                        self.close(session)
+                    elif now - session.last_activity > self.keepalive:
+                        try:
+                            session.dev.do_sendline('')
+                            session.last_activity = time.monotonic()
+                        except RcmdError:
+                            self.close(session)
+                finally:
+                    session.lock.release()
+
+
+    def serve(self, path):
+        import socketserver
+
+        broker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline())
+                    response = broker.run(request)
+                except RcmdError as e:
+                    response = {'ok': False, 'error': e.value}
+                except (ValueError, KeyError, TypeError) as e:
+                    response = {'ok': False, 'error': f'ERROR: Invalid broker request - {e}'}
+                except Exception as e:  # pylint: disable=broad-except
+                    response = {'ok': False, 'error': f'ERROR: {e}'}
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        if os.path.exists(path):
+            os.unlink(path)
+        # Socket is only usable by the owner - sessions are logged in with the owner's credentials
+        oldmask = os.umask(0o077)
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        os.umask(oldmask)
+        server.daemon_threads = True
+
+        threading.Thread(target=self.housekeeping, daemon=True).start()
+        print(f'!!! Session broker listening on {path} !!!')
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(path)
+
+
+def broker_request(request, path=BROKER_SOCKET):
+    # Client side - returns the response dict, or None if no broker is running at path
+    if not os.path.exists(path):
+        return None
+    # A hung broker (or one stuck behind another client on the same session) should not hang the
+    # client - wait no longer than the login plus every command taking its full timeout
+    limit = request.get('timeout', 45) * (len(request.get('cmds', [])) + 1) + BROKER_MARGIN
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(limit)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    with sock:
+        try:
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            with sock.makefile('rb') as f:
+                data = f.readline()
+        except socket.timeout:
+            print(f'!!! No response from session broker in {limit}s - connecting directly !!!')
+            return None
+        except OSError:
+            return None
+    if not data:
+        return None
+    return json.loads(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='Keep device sessions logged in and run command batches on them for rcmd.py.')
+    parser.add_argument('-s', '--socket', default=BROKER_SOCKET, help=f'Unix socket to listen on (default {BROKER_SOCKET}, or $RCMD_BROKER)')
+    parser.add_argument('-m', '--maxsessions', default=MAX_SESSIONS, type=int, help=f'Maximum number of sessions to keep (default {MAX_SESSIONS})')
+    parser.add_argument('-I', '--idle', default=IDLE_TIMEOUT, type=int, help=f'Close sessions idle for this many seconds (default {IDLE_TIMEOUT})')
+    parser.add_argument('-k', '--keepalive', default=KEEPALIVE, type=int, help=f'Send keepalive on idle sessions every this many seconds (default {KEEPALIVE})')
+    parser.add_argument('-d', '--debug', action='store_true', default=False, help='Display debugs output.')
+    args = parser.parse_args()
+
+    os.environ['TERM'] = 'vt100'
+
+    broker = SessionBroker(args.maxsessions, args.idle, args.keepalive, args.debug)
+    try:
+        broker.serve(args.socket)
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    run_main(main)
@@ -2,24 +2,65 @@
 
 # pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
 
+import os
 import sys
 import time
 import re
+import threading
+import collections
 import configparser
 import sqlite3
-import pexpect
+import socket
+
+# pexpect is imported by the Device methods that talk to the device, so that the DB/config only
+# tools (check-ip, dumpinfo, ...) do not pay for importing it
 
 
 SSH = '/usr/bin/ssh'
 TELNET = '/usr/bin/telnet'
 SOCAT = '/usr/bin/socat'
 BASE_PROMPT = r'[\r\n]([\w\d\-\+\@\/\.\(\)\~\:\/\[\]]+[#>%\$]|[#>%\$])'  # Issue with prompt with spaces (e.g. F5).. allowing space will break others...
+# BASE_PROMPT for the end of the login - a bare % straight after a newline is the start of e.g. "% Login invalid"
+LOGIN_PROMPT = r'[\r\n]([\w\d\-\+\@\/\.\(\)\~\:\/\[\]]+[#>%\$]|[#>\$])'
 HOST_PROMPT = r'(.*)[#>%\$]'
 PROMPT_CHAR = r'[#>%\$]'
 PASSWORD_PROMPT = '[Pp]assword:'
+USERNAME_PROMPT = r'(sername|(?<!ast l)ogin):'  # not the "Last login:" banner
+HOSTKEY_PROMPT = r'continue connecting \(yes/no[^)]*\)\?'
+LOGIN_FAILED = r'(Permission denied|[Aa]uthentication failed|Login incorrect|Login invalid|Access denied|Bad secrets?|Invalid password)'
+ENABLE_PROMPT = r'[\r\n][^\r\n%]*#'
 MAXREAD = 4000 * 1024
 LOGINTIMEOUT = 30
+MUX_DIR = '~/.rcmd/mux'
+MUX_PERSIST = 600
+PROMPT_OVERLAP = 1024  # characters of already searched output searched again with each read - longer than any prompt
+STREAM_CHUNK = 64 * 1024
+STREAM_TAIL = 4096  # characters of streamed output held back so a prompt split across reads is still found
 MORE_PROMPTS = r'[Mm]ore( \d+\%\)---|\)---|--| --->)'
+FINGERPRINT_TTL = 7 * 24 * 3600  # seconds a learned dtype/prompt is trusted for before being learned again
+
+# Terminal setup sent after login for each device type - ('sendline', cmd) waits for the prompt, ('send', chars) does not
+INIT_COMMANDS = {
+    'J': [('sendline', 'set cli screen-length 0'), ('sendline', 'set cli screen-width 0'), ('send', chr(0x1b)), ('send', 'q'), ('sendline', '')],
+    'A': [('sendline', 'terminal length 0'), ('sendline', 'terminal width 32767')],
+    'C': [('sendline', 'terminal length 0'), ('sendline', 'terminal width 0')],
+    'N': [('sendline', 'terminal length 0'), ('sendline', 'terminal width 511')],
+    'E': [('sendline', 'terminal length 0'), ('sendline', 'terminal width 511')],
+    'F': [('sendline', 'terminal pager 0')],
+    'L': [],
+    'T': [],
+    'P': [('sendline', 'set cli pager off'), ('sendline', 'set cli terminal width 500'), ('sendline', 'set cli scripting-mode on'), ('sendline', 'set cli confirmation-prompt off')],
+}
+
+# 'show version' patterns used by OS autodetect, checked in order
+OS_SIGNATURES = [
+    (r'\nJUNOS ', 'J', 'Juniper JunOS'),
+    (r'Arista', 'A', 'Arista EOS'),
+    (r'(Cisco IOS|\ncisco )', 'C', 'Cisco IOS'),
+    (r'Cisco Nexus', 'N', 'Cisco NX-OS'),
+    (r'Cisco Application Control', 'E', 'Cisco ACE'),
+    (r'\n(Cisco Adaptive Security|FWSM)', 'F', 'Cisco ASA/FWSM'),
+]
 
 
 class RcmdError(Exception):
@@ -28,9 +69,646 @@ class RcmdError(Exception):
         self.value = value
 
 
+Fingerprint = collections.namedtuple('Fingerprint', ['dtype', 'prompt', 'paging', 'learned', 'lastseen'])
+AuthRecord = collections.namedtuple('AuthRecord', ['username', 'password', 'enable_password'])
+ProxyRecord = collections.namedtuple('ProxyRecord', ['server', 'port', 'sshconfig', 'maxsessions'])
+
+
+class RcmdConfig(object):
+
+    # Parsed and resolved cfgfile - [AuthN] sections (with include_auth followed) and [ProxyN]
+    # sections are resolved once into AuthRecord/ProxyRecord tuples. Treat as read-only, a changed
+    # cfgfile gives a new RcmdConfig from load_config() rather than modifying an existing one.
+
+    def __init__(self, cfgfile, stamp=None):
+        self.cfgfile = cfgfile
+        self.stamp = stamp
+        self.auths = {}
+        self.proxies = {}
+        self.errors = {}
+
+        parser = configparser.ConfigParser()
+        parser.read(cfgfile)
+
+        try:
+            self.dbpath = parser.get('DevicesDB', 'path')
+        except configparser.Error:
+            self.dbpath = None
+
+        # Optional [SSHMux] section for OpenSSH connection multiplexing (connect(mux=True))
+        self.muxdir = os.path.expanduser(parser.get('SSHMux', 'path', fallback=MUX_DIR))
+        self.muxpersist = parser.get('SSHMux', 'persist', fallback=str(MUX_PERSIST))
+
+        # Optional [SSH] section - accept_new_hostkeys = yes answers yes when ssh asks about an
+        # unknown host key. Off by default, an unknown host key is a login failure.
+        try:
+            self.acceptkeys = parser.getboolean('SSH', 'accept_new_hostkeys', fallback=False)
+        except ValueError:
+            self.acceptkeys = False
+
+        # Optional [Fingerprints] section for the cache of what connect() learns about each device
+        # (default next to the Devices DB, e.g. devices.db -> devices.fingerprints.db). ttl = 0 turns it off.
+        self.fppath = parser.get('Fingerprints', 'path', fallback=None)
+        if self.fppath is None and self.dbpath is not None:
+            root, ext = os.path.splitext(self.dbpath)
+            self.fppath = f'{root}.fingerprints{ext or ".db"}'
+        try:
+            self.fpttl = parser.getint('Fingerprints', 'ttl', fallback=FINGERPRINT_TTL)
+        except ValueError:
+            self.fpttl = FINGERPRINT_TTL
+
+        for section in parser.sections():
+            m = re.match(r'(Auth|Proxy)(\d+)$', section)
+            if m is None:
+                continue
+            try:
+                if m.group(1) == 'Auth':
+                    self.auths[int(m.group(2))] = self.resolve_auth(parser, section)
+                else:
+                    maxsessions = parser.getint(section, 'maxsessions', fallback=None)
+                    # 0 or less would never let a session through the proxy - fleet runs would hang
+                    if maxsessions is not None and maxsessions < 1:
+                        raise ValueError(f'maxsessions must be at least 1 (got {maxsessions})')
+                    self.proxies[int(m.group(2))] = ProxyRecord(parser.get(section, 'server'), parser.get(section, 'port'), parser.get(section, 'sshconfig'), maxsessions)
+            except (configparser.Error, ValueError) as e:
+                self.errors[section] = str(e)
+
+
+    def resolve_auth(self, parser, section):
+        # Follow include_auth through any number of sections for the username/password
+        chain = [section]
+        current = section
+        while parser.has_option(current, 'include_auth'):
+            current = parser.get(current, 'include_auth')
+            if current in chain:
+                raise configparser.Error(f'include_auth loop in {section}')
+            chain.append(current)
+        username = parser.get(current, 'username')
+        password = parser.get(current, 'password')
+        enable_password = parser.get(section, 'enable_password', fallback=password)
+        return AuthRecord(username, password, enable_password)
+
+
+    def get_auth(self, authid):
+        if authid not in self.auths:
+            section = f'Auth{authid}'
+            raise RcmdError(f'ERROR: Invalid {section} section in cfgfile - {self.errors.get(section, "section not found")}')
+        return self.auths[authid]
+
+
+    def get_proxy(self, proxyid):
+        if proxyid not in self.proxies:
+            section = f'Proxy{proxyid}'
+            raise RcmdError(f'ERROR: Invalid {section} section in cfgfile - {self.errors.get(section, "section not found")}')
+        return self.proxies[proxyid]
+
+
+CONFIGS = {}
+CONFIGS_LOCK = threading.Lock()
+
+
+def load_config(cfgfile):
+    # Shared RcmdConfig per cfgfile, re-read only when the file changes
+    if cfgfile is None:
+        raise RcmdError('ERROR: No cfgfile specified')
+
+    try:
+        st = os.stat(cfgfile)
+        cfgf = open(cfgfile, 'r')
+    except (IOError, OSError):
+        raise RcmdError('ERROR: Unable to open cfgfile')
+    cfgf.close()
+
+    path = os.path.abspath(cfgfile)
+    stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+    with CONFIGS_LOCK:
+        config = CONFIGS.get(path)
+        if config is None or config.stamp != stamp:
+            config = RcmdConfig(cfgfile, stamp)
+            CONFIGS[path] = config
+
+    return config
+
+
+class Inventory(object):
+
+    # In-memory snapshot of the Devices table, indexed by hostname (case insensitive) and MgmtIP.
+    # The DB file (and its WAL file) is stat()ed on every lookup and the snapshot reloaded when it changes.
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.rows = ()
+        self.byhost = {}
+        self.byip = {}
+        self.lock = threading.Lock()
+
+
+    def get_stamp(self):
+        return db_stamp(self.path)
+
+
+    def refresh(self):
+        stamp = self.get_stamp()
+        if stamp == self.stamp:
+            return False
+        with self.lock:
+            # Another thread may have already reloaded while we waited for the lock
+            if stamp == self.stamp:
+                return False
+            try:
+                db = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+                rows = tuple(db.execute('SELECT * FROM Devices').fetchall())
+                db.close()
+            except sqlite3.Error:
+                raise RcmdError('ERROR: Unable to read Devices table from DB')
+            byhost = {}
+            byip = {}
+            for row in rows:
+                byhost.setdefault(row[0].lower(), row)
+                byip.setdefault(row[1], row)
+            self.rows, self.byhost, self.byip = rows, byhost, byip
+            self.stamp = stamp
+        return True
+
+
+    def get_host(self, host):
+        self.refresh()
+        return self.byhost.get(host.lower())
+
+
+    def get_ip(self, ip):
+        self.refresh()
+        return self.byip.get(ip)
+
+
+    def get_rows(self):
+        self.refresh()
+        return self.rows
+
+
+def mux_alive(path):
+    # True if an ssh master is listening on the control socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def mux_cleanup(muxdir, stop=False):
+    # Remove control sockets left behind by dead masters, and with stop=True ask the live
+    # masters to exit. Returns (removed, stopped) lists of socket paths.
+    import subprocess
+    removed = []
+    stopped = []
+    if not os.path.isdir(muxdir):
+        return removed, stopped
+    for name in sorted(os.listdir(muxdir)):
+        path = os.path.join(muxdir, name)
+        if mux_alive(path):
+            if stop:
+                subprocess.run([SSH, '-S', path, '-O', 'exit', 'mux'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+                stopped.append(path)
+        else:
+            os.unlink(path)
+            removed.append(path)
+    return removed, stopped
+
+
+class ProxyScheduler(object):
+
+    # Hands out devices to fleet worker threads, one queue per proxy ID. Proxies are served
+    # round-robin and a proxy with maxsessions set in its [ProxyN] section never has more than
+    # that many devices in flight, so one slow or small proxy does not hold up the others.
+
+    def __init__(self, devices, config):
+        self.queues = collections.OrderedDict()
+        for dev in devices:
+            self.queues.setdefault(dev.proxy, collections.deque()).append(dev)
+        self.limits = {}
+        for proxy in self.queues:
+            if proxy in config.proxies:
+                self.limits[proxy] = config.proxies[proxy].maxsessions
+            else:
+                self.limits[proxy] = None
+        self.inflight = dict.fromkeys(self.queues, 0)
+        self.order = collections.deque(self.queues)
+        self.cond = threading.Condition()
+
+
+    def get(self):
+        # Next device to run, blocking while every proxy with work left is at its limit.
+        # Returns None once all devices have been handed out.
+        with self.cond:
+            while True:
+                if not any(self.queues.values()):
+                    return None
+                for _ in range(len(self.order)):
+                    proxy = self.order[0]
+                    self.order.rotate(-1)
+                    limit = self.limits[proxy]
+                    if self.queues[proxy] and (limit is None or self.inflight[proxy] < limit):
+                        self.inflight[proxy] += 1
+                        return self.queues[proxy].popleft()
+                self.cond.wait()
+
+
+    def done(self, dev):
+        with self.cond:
+            self.inflight[dev.proxy] -= 1
+            self.cond.notify_all()
+
+
+INVENTORIES = {}
+INVENTORIES_LOCK = threading.Lock()
+
+
+def get_inventory(path):
+    # One shared Inventory per DB file for the whole process
+    path = os.path.abspath(path)
+    with INVENTORIES_LOCK:
+        if path not in INVENTORIES:
+            INVENTORIES[path] = Inventory(path)
+        return INVENTORIES[path]
+
+
+def lookup_host(path, host):
+    # Devices row for host, or None. Served from the inventory snapshot if a batch or long running
+    # caller (resolve_devices, the session broker, audit) has loaded one with get_inventory() -
+    # otherwise a single query, as loading the whole table costs far more than one lookup.
+    with INVENTORIES_LOCK:
+        inventory = INVENTORIES.get(os.path.abspath(path))
+    if inventory is not None:
+        return inventory.get_host(host)
+    try:
+        db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        row = db.execute('''SELECT * FROM Devices WHERE Hostname = ? COLLATE NOCASE LIMIT 1''', (host,)).fetchone()
+        db.close()
+    except sqlite3.Error:
+        raise RcmdError('ERROR: Unable to read Devices table from DB')
+    return row
+
+
+class FingerprintCache(object):
+
+    # What connect() learns about each device - the dtype found by os_detect, the prompt regex
+    # found by do_set_prompt and whether show version was paged - kept in an SQLite DB so later
+    # connects can skip those round trips. Entries learned more than ttl seconds ago are ignored.
+    # Best effort - a DB error (e.g. read-only directory) just means no fingerprint.
+
+    def __init__(self, path, ttl=FINGERPRINT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.db = None
+        self.lock = threading.Lock()
+
+
+    def open(self):
+        if self.db is None:
+            db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''CREATE TABLE IF NOT EXISTS Fingerprints (
+                Hostname TEXT NOT NULL,
+                MgmtIP   TEXT NOT NULL,
+                Username TEXT NOT NULL,
+                DType    TEXT,
+                Prompt   TEXT,
+                Paging   INT,
+                Learned  REAL NOT NULL,
+                LastSeen REAL NOT NULL,
+                PRIMARY KEY (Hostname, MgmtIP, Username)
+            )''')
+            db.commit()
+            self.db = db
+        return self.db
+
+
+    def get(self, host, ip, username):
+        try:
+            with self.lock:
+                row = self.open().execute('SELECT DType, Prompt, Paging, Learned, LastSeen FROM Fingerprints WHERE Hostname = ? AND MgmtIP = ? AND Username = ?', (host.lower(), ip, username)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None or time.time() - row[3] > self.ttl:
+            return None
+        return Fingerprint(row[0], row[1], None if row[2] is None else bool(row[2]), row[3], row[4])
+
+
+    def drop(self, host, ip, username):
+        try:
+            with self.lock:
+                db = self.open()
+                db.execute('DELETE FROM Fingerprints WHERE Hostname = ? AND MgmtIP = ? AND Username = ?', (host.lower(), ip, username))
+                db.commit()
+        except sqlite3.Error:
+            return False
+        return True
+
+
+    def put(self, host, ip, username, fingerprint):
+        try:
+            with self.lock:
+                db = self.open()
+                db.execute('INSERT OR REPLACE INTO Fingerprints VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (host.lower(), ip, username) + tuple(fingerprint))
+                db.commit()
+        except sqlite3.Error:
+            return False
+        return True
+
+
+FINGERPRINTS = {}
+FINGERPRINTS_LOCK = threading.Lock()
+
+
+def get_fingerprints(path, ttl=FINGERPRINT_TTL):
+    # One shared FingerprintCache per file for the whole process
+    path = os.path.abspath(path)
+    with FINGERPRINTS_LOCK:
+        if path not in FINGERPRINTS:
+            FINGERPRINTS[path] = FingerprintCache(path, ttl)
+        return FINGERPRINTS[path]
+
+
+def db_stamp(path):
+    # Changes whenever the DB file (or its WAL file) is written to
+    stamp = []
+    for name in (path, path + '-wal'):
+        try:
+            st = os.stat(name)
+        except OSError:
+            if name == path:
+                raise RcmdError('ERROR: Unable to open DB file')
+            continue
+        stamp.append((st.st_ino, st.st_size, st.st_mtime_ns))
+    return tuple(stamp)
+
+
+def search_index_path(dbpath):
+    # Sidecar DB holding the hostname search index, e.g. devices.db -> devices.search.db
+    root, ext = os.path.splitext(dbpath)
+    return f'{root}.search{ext or ".db"}'
+
+
+def build_search_index(dbpath):
+    # (Re)builds the FTS5 trigram index of Devices.Hostname in the sidecar DB, keyed by Devices
+    # rowid and stamped with the Devices DB it was built from. The Devices DB itself is only read,
+    # so tools with an SQLite lacking FTS5/trigram can still edit it. Built in a temporary file and
+    # renamed, so searches running at the same time see the old or the new index, never half of one.
+    indexpath = search_index_path(dbpath)
+    tmp = f'{indexpath}.{os.getpid()}.tmp'
+    try:
+        stamp = repr(db_stamp(dbpath))
+        db = sqlite3.connect(f'file:{dbpath}?mode=ro', uri=True)
+        rows = db.execute('SELECT rowid, Hostname FROM Devices').fetchall()
+        db.close()
+        index = sqlite3.connect(tmp)
+        index.execute("CREATE VIRTUAL TABLE DevicesSearch USING fts5(Hostname, tokenize='trigram')")
+        index.executemany('INSERT INTO DevicesSearch(rowid, Hostname) VALUES (?, ?)', rows)
+        index.execute('CREATE TABLE Stamp (Stamp TEXT)')
+        index.execute('INSERT INTO Stamp VALUES (?)', (stamp,))
+        index.commit()
+        index.close()
+        os.replace(tmp, indexpath)
+    except (sqlite3.Error, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise RcmdError('ERROR: Unable to build search index')
+    return indexpath
+
+
+SEARCH_INDEXES = {}
+
+
+def search_index(db):
+    # Path of the search index for db's Devices DB, rebuilt first if Devices has changed since it
+    # was built. None if there is no index - it is opt-in, made by searchindex.py - or it cannot
+    # be used (SQLite older than 3.34, unwritable directory, ...).
+    dbpath = db.execute('PRAGMA database_list').fetchone()[2]
+    if not dbpath:
+        return None
+    indexpath = search_index_path(dbpath)
+    try:
+        stamps = (db_stamp(dbpath), db_stamp(indexpath))
+    except RcmdError:
+        return None
+    # Already checked in this process and neither file has changed since
+    if SEARCH_INDEXES.get(indexpath) == stamps:
+        return indexpath
+    try:
+        index = sqlite3.connect(f'file:{indexpath}?mode=ro', uri=True)
+        stamp = index.execute('SELECT Stamp FROM Stamp').fetchone()[0]
+        index.close()
+        if stamp != repr(stamps[0]):
+            build_search_index(dbpath)
+        SEARCH_INDEXES[indexpath] = (stamps[0], db_stamp(indexpath))
+    except (sqlite3.Error, RcmdError):
+        return None
+    return indexpath
+
+
+def search_rows(db, terms, limit=None):
+    # Rows whose Hostname contains all of the terms (case insensitive), best match first -
+    # exact hostname, then hostnames starting with the first term, then shortest hostname.
+    terms = [term for term in terms if term]
+    if not terms:
+        return []
+
+    # Terms are always checked with LIKE against Devices itself, the trigram index (which needs
+    # at least 3 characters per term) is only used to narrow down the candidate rows
+    wheresql = ' AND '.join(["Hostname LIKE ? ESCAPE '\\'"] * len(terms))
+    params = ['%' + re.sub(r'([\\%_])', r'\\\1', term) + '%' for term in terms]
+    ftsterms = ['"' + term.replace('"', '""') + '"' for term in terms if len(term) >= 3]
+    indexpath = search_index(db) if ftsterms else None
+    if indexpath is not None:
+        try:
+            db.execute('ATTACH DATABASE ? AS search', (indexpath,))
+        except sqlite3.Error:
+            indexpath = None
+    if indexpath is not None:
+        wheresql += ' AND rowid IN (SELECT rowid FROM search.DevicesSearch WHERE DevicesSearch MATCH ?)'
+        params.append(' AND '.join(ftsterms))
+
+    ordersql = "Hostname = ? COLLATE NOCASE DESC, Hostname LIKE ? ESCAPE '\\' DESC, length(Hostname) ASC, Hostname ASC"
+    params += [' '.join(terms), params[0][1:]]
+    sqlquery = f'SELECT * FROM Devices WHERE {wheresql} ORDER BY {ordersql}'
+    if limit is not None:
+        sqlquery += ' LIMIT ?'
+        params.append(limit)
+
+    cursor = db.cursor()
+    try:
+        cursor.execute(sqlquery, params)
+        return cursor.fetchall()
+    finally:
+        if indexpath is not None:
+            db.execute('DETACH DATABASE search')
+
+
+def search_devices(cfgfile=None, hostregex=None, limit=None, config=None):
+    # Non-interactive version of the Device() hostregex lookup - returns the ranked list of matching DB rows
+    if config is None:
+        config = load_config(cfgfile)
+
+    SQLDB = config.dbpath
+    if SQLDB is None:
+        raise RcmdError('ERROR: Unable to get DB file from CFG file')
+
+    db = sqlite3.connect(SQLDB)
+    rows = search_rows(db, hostregex.split(' '), limit)
+    db.close()
+
+    return rows
+
+
+def resolve_devices(cfgfile=None, hosts=None, hostregex=None, osdetect=False, config=None):
+    # Batch version of the Device() lookup - one config parse and one DB load for the whole list.
+    # Returns (devices, failed) where failed is a list of (host, error) - requested hosts not in the
+    # DB, and rows no Device could be made from (e.g. an undefined AuthID), so that one bad row is
+    # reported against its host rather than stopping the whole list.
+    # hostregex selects every matching device (no interactive selection).
+    if config is None:
+        config = load_config(cfgfile)
+
+    SQLDB = config.dbpath
+    if SQLDB is None:
+        raise RcmdError('ERROR: Unable to get DB file from CFG file')
+
+    # Hostnames are looked up in the in-memory inventory snapshot (one load of the Devices table)
+    inventory = get_inventory(SQLDB)
+
+    found = []
+    failed = []
+    for host in hosts or []:
+        row = inventory.get_host(host)
+        if row is None:
+            failed.append((host, 'ERROR: Device does not exist in DB'))
+        else:
+            found.append(row)
+    if hostregex is not None:
+        db = sqlite3.connect(SQLDB)
+        found += search_rows(db, hostregex.split(' '))
+        db.close()
+
+    devices = []
+    seen = set()
+    for row in found:
+        key = row[0].lower()
+        if key in seen:
+            continue
+        seen.add(key)
+        try:
+            devices.append(Device(config=config, row=row, osdetect=osdetect))
+        except RcmdError as e:
+            failed.append((row[0], e.value))
+
+    return devices, failed
+
+
+class OutputStream(object):
+
+    # do_getbuffer() for streamed output - drops the echoed command line and turns CRLF into LF a
+    # chunk at a time on the way to fout (None to discard), so the whole output is never held.
+    # With binary=True the output and fout are bytes.
+
+    def __init__(self, fout, binary=False):
+        self.fout = fout
+        self.echo = True
+        self.cr = False
+        self.size = 0
+        if binary:
+            self.CR, self.LF, self.CRLF = b'\r', b'\n', b'\r\n'
+        else:
+            self.CR, self.LF, self.CRLF = '\r', '\n', '\r\n'
+
+
+    def write(self, data):
+        if self.echo:
+            idx = data.find(self.LF)
+            if idx < 0:
+                return True
+            self.echo = False
+            data = data[idx+1:]
+        if self.cr:
+            data = self.CR + data
+        # A trailing \r may be the first half of a \r\n split across chunks
+        self.cr = data.endswith(self.CR)
+        if self.cr:
+            data = data[:-1]
+        data = data.replace(self.CRLF, self.LF)
+        self.size += len(data)
+        if self.fout is not None and data:
+            self.fout.write(data)
+        return True
+
+
+    def close(self):
+        if self.cr:
+            self.cr = False
+            self.size += 1
+            if self.fout is not None:
+                self.fout.write(self.CR)
+        return True
+
+
+class PhaseTimer(object):
+
+    # Per-phase timings for a Device (connect(timings=True)) - records[] of (phase, command,
+    # seconds, bytes read) in the order they happened. The phases are the login stages (spawn,
+    # hostkey, username, password, prompt), enable, set_prompt, os_detect or init, and command.
+    # Bytes are counted by standing in as the child's logfile_read (passing reads on to logfile).
+
+    def __init__(self):
+        self.records = []
+        self.logfile = None
+        self.nbytes = 0
+        self.mark = time.monotonic()
+        self.markbytes = 0
+
+
+    def write(self, data):
+        self.nbytes += len(data)
+        if self.logfile is not None:
+            self.logfile.write(data)
+
+
+    def flush(self):
+        if self.logfile is not None:
+            self.logfile.flush()
+
+
+    def start(self):
+        self.mark = time.monotonic()
+        self.markbytes = self.nbytes
+        return True
+
+
+    def stage(self, phase, command=None):
+        # Time and bytes since the last start() or stage()
+        now = time.monotonic()
+        self.records.append((phase, command, now - self.mark, self.nbytes - self.markbytes))
+        self.mark = now
+        self.markbytes = self.nbytes
+        return True
+
+
+    def totals(self):
+        # {phase: [seconds, bytes, count]} in the order the phases first happened
+        totals = {}
+        for phase, _, seconds, nbytes in self.records:
+            total = totals.setdefault(phase, [0.0, 0, 0])
+            total[0] += seconds
+            total[1] += nbytes
+            total[2] += 1
+        return totals
+
+
 class Device(object):
 
-    def __init__(self, cfgfile=None, host=None, hostregex=None, customhost=None, osdetect=False):
+    def __init__(self, cfgfile=None, host=None, hostregex=None, customhost=None, osdetect=False, config=None, row=None):
         self.cfgfile = cfgfile
         self.host = host
         if hostregex is not None:
@@ -56,73 +734,60 @@ class Device(object):
         self.timeout = 45
         self.buffer = None
         self.prompt = BASE_PROMPT
+        self.regexes = {}
         self.osdetect = osdetect
         self.enablemode = False
         self.pki = False
+        self.mux = False
+        self.binary = False
+        self.login_timings = []
+        self.login_mark = None
+        self.timer = None
+        self.fingerprints = None
+        # False to always learn the dtype/prompt again (still saved) - e.g. to check the DB dtype
+        self.use_fingerprint = True
+        self.paging = None
+        self.sentuser = False
+        self.sentpass = False
+        self.lastprompt = None
+        self.muxdir = None
+        self.muxpersist = None
+        self.acceptkeys = False
         HostList = []
         HostDict = {}
 
-        if (self.host is None) and (self.hostregex is None) and (customhost is None):
+        if (self.host is None) and (self.hostregex is None) and (customhost is None) and (row is None):
             raise RcmdError('ERROR: No host or hostregex or customhost specified')
 
-        if self.cfgfile is None:
-            raise RcmdError('ERROR: No cfgfile specified')
+        # A resolved config (from load_config) and DB row can be passed in instead of looking them up
+        if config is None:
+            config = load_config(self.cfgfile)
+        else:
+            self.cfgfile = config.cfgfile
 
-        try:
-            cfgf = open(self.cfgfile, 'r')
-        except IOError:
-            raise RcmdError('ERROR: Unable to open cfgfile')
-        cfgf.close()
-
-        config = configparser.ConfigParser()
-        config.read(self.cfgfile)
-
-        if customhost is not None:
-            row = customhost.split(',')
-            self.host = row[0]
-            self.ip = row[1]
-            self.dtype = row[2]
-            self.conn = row[3]
-            self.proxy = int(row[4])
-            self.authid = int(row[5])
+        if row is not None:
+            self.set_row(row)
+        elif customhost is not None:
+            self.set_row(customhost.split(','))
         else:
-            SQLDB = config.get('DevicesDB', 'path')
+            SQLDB = config.dbpath
             if SQLDB is None:
                 raise RcmdError('ERROR: Unable to get DB file from CFG file')
 
             if host is not None:
-                db = sqlite3.connect(SQLDB)
-                cursor = db.cursor()
-                cursor.execute('''SELECT * FROM Devices WHERE Hostname = ? COLLATE NOCASE LIMIT 1''', (host,))
-                row = cursor.fetchone()
+                row = lookup_host(SQLDB, host)
                 if row is None:
                     raise RcmdError('ERROR: Device does not exist in DB')
                 else:
-                    self.host = row[0]
-                    self.ip = row[1]
-                    self.dtype = row[2]
-                    self.conn = row[3]
-                    self.proxy = int(row[4])
-                    self.authid = int(row[5])
+                    self.set_row(row)
             else:
-                hostregexsql = f'Hostname NOT NULL'
-                for i in self.hostregex:
-                    hostregexsql += f' AND Hostname LIKE "%{i}%"'
-
                 db = sqlite3.connect(SQLDB)
-                cursor = db.cursor()
-                sqlquery = f'SELECT * FROM Devices WHERE {hostregexsql} ORDER BY Hostname ASC'
-                cursor.execute(sqlquery)
-                rows = cursor.fetchall()
+                rows = search_rows(db, self.hostregex)
+                db.close()
                 if not rows:
                     raise RcmdError('ERROR: Device does not exist in DB')
                 elif len(rows) == 1:
-                    self.host = rows[0][0]
-                    self.ip = rows[0][1]
-                    self.dtype = rows[0][2]
-                    self.conn = rows[0][3]
-                    self.proxy = int(rows[0][4])
-                    self.authid = int(rows[0][5])
+                    self.set_row(rows[0])
                 else:
                     idx = 1
                     for row in rows:
@@ -173,39 +838,53 @@ class Device(object):
                         if isvalid is False:
                             raise RcmdError('ERROR: Invalid selection')
 
-            db.close()
-
-        authsection = 'Auth' + str(self.authid)
-
-        try:
-            include_auth = config.get(authsection, 'include_auth')
-        except configparser.NoOptionError:
-            self.username = config.get(authsection, 'username')
-            self.password = config.get(authsection, 'password')
-        else:
-            self.username = config.get(include_auth, 'username')
-            self.password = config.get(include_auth, 'password')
+        self.muxdir = config.muxdir
+        self.muxpersist = config.muxpersist
+        self.acceptkeys = config.acceptkeys
+        if config.fppath is not None and config.fpttl > 0:
+            self.fingerprints = get_fingerprints(config.fppath, config.fpttl)
 
-        try:
-            self.enable_password = config.get(authsection, 'enable_password')
-        except configparser.NoOptionError:
-            self.enable_password = self.password
+        auth = config.get_auth(self.authid)
+        self.username = auth.username
+        self.password = auth.password
+        self.enable_password = auth.enable_password
 
         if self.proxy != 0:
             self.proxysection = 'Proxy' + str(self.proxy)
-            self.pserver = config.get(self.proxysection, 'server')
-            self.pport = config.get(self.proxysection, 'port')
-            self.sshconfig = config.get(self.proxysection, 'sshconfig')
+            proxy = config.get_proxy(self.proxy)
+            self.pserver = proxy.server
+            self.pport = proxy.port
+            self.sshconfig = proxy.sshconfig
 
         self.valid = True
 
         return None
 
 
-    def connect(self, debug=False, timeout=45, enablemode=False, smartprompt=True, pki=False):
+    def set_row(self, row):
+        # ProxyID and AuthID can be NULL in the Devices table
+        try:
+            proxy = int(row[4])
+            authid = int(row[5])
+        except (TypeError, ValueError):
+            raise RcmdError('ERROR: Invalid ProxyID/AuthID in DB')
+        self.host = row[0]
+        self.ip = row[1]
+        self.dtype = row[2]
+        self.conn = row[3]
+        self.proxy = proxy
+        self.authid = authid
+        return True
+
+
+    def connect(self, debug=False, timeout=45, enablemode=False, smartprompt=True, pki=False, mux=False, binary=False, timings=False):
         self.debug = debug
         self.timeout = timeout
         self.pki = pki
+        self.mux = mux
+        self.binary = binary
+        self.timer = PhaseTimer() if timings else None
+        self.connected = False
 
         if self.conn == 'S':
             self.do_spawn_ssh()
@@ -215,55 +894,60 @@ class Device(object):
             raise RcmdError('ERROR: Invalid connection type')
 
         if enablemode or self.dtype == 'F':
-            self.child.sendline('enable')
-            myexp = self.child.expect([PASSWORD_PROMPT, HOST_PROMPT, pexpect.EOF, pexpect.TIMEOUT], timeout=LOGINTIMEOUT)
-            if myexp == 0:
-                self.do_sendline(self.enable_password)
-            elif myexp == 1:
-                pass
-            elif myexp == 2:
-                raise RcmdError('ERROR: EOF encountered')
-            elif myexp == 3:
-                raise RcmdError('ERROR: Timeout encountered')
-            else:
-                raise RcmdError('ERROR: Unknown expect error')
-            self.buffer = self.child.before
+            self.do_enable()
+
+        if self.debug:
+            print('\nDEBUG> Login stages - ' + ', '.join(f'{stage} {secs:.3f}s' for stage, secs in self.login_timings))
+
+        # A fingerprint from an earlier connect saves learning the prompt/dtype again
+        fingerprint = self.cached_fingerprint()
+        try:
+            self.setup(fingerprint, smartprompt)
+        except RcmdError as e:
+            if fingerprint is None or e.value != 'ERROR: Timeout encountered':
+                raise
+            # The cached prompt (or dtype) no longer fits the device - forget it and learn again
+            self.forget_fingerprint()
+            fingerprint = None
+            self.setup(None, smartprompt)
 
+        self.save_fingerprint(fingerprint, smartprompt)
+
+        self.connected = True
+
+        return True
+
+
+    def setup(self, fingerprint, smartprompt):
+        # Prompt detection and device setup after login - from fingerprint where it has the answer
         if smartprompt:
-            self.do_set_prompt()
+            if fingerprint is not None and fingerprint.prompt is not None:
+                self.prompt = fingerprint.prompt
+            else:
+                self.prompt = BASE_PROMPT
+                self.do_set_prompt()
+            self.phase('set_prompt')
 
         if self.osdetect:
-            self.os_detect()
-        else:
-            if self.dtype == 'J':
-                self.init_device_junos()
-            elif self.dtype == 'A':
-                self.init_device_eos()
-            elif self.dtype == 'C':
-                self.init_device_ios()
-            elif self.dtype == 'N':
-                self.init_device_nxos()
-            elif self.dtype == 'E':
-                self.init_device_ace()
-            elif self.dtype == 'F':
-                self.init_device_asa()
-            elif self.dtype == 'L':
-                self.init_device_linux()
-            elif self.dtype == 'T':
-                self.init_device_tmos()
-            elif self.dtype == 'P':
-                self.init_device_panos()
+            if fingerprint is not None and fingerprint.dtype is not None:
+                self.dtype = fingerprint.dtype
+                self.paging = fingerprint.paging
+                self.init_device()
             else:
-                raise RcmdError('ERROR: Unknown device type')
-
-        self.connected = True
+                self.os_detect()
+            self.phase('os_detect')
+        else:
+            self.init_device()
+            self.phase('init')
 
         return True
 
 
     def os_detect(self):
+        import pexpect
         got_prompt = False
         output = ''
+        self.paging = False
 
         # Required to prevent Arista EOS from sending control characters in prompt
         self.do_sendline('terminal length 0')
@@ -273,10 +957,11 @@ class Device(object):
         while got_prompt is False:
             myexp = self.child.expect([self.prompt, MORE_PROMPTS, pexpect.EOF, pexpect.TIMEOUT], timeout=self.timeout)
             if myexp == 0:
-                output = output + self.child.before
+                output = output + self.text(self.child.before)
                 got_prompt = True
             elif myexp == 1:
-                output = output + self.child.before
+                output = output + self.text(self.child.before)
+                self.paging = True
                 self.child.send(' ')
             elif myexp == 2:
                 raise RcmdError('ERROR: EOF encountered')
@@ -285,96 +970,113 @@ class Device(object):
             else:
                 raise RcmdError('ERROR: Unknown expect error')
 
-        if re.search(r'\nJUNOS ', output):
-            self.dtype = 'J'
-            if self.debug:
-                print('\nDEBUG> Juniper JunOS device detected')
-            self.init_device_junos()
-        elif re.search(r'Arista', output):
-            self.dtype = 'A'
-            if self.debug:
-                print('\nDEBUG> Arista EOS device detected')
-            self.init_device_eos()
-        elif re.search(r'(Cisco IOS|\ncisco )', output):
-            self.dtype = 'C'
-            if self.debug:
-                print('\nDEBUG> Cisco IOS device detected')
-            self.init_device_ios()
-        elif re.search(r'Cisco Nexus', output):
-            self.dtype = 'N'
-            if self.debug:
-                print('\nDEBUG> Cisco NX-OS device detected')
-            self.init_device_nxos()
-        elif re.search(r'Cisco Application Control', output):
-            self.dtype = 'E'
-            if self.debug:
-                print('\nDEBUG> Cisco ACE device detected')
-            self.init_device_ace()
-        elif re.search(r'\n(Cisco Adaptive Security|FWSM)', output):
-            self.dtype = 'F'
-            if self.debug:
-                print('\nDEBUG> Cisco ASA/FWSM device detected')
-            self.init_device_asa()
-        else:
-            raise RcmdError('ERROR: Unknown device type')
+        self.dtype = self.detect_dtype(output)
+        self.init_device()
 
         return True
 
 
-    def init_device_junos(self):
-        self.do_sendline('set cli screen-length 0')
-        self.do_sendline('set cli screen-width 0')
-        self.child.send(chr(0x1b))
-        self.child.send('q')
-        self.do_sendline('')
+    def cached_fingerprint(self):
+        # Fingerprint saved by an earlier connect - None if there is none, or if the prompt seen at
+        # login no longer matches its prompt (e.g. renamed device), so everything is learned again
+        if self.fingerprints is None or not self.use_fingerprint:
+            return None
+        fingerprint = self.fingerprints.get(self.host, self.ip, self.username)
+        if fingerprint is None:
+            return None
+        if fingerprint.prompt is not None and self.lastprompt is not None:
+            if re.search(fingerprint.prompt, '\r\n' + self.lastprompt.lstrip('\r\n')) is None:
+                return None
+        return fingerprint
+
+
+    def forget_fingerprint(self):
+        if self.fingerprints is None:
+            return False
+        return self.fingerprints.drop(self.host, self.ip, self.username)
+
+
+    def save_fingerprint(self, cached, smartprompt):
+        # Only written when something was learned - a connect that used the whole fingerprint
+        # does not write to the cache
+        if self.fingerprints is None:
+            return False
+        now = time.time()
+        if cached is None:
+            cached = Fingerprint(None, None, None, None, now)
+        # Learned is when anything in it was last found out from the device, for the ttl
+        learned = cached.learned
+        prompt = cached.prompt
+        if smartprompt and prompt is None:
+            prompt = self.prompt
+            learned = now
+        dtype = cached.dtype
+        paging = cached.paging
+        if self.osdetect and dtype is None:
+            dtype = self.dtype
+            paging = self.paging
+            learned = now
+        if learned == cached.learned:
+            return True
+        return self.fingerprints.put(self.host, self.ip, self.username, Fingerprint(dtype, prompt, paging, learned, now))
+
+
+    def detect_dtype(self, output):
+        for regex, dtype, name in OS_SIGNATURES:
+            if re.search(regex, output):
+                if self.debug:
+                    print(f'\nDEBUG> {name} device detected')
+                return dtype
+        raise RcmdError('ERROR: Unknown device type')
+
+
+    def init_device(self, dtype=None):
+        if dtype is None:
+            dtype = self.dtype
+        if dtype not in INIT_COMMANDS:
+            raise RcmdError('ERROR: Unknown device type')
+        for send, line in INIT_COMMANDS[dtype]:
+            if send == 'sendline':
+                self.do_sendline(line)
+            else:
+                self.child.send(line)
         return True
 
 
+    def init_device_junos(self):
+        return self.init_device('J')
+
+
     def init_device_eos(self):
-        self.do_sendline('terminal length 0')
-        self.do_sendline('terminal width 32767')
-        return True
+        return self.init_device('A')
 
 
     def init_device_ios(self):
-        self.do_sendline('terminal length 0')
-        self.do_sendline('terminal width 0')
-        return True
+        return self.init_device('C')
 
 
     def init_device_nxos(self):
-        self.do_sendline('terminal length 0')
-        self.do_sendline('terminal width 511')
-        return True
+        return self.init_device('N')
 
 
     def init_device_ace(self):
-        self.do_sendline('terminal length 0')
-        self.do_sendline('terminal width 511')
-        return True
+        return self.init_device('E')
 
 
     def init_device_asa(self):
-        self.do_sendline('terminal pager 0')
-        return True
+        return self.init_device('F')
 
 
     def init_device_linux(self):
-        pass
-        return True
+        return self.init_device('L')
 
 
     def init_device_tmos(self):
-        pass
-        return True
+        return self.init_device('T')
 
 
     def init_device_panos(self):
-        self.do_sendline('set cli pager off')
-        self.do_sendline('set cli terminal width 500')
-        self.do_sendline('set cli scripting-mode on')
-        self.do_sendline('set cli confirmation-prompt off')
-        return True
+        return self.init_device('P')
 
 
     def dump_hex(self, output):
@@ -383,35 +1085,188 @@ class Device(object):
         return True
 
 
-    def do_spawn_ssh(self):
-        if self.sshconfig is None:
-            self.child = pexpect.spawn(SSH, ['-l', self.username, self.ip], encoding='utf-8', codec_errors='ignore')
+    def ssh_args(self):
+        args = []
+        if self.sshconfig is not None:
+            args += ['-F', self.sshconfig]
+        if self.mux:
+            args += self.mux_args()
+        args += ['-l', self.username, self.ip]
+        return args
+
+
+    def mux_path(self):
+        # One control socket per proxy/user/device - the same IP can be behind different proxies
+        return os.path.join(self.muxdir, f'p{self.proxy}-{self.username}@{self.ip}')
+
+
+    def mux_args(self):
+        os.makedirs(self.muxdir, mode=0o700, exist_ok=True)
+        path = self.mux_path()
+        # ssh disables multiplexing if a socket is left behind by a master that has gone away
+        if os.path.exists(path) and not mux_alive(path):
+            os.unlink(path)
+        return ['-o', 'ControlMaster=auto', '-o', f'ControlPath={path}', '-o', f'ControlPersist={self.muxpersist}']
+
+
+    def do_spawn(self, command, args):
+        import pexpect
+        if self.binary:
+            self.child = pexpect.spawn(command, args)
         else:
-            self.child = pexpect.spawn(SSH, ['-F', self.sshconfig, '-l', self.username, self.ip], encoding='utf-8', codec_errors='ignore')
+            self.child = pexpect.spawn(command, args, encoding='utf-8', codec_errors='ignore')
         self.child.maxread = MAXREAD
         if self.debug:
-            self.child.logfile_read = sys.stdout
-        if self.pki is False:
-            self.do_expect(PASSWORD_PROMPT, LOGINTIMEOUT)
-            time.sleep(1)
-            self.child.sendline(self.password)
-        self.do_expect(self.prompt, LOGINTIMEOUT)
+            self.child.logfile_read = sys.stdout.buffer if self.binary else sys.stdout
+        self.time_reads()
+        return True
+
+
+    def time_reads(self):
+        # Count the bytes read for the per-phase timings, passing reads on to any logfile_read
+        if self.timer is not None:
+            self.timer.logfile = self.child.logfile_read
+            self.child.logfile_read = self.timer
+        return True
+
+
+    def phase(self, phase, command=None):
+        # Per-phase timings (connect(timings=True)) - time and bytes read since the previous phase
+        if self.timer is not None:
+            self.timer.stage(phase, command)
+        return True
+
+
+    def phase_start(self):
+        if self.timer is not None:
+            self.timer.start()
+        return True
+
+
+    def command_start(self):
+        # Commands sent by connect() itself (init, os_detect) are part of those phases instead
+        if self.timer is not None and self.connected:
+            self.timer.start()
+        return True
+
+
+    def command_done(self, line):
+        if self.timer is not None and self.connected:
+            self.timer.stage('command', line)
+        return True
+
+
+    def do_spawn_ssh(self):
+        self.login_start()
+        self.do_spawn(SSH, self.ssh_args())
+        self.login_stage('spawn')
+        self.do_login()
         return True
 
 
     def do_spawn_telnet(self):
+        self.login_start()
         if self.pserver is None:
-            self.child = pexpect.spawn(TELNET, [self.ip], encoding='utf-8', codec_errors='ignore')
+            self.do_spawn(TELNET, [self.ip])
         else:
             arglist = ['-,rawer']
             arg2 = f'socks4:{self.pserver}:{self.ip}:23,socksport={self.pport}'
             arglist.append(arg2)
-            self.child = pexpect.spawn(SOCAT, arglist, encoding='utf-8', codec_errors='ignore')
-        self.child.maxread = MAXREAD
-        if self.debug:
-            self.child.logfile_read = sys.stdout
-        myexp = self.child.expect(['sername:', 'ogin:', pexpect.EOF, pexpect.TIMEOUT], timeout=LOGINTIMEOUT)
-        if myexp == 0 or myexp == 1:
+            self.do_spawn(SOCAT, arglist)
+        self.login_stage('spawn')
+        self.do_login()
+        return True
+
+
+    def do_login(self):
+        while True:
+            myexp = self.child.expect(self.login_patterns(), timeout=LOGINTIMEOUT)
+            if self.login_event(myexp):
+                return True
+
+
+    def login_start(self):
+        self.login_timings = []
+        self.login_mark = time.monotonic()
+        self.phase_start()
+        self.sentuser = False
+        self.sentpass = False
+        self.lastprompt = None
+        return True
+
+
+    def login_stage(self, stage):
+        # Time taken by each login stage, from the end of the previous one
+        now = time.monotonic()
+        self.login_timings.append((stage, now - self.login_mark))
+        self.login_mark = now
+        self.phase(stage)
+        return True
+
+
+    def login_patterns(self):
+        import pexpect
+        patterns = [HOSTKEY_PROMPT, USERNAME_PROMPT, PASSWORD_PROMPT, LOGIN_FAILED, pexpect.EOF, pexpect.TIMEOUT]
+        # Only look for the device prompt once it can appear (after the password, or straight away
+        # with SSH keys or a multiplexed SSH session), so a banner line ending in #/>/$ is not taken for it
+        if self.sentpass or (self.conn == 'S' and (self.pki or self.mux)):
+            patterns.append(LOGIN_PROMPT)
+        return patterns
+
+
+    def login_event(self, myexp):
+        # One step of the login - reacts to whatever login_patterns() matched, returns True once logged in
+        if myexp == 0:
+            # Never accepted silently - an unknown key may be a man in the middle
+            if not self.acceptkeys:
+                raise RcmdError('ERROR: Unknown host key')
+            self.login_stage('hostkey')
+            self.child.sendline('yes')
+        elif myexp == 1:
+            if self.sentuser:
+                raise RcmdError('ERROR: Authentication failed')
+            self.login_stage('username')
+            self.child.sendline(self.username)
+            self.sentuser = True
+        elif myexp == 2:
+            if self.sentpass:
+                raise RcmdError('ERROR: Authentication failed')
+            self.login_stage('password')
+            self.child.sendline(self.password)
+            self.sentpass = True
+        elif myexp == 3:
+            raise RcmdError('ERROR: Authentication failed')
+        elif myexp == 4:
+            raise RcmdError('ERROR: EOF encountered')
+        elif myexp == 5:
+            raise RcmdError('ERROR: Timeout encountered')
+        elif myexp == 6:
+            self.login_stage('prompt')
+            self.buffer = self.child.before
+            self.lastprompt = self.text(self.child.after)
+            return True
+        else:
+            raise RcmdError('ERROR: Unknown expect error')
+        return False
+
+
+    def do_enable(self):
+        import pexpect
+        # Already privileged (e.g. privilege 15 user) - no need for enable
+        if self.lastprompt is not None and self.lastprompt.rstrip().endswith('#'):
+            return True
+        self.child.sendline('enable')
+        myexp = self.child.expect([PASSWORD_PROMPT, HOST_PROMPT, pexpect.EOF, pexpect.TIMEOUT], timeout=LOGINTIMEOUT)
+        if myexp == 0:
+            self.child.sendline(self.enable_password)
+            myexp = self.child.expect([ENABLE_PROMPT, PASSWORD_PROMPT, LOGIN_FAILED, pexpect.EOF, pexpect.TIMEOUT], timeout=LOGINTIMEOUT)
+            if myexp == 1 or myexp == 2:
+                raise RcmdError('ERROR: Enable failed')
+            elif myexp == 3:
+                raise RcmdError('ERROR: EOF encountered')
+            elif myexp == 4:
+                raise RcmdError('ERROR: Timeout encountered')
+        elif myexp == 1:
             pass
         elif myexp == 2:
             raise RcmdError('ERROR: EOF encountered')
@@ -419,18 +1274,20 @@ class Device(object):
             raise RcmdError('ERROR: Timeout encountered')
         else:
             raise RcmdError('ERROR: Unknown expect error')
-        self.child.sendline(self.username)
-        self.do_expect(PASSWORD_PROMPT, LOGINTIMEOUT)
-        time.sleep(1)
-        self.child.sendline(self.password)
-        self.do_expect(self.prompt, LOGINTIMEOUT)
+        self.buffer = self.child.before
+        self.login_stage('enable')
         return True
 
 
     def do_set_prompt(self):
         self.child.sendline('')
-        self.do_expect(self.prompt, self.timeout)
-        self.prompt = self.child.match.group(0)
+        self.do_expect_prompt(self.timeout)
+        self.learn_prompt(self.text(self.child.match.group(0)))
+        return True
+
+
+    def learn_prompt(self, matched):
+        self.prompt = matched
         m = re.search(HOST_PROMPT, self.prompt)
         if m.group(1) is not None:
             prompt1 = re.escape(m.group(1))
@@ -439,6 +1296,7 @@ class Device(object):
 
 
     def do_expect(self, myexpect, mytimeout):
+        import pexpect
         myexp = self.child.expect([myexpect, pexpect.EOF, pexpect.TIMEOUT], timeout=mytimeout)
         if myexp == 0:
             pass
@@ -452,7 +1310,106 @@ class Device(object):
         return True
 
 
+    def do_expect_prompt(self, mytimeout):
+        # do_expect(self.prompt, ...) without pexpect rescanning the whole output on every read -
+        # only the new data plus the last PROMPT_OVERLAP characters before it are searched, and
+        # the output is only joined up once, so the cost stays linear in the output size
+        regex = self.get_regex(self.prompt)
+        if self.binary:
+            return self.do_expect_prompt_bytes(regex, mytimeout)
+        chunks = []
+        size = 0
+        tail = ''
+        data = self.take_pending()
+        end_time = time.monotonic() + mytimeout
+        while True:
+            window = tail + data
+            m = regex.search(window)
+            chunks.append(data)
+            if m is not None:
+                start = size - len(tail) + m.start()
+                self.buffer = ''.join(chunks)[:start]
+                self.put_pending(window[m.end():])
+                self.child.before = self.buffer
+                self.child.after = m.group(0)
+                self.child.match = m
+                return True
+            size += len(data)
+            tail = window[-PROMPT_OVERLAP:]
+            data = self.read_chunk(end_time)
+
+
+    def do_expect_prompt_bytes(self, regex, mytimeout):
+        # Bytes mode - output is read into one bytearray and searched in place (re takes any
+        # bytes-like object), the prompt and what follows it are cut off the end afterwards
+        buf = bytearray(self.take_pending())
+        searched = 0
+        end_time = time.monotonic() + mytimeout
+        while True:
+            m = regex.search(buf, max(0, searched - PROMPT_OVERLAP))
+            if m is not None:
+                self.put_pending(bytes(buf[m.end():]))
+                # m refers to buf, which is cut down below - keep a match on a copy of just the prompt
+                self.child.after = m.group(0)
+                self.child.match = regex.match(self.child.after)
+                del buf[m.start():]
+                self.buffer = buf
+                self.child.before = buf
+                return True
+            searched = len(buf)
+            buf += self.read_chunk(end_time)
+
+
+    def get_regex(self, pattern):
+        # Compiled once per Device and pattern (flags as pexpect uses)
+        regex = self.regexes.get(pattern)
+        if regex is None:
+            if self.binary:
+                regex = re.compile(pattern.encode(), re.DOTALL)
+            else:
+                regex = re.compile(pattern, re.DOTALL)
+            self.regexes[pattern] = regex
+        return regex
+
+
+    def text(self, data):
+        # Output as str, whichever mode the child is in
+        if isinstance(data, str):
+            return data
+        return bytes(data).decode('utf-8', 'ignore')
+
+
+    def take_pending(self):
+        # Output pexpect has already read but not matched - for reading the child directly
+        pending = self.child.buffer
+        self.put_pending(pending[:0])
+        return pending
+
+
+    def put_pending(self, data):
+        # Hand unmatched output back to pexpect for the next expect(). pexpect keeps a second
+        # copy in _before that is searched again if it is longer than buffer, so reset both.
+        self.child.buffer = data
+        self.child._before = self.child.buffer_type()  # pylint: disable=protected-access
+        self.child._before.write(data)  # pylint: disable=protected-access
+        return True
+
+
+    def read_chunk(self, end_time):
+        import pexpect
+        remaining = end_time - time.monotonic()
+        if remaining <= 0:
+            raise RcmdError('ERROR: Timeout encountered')
+        try:
+            return self.child.read_nonblocking(STREAM_CHUNK, remaining)
+        except pexpect.TIMEOUT:
+            raise RcmdError('ERROR: Timeout encountered')
+        except pexpect.EOF:
+            raise RcmdError('ERROR: EOF encountered')
+
+
     def do_expectraw(self, myexpect, mytimeout):
+        import pexpect
         myexp = self.child.expect([myexpect, pexpect.EOF, pexpect.TIMEOUT], timeout=mytimeout)
         if myexp == 0:
             self.buffer = self.child.before
@@ -460,11 +1417,68 @@ class Device(object):
 
 
     def do_sendline(self, line):
+        self.command_start()
         self.child.sendline(line)
-        self.do_expect(self.prompt, self.timeout)
+        self.do_expect_prompt(self.timeout)
+        self.command_done(line)
         return True
 
 
+    def do_sendline_batch(self, lines, depth, times=None):
+        # Pipelined do_sendline - keeps up to depth commands in flight instead of waiting for the
+        # prompt after each one, then splits the output back up on the (learned) prompt.
+        # Returns the do_getbuffer() output of each line (and appends when each one completed,
+        # time.monotonic(), to times if given).
+        outputs = []
+        sent = 0
+        self.command_start()
+        while len(outputs) < len(lines):
+            todo = lines[sent:len(outputs) + depth]
+            if todo:
+                # One write for all of them - each pexpect send() waits delaybeforesend
+                self.child.send(''.join(line + os.linesep for line in todo))
+                sent += len(todo)
+            self.do_expect_prompt(self.timeout)
+            # Timed from when the previous one completed
+            self.command_done(lines[len(outputs)])
+            outputs.append(self.do_getbuffer_bytes() if self.binary else self.do_getbuffer())
+            if times is not None:
+                times.append(time.monotonic())
+        return outputs
+
+
+    def do_sendline_stream(self, line, fout):
+        # do_sendline + do_getbuffer with the output written to fout as it arrives
+        self.command_start()
+        self.child.sendline(line)
+        self.do_expect_stream(self.prompt, self.timeout, OutputStream(fout, self.binary))
+        self.command_done(line)
+        return True
+
+
+    def do_expect_stream(self, myexpect, mytimeout, stream):
+        # do_expect that passes everything before the match to stream as it is read, only keeping
+        # the last STREAM_TAIL characters to search for the prompt. self.buffer is left empty.
+        regex = self.get_regex(myexpect)
+        pending = self.take_pending()
+        end_time = time.monotonic() + mytimeout
+        while True:
+            m = regex.search(pending)
+            if m is not None:
+                stream.write(pending[:m.start()])
+                stream.close()
+                self.put_pending(pending[m.end():])
+                self.child.before = pending[:0]
+                self.child.after = m.group(0)
+                self.child.match = m
+                self.buffer = pending[:0]
+                return True
+            if len(pending) > STREAM_TAIL:
+                stream.write(pending[:-STREAM_TAIL])
+                pending = pending[-STREAM_TAIL:]
+            pending += self.read_chunk(end_time)
+
+
     def do_sendline_noexpect(self, line):
         self.child.sendline(line)
         return True
@@ -476,19 +1490,41 @@ class Device(object):
 
 
     def do_sendline_setprompt(self, line):
+        self.command_start()
         self.child.sendline(line)
         self.prompt = BASE_PROMPT
-        self.do_expect(self.prompt, self.timeout)
+        self.do_expect_prompt(self.timeout)
         self.do_set_prompt()
+        self.command_done(line)
         return True
 
 
     def do_getbuffer(self):
+        if self.binary:
+            return self.text(self.do_getbuffer_bytes())
         idx = self.buffer.find('\n')
         outp = re.sub('\r\n', '\n', self.buffer[idx+1:])
         return outp
 
 
+    def do_getbuffer_bytes(self):
+        # do_getbuffer() without decoding - bytes mode only
+        idx = self.buffer.find(b'\n')
+        return self.buffer[idx+1:].replace(b'\r\n', b'\n')
+
+
     def disconnect(self):
         self.child.sendline('exit')
         return True
+
+
+    def close(self):
+        # Drop the session without logging out - e.g. a connect() that was cancelled or failed
+        import pexpect
+        if self.child is not None:
+            try:
+                self.child.close()
+            except pexpect.ExceptionPexpect:
+                # Still exiting - it is reaped when the script ends
+                pass
+        return True
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+
+# Single entry point for all the tools - rcmdtool.py <subcommand> [options]
+# Only the chosen subcommand's script is loaded, so e.g. check-ip/dumpinfo never import pexpect.
+# Keep the imports here to the bare minimum, this runs on every invocation.
+
+import os
+import sys
+
+
+SUBCOMMANDS = {
+    'run': ('rcmd.py', 'Run CLI commands on remote device(s).'),
+    'scp': ('rscp.py', 'scp file to remote device.'),
+    'discover': ('discover.py', 'Run OS discovery on remote device.'),
+    'check-ip': ('check-ip.py', 'Check management IP of device in device DB.'),
+    'check-hostname': ('check-hostname.py', 'Check hostname of device against device DB.'),
+    'check-dtype': ('check-dtype.py', 'Check device type of device against device DB.'),
+    'audit': ('audit.py', 'Check-ip/check-hostname/check-dtype for the whole device DB or a selection of it.'),
+    'dumpinfo': ('dumpinfo.py', 'Dump device DB information for device.'),
+    'index': ('searchindex.py', 'Build (or remove) the hostname search index.'),
+    'muxclean': ('muxclean.py', 'Clean up SSH ControlMaster sockets used by run -M.'),
+    'store': ('outstore.py', 'Query the output store written by run --store.'),
+}
+
+
+def usage():
+    print(f'usage: {os.path.basename(sys.argv[0])} <subcommand> [options]\n\nsubcommands:')
+    for name, (_, desc) in SUBCOMMANDS.items():
+        print(f'  {name.ljust(16)} {desc}')
+    print(f'\nRun "{os.path.basename(sys.argv[0])} <subcommand> -h" for help on a subcommand.')
+    print('Any subcommand also takes --profile PREFIX to write a CPU profile of the run (see profiling.py).')
+
+
+def load_subcommand(name):
+    # The scripts have '-' in their names so can't be imported normally. Load them through the
+    # regular source loader so the bytecode cache in __pycache__ is still used (importlib.util
+    # would do the same but costs several ms to import).
+    from importlib.machinery import SourceFileLoader
+    modname = name.replace('-', '_')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), SUBCOMMANDS[name][0])
+    module = type(sys)(modname)
+    module.__file__ = script
+    SourceFileLoader(modname, script).exec_module(module)
+    return module
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        usage()
+        sys.exit(0 if len(sys.argv) >= 2 else 1)
+
+    name = sys.argv[1]
+    if name not in SUBCOMMANDS:
+        print(f'ERROR: Unknown subcommand - {name}')
+        usage()
+        sys.exit(1)
+
+    # Make the subcommand's own argparse see its options, with "rcmdtool.py <subcommand>" as prog
+    sys.argv = [f'{os.path.basename(sys.argv[0])} {name}'] + sys.argv[2:]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # --profile works for every subcommand (and covers loading it) - see profiling.py
+    from profiling import run_main
+    run_main(lambda: load_subcommand(name).main())
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ import sys
 import argparse
 from rcmdclass import Device, RcmdError
 import pexpect
+from profiling import run_main
 
 
 SCP = '/usr/bin/scp'
@@ -57,4 +58,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    run_main(main)
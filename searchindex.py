@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+
+
+import os
+import sys
+import argparse
+from rcmdclass import RcmdError, load_config, build_search_index, search_index_path
+from profiling import run_main
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='Build (or remove) the hostname search index used by hostregex lookups (rcmd.py -s etc.).')
+    parser.add_argument('-i', '--cfgfile', required=True, help='Config file.')
+    parser.add_argument('-r', '--remove', action='store_true', default=False, help='Remove the index - searches go back to a plain LIKE scan.')
+    args = parser.parse_args()
+
+    try:
+        config = load_config(args.cfgfile)
+        if config.dbpath is None:
+            raise RcmdError('ERROR: Unable to get DB file from CFG file')
+        indexpath = search_index_path(config.dbpath)
+        if args.remove:
+            if os.path.exists(indexpath):
+                os.remove(indexpath)
+                print(f'Removed search index - {indexpath}')
+        else:
+            build_search_index(config.dbpath)
+            print(f'Built search index - {indexpath}')
+    except RcmdError as e:
+        print(e.value)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run_main(main)
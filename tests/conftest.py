@@ -0,0 +1,68 @@
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, redefined-outer-name
+
+# Tests run against fakedevice.py in place of ssh/telnet, with a config file and Devices DB made
+# for each test - no real devices or network needed.
+
+import os
+import sys
+import sqlite3
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import rcmdclass  # pylint: disable=wrong-import-position
+import asyncrcmd  # pylint: disable=wrong-import-position
+
+FAKEDEVICE = os.path.join(ROOT, 'fakedevice.py')
+
+# Devices rows - fakedevice takes the device type from an IP of the form <dtype>-<anything>
+ROWS = [
+    ('rtr1-lab', 'C-1', 'C', 'S', 0, 1),
+    ('rtr2-lab', 'C-2', 'C', 'T', 0, 1),
+    ('sw1-lab', 'N-1', 'N', 'S', 0, 1),
+]
+
+
+def write_db(path, rows):
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE Devices ( Hostname TEXT PRIMARY KEY ASC NOT NULL UNIQUE, MgmtIP TEXT NOT NULL UNIQUE, DeviceType TEXT NOT NULL, ConnMethod TEXT NOT NULL, ProxyID INT NOT NULL, AuthID INT)')
+    db.executemany('INSERT INTO Devices VALUES (?, ?, ?, ?, ?, ?)', rows)
+    db.commit()
+    db.close()
+    return path
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    # ssh and telnet are both fakedevice.py, which accepts any password unless FAKEDEV_PASSWORD is set.
+    # A short login timeout makes a login that is not recognised as failed show up quickly.
+    for module in (rcmdclass, asyncrcmd):
+        monkeypatch.setattr(module, 'SSH', FAKEDEVICE)
+        monkeypatch.setattr(module, 'TELNET', FAKEDEVICE)
+        monkeypatch.setattr(module, 'LOGINTIMEOUT', 5)
+    for name in ('FAKEDEV_PASSWORD', 'FAKEDEV_REJECT', 'FAKEDEV_HOSTKEY', 'FAKEDEV_DTYPE', 'FAKEDEV_LATENCY', 'FAKEDEV_LOGIN_DELAY'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('TERM', 'vt100')
+    return FAKEDEVICE
+
+
+@pytest.fixture
+def dbpath(tmp_path):
+    return write_db(str(tmp_path / 'devices.db'), ROWS)
+
+
+@pytest.fixture
+def cfgfile(tmp_path, dbpath):
+    path = tmp_path / 'rcmd.ini'
+    path.write_text(f'''[Auth1]
+username=u
+password=p
+
+[DevicesDB]
+path={dbpath}
+
+[Fingerprints]
+ttl=0
+''')
+    return str(path)
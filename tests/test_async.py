@@ -0,0 +1,42 @@
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, redefined-outer-name, unused-argument
+
+import io
+import asyncio
+from asyncrcmd import AsyncDevice
+
+
+def run(cfgfile, coro):
+    async def main():
+        dev = AsyncDevice(cfgfile=cfgfile, host='rtr1-lab')
+        await dev.connect(timeout=10)
+        try:
+            return await coro(dev)
+        finally:
+            await dev.disconnect()
+            dev.close()
+    return asyncio.run(main())
+
+
+def test_large_output(fake, cfgfile):
+    # Collected in many reads - buffered and streamed output are the same, and the session is
+    # still in step with the prompt afterwards
+    async def commands(dev):
+        await dev.do_sendline('show lines 50000')
+        buffered = dev.do_getbuffer()
+        fout = io.StringIO()
+        await dev.do_sendline_stream('show lines 50000', fout)
+        await dev.do_sendline('show lines 2')
+        return buffered, fout.getvalue(), dev.do_getbuffer()
+
+    buffered, streamed, last = run(cfgfile, commands)
+    assert len(buffered.strip('\n').split('\n')) == 50000
+    assert streamed.replace('\r\n', '\n').strip('\n') == buffered.strip('\n')
+    assert last.count('10.') == 2
+
+
+def test_pipelined(fake, cfgfile):
+    async def commands(dev):
+        return await dev.do_sendline_batch([f'show lines {n}' for n in range(1, 7)], 3)
+
+    outputs = run(cfgfile, commands)
+    assert [output.count('10.') for output in outputs] == list(range(1, 7))
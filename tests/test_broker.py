@@ -0,0 +1,43 @@
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, redefined-outer-name, unused-argument
+
+import threading
+import pytest
+import rcmdclass
+from rcmdbroker import SessionBroker
+
+
+def request(cfgfile, host='rtr1-lab'):
+    return {'cfgfile': cfgfile, 'host': host, 'cmds': ['show lines 3'], 'timeout': 5}
+
+
+def close_all(broker):
+    for session in list(broker.sessions.values()):
+        with session.lock:
+            broker.close(session)
+
+
+def test_reuse(fake, cfgfile):
+    broker = SessionBroker()
+    first = broker.run(request(cfgfile))
+    second = broker.run(request(cfgfile))
+    assert (first['reused'], second['reused']) == (False, True)
+    assert second['output'].count('10.') == 3
+    close_all(broker)
+
+
+def test_spawn_failure(fake, cfgfile, tmp_path, monkeypatch):
+    # A failure other than RcmdError (here pexpect unable to spawn ssh) must not leave the session
+    # registered and locked, which would block every later request for the host
+    broker = SessionBroker()
+    monkeypatch.setattr(rcmdclass, 'SSH', str(tmp_path / 'missing-ssh'))
+    with pytest.raises(Exception):
+        broker.run(request(cfgfile))
+    assert not broker.sessions
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(broker.run(request(cfgfile))), daemon=True)
+    monkeypatch.setattr(rcmdclass, 'SSH', fake)
+    thread.start()
+    thread.join(10)
+    assert result and result[0]['ok']
+    close_all(broker)
@@ -0,0 +1,48 @@
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, redefined-outer-name, unused-argument
+
+import io
+from rcmdclass import Device, load_config, resolve_devices
+from rcmd import run_fleet
+from conftest import ROWS
+
+
+CMDS = ['show lines 3', 'show bytes 70000', 'show version']
+
+
+def outputs(cfgfile, binary):
+    # Output of each of CMDS sent one at a time, pipelined and streamed
+    dev = Device(cfgfile=cfgfile, host='rtr1-lab')
+    dev.connect(timeout=10, binary=binary)
+    getbuffer = dev.do_getbuffer_bytes if binary else dev.do_getbuffer
+    single = []
+    for line in CMDS:
+        dev.do_sendline(line)
+        single.append(getbuffer())
+    batch = dev.do_sendline_batch(CMDS, 3)
+    fout = io.BytesIO() if binary else io.StringIO()
+    dev.do_sendline_stream(CMDS[1], fout)
+    dev.disconnect()
+    dev.close()
+    return single, batch, fout.getvalue()
+
+
+def test_bytes(fake, cfgfile):
+    # Bytes mode gives the same output as text mode, undecoded (bytearray from the session buffer)
+    single, batch, streamed = outputs(cfgfile, True)
+    text = outputs(cfgfile, False)
+    assert all(isinstance(output, (bytes, bytearray)) for output in single + batch + [streamed])
+    assert single == [output.encode() for output in text[0]]
+    assert batch == single
+    assert streamed == text[2].encode() == single[1]
+
+
+def test_fleet_bytes(fake, cfgfile, tmp_path):
+    config = load_config(cfgfile)
+    logs = {}
+    for binary in (False, True):
+        for stream in (False, True):
+            devices, failed = resolve_devices(hosts=[row[0] for row in ROWS], config=config)
+            logdir = tmp_path / f'logs{binary}{stream}'
+            assert run_fleet(devices, failed, CMDS, config, logdir=str(logdir), workers=3, timeout=10, stream=stream, binary=binary)
+            logs[binary, stream] = {row[0]: (logdir / f'{row[0]}.log').read_bytes() for row in ROWS}
+    assert logs[True, False] == logs[False, False] == logs[True, True] == logs[False, True]
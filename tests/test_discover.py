@@ -0,0 +1,36 @@
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, redefined-outer-name, unused-argument
+
+import asyncio
+import sqlite3
+from discover import BulkReport, DevicesWriter
+
+
+def test_devices_writer(dbpath, tmp_path):
+    report = BulkReport(str(tmp_path / 'report.csv'))
+    writer = DevicesWriter(dbpath, report, batch=2)
+
+    async def add():
+        await writer.add('RTR1-LAB', ('rtr1-lab', 'C-11', 'C', 'S', 0, 1))
+        await writer.add('new1', ('new1', 'C-21', 'C', 'S', 0, 1))
+        # MgmtIP already in the DB as sw1-lab
+        await writer.add('new2', ('new2', 'N-1', 'N', 'S', 0, 1))
+
+    asyncio.run(add())
+    writer.close()
+    report.close()
+    assert (writer.added, writer.updated) == (1, 1)
+    assert report.counts['conflict'] == 1
+    db = sqlite3.connect(dbpath)
+    assert db.execute('''SELECT Hostname, MgmtIP FROM Devices WHERE Hostname IN ('rtr1-lab', 'new1', 'new2') ORDER BY Hostname''').fetchall() == [('new1', 'C-21'), ('rtr1-lab', 'C-11')]
+    db.close()
+
+
+def test_race_spawn_failure(fake, cfgfile, tmp_path, monkeypatch):
+    # ssh cannot even be spawned - that is only the SSH candidate's failure, telnet still wins
+    import asyncrcmd
+    from rcmdclass import load_config
+    from discover import detect
+    monkeypatch.setattr(asyncrcmd, 'SSH', str(tmp_path / 'missing-ssh'))
+    config = load_config(cfgfile)
+    row = asyncio.run(detect(config, 'sim-c-5', 'C-5', [0], 1, 5, 0.5, False))
+    assert row == ('sim-c-5', 'C-5', 'C', 'T', 0, 1)
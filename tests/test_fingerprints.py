@@ -0,0 +1,83 @@
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, redefined-outer-name, unused-argument
+
+import asyncio
+import sqlite3
+import pytest
+from rcmdclass import Device
+from asyncrcmd import AsyncDevice
+
+
+CUSTOM = 'rtr9-lab,C-9,C,S,0,1'
+
+
+@pytest.fixture
+def fpcfg(tmp_path):
+    path = tmp_path / 'fp.ini'
+    path.write_text(f'''[Auth1]
+username=u
+password=p
+
+[Fingerprints]
+path={tmp_path / 'fp.db'}
+ttl=3600
+''')
+    return str(path)
+
+
+def cached(cfgfile):
+    db = sqlite3.connect(cfgfile.replace('fp.ini', 'fp.db'))
+    rows = db.execute('SELECT DType, Prompt, Learned, LastSeen FROM Fingerprints').fetchall()
+    db.close()
+    return rows
+
+
+def update(cfgfile, sql):
+    db = sqlite3.connect(cfgfile.replace('fp.ini', 'fp.db'))
+    db.execute(sql)
+    db.commit()
+    db.close()
+
+
+def connect(cfgfile, enablemode=False):
+    dev = Device(cfgfile=cfgfile, customhost=CUSTOM, osdetect=True)
+    dev.connect(timeout=2, enablemode=enablemode)
+    dev.do_sendline('show lines 2')
+    output = dev.do_getbuffer()
+    dev.close()
+    return dev, output
+
+
+def test_reuse(fake, fpcfg):
+    connect(fpcfg)
+    first = cached(fpcfg)
+    assert first[0][0] == 'C'
+    # The dtype now comes from the cache, and a connect that learns nothing does not write
+    update(fpcfg, '''UPDATE Fingerprints SET DType = 'N' ''')
+    dev, output = connect(fpcfg)
+    assert dev.dtype == 'N'
+    assert output.count('10.') == 2
+    assert cached(fpcfg)[0][1:] == first[0][1:]
+
+
+def test_async_reuse(fake, fpcfg):
+    connect(fpcfg)
+    update(fpcfg, '''UPDATE Fingerprints SET DType = 'N' ''')
+
+    async def run():
+        dev = AsyncDevice(cfgfile=fpcfg, customhost=CUSTOM, osdetect=True)
+        await dev.connect(timeout=2)
+        dtype = dev.dtype
+        dev.close()
+        return dtype
+
+    assert asyncio.run(run()) == 'N'
+
+
+def test_stale_prompt(fake, fpcfg):
+    # Matches the prompt at login (user mode) but not after enable - the first prompt times out,
+    # and the fingerprint is dropped and learned again instead of failing the connect
+    connect(fpcfg)
+    update(fpcfg, r'''UPDATE Fingerprints SET Prompt = '\r\nsim\-c\-9>' ''')
+    dev, output = connect(fpcfg, enablemode=True)
+    assert output.count('10.') == 2
+    assert cached(fpcfg)[0][1] == dev.prompt != r'\r\nsim\-c\-9>'
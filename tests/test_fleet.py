@@ -0,0 +1,84 @@
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, redefined-outer-name, unused-argument
+
+import os
+import pytest
+import rcmdclass
+from rcmdclass import load_config, resolve_devices
+from rcmd import run_fleet
+from conftest import ROWS, write_db
+
+
+CMDS = ['show lines 3']
+
+
+def test_fleet(fake, cfgfile, tmp_path, capsys):
+    config = load_config(cfgfile)
+    devices, failed = resolve_devices(hosts=[row[0] for row in ROWS], config=config)
+    assert failed == []
+    assert run_fleet(devices, failed, CMDS, config, logdir=str(tmp_path / 'logs'), workers=2, timeout=5)
+    assert f'{len(ROWS)} succeeded, 0 failed' in capsys.readouterr().out
+    for row in ROWS:
+        assert os.path.exists(tmp_path / 'logs' / f'{row[0]}.log')
+
+
+def test_resolve_failures(fake, cfgfile, tmp_path):
+    # A host not in the DB and rows no Device can be made from are reported per host
+    write_db(str(tmp_path / 'bad.db'), [('rtr1-lab', 'C-1', 'C', 'S', 0, 1), ('rtr8-lab', 'C-8', 'C', 'S', 0, 9), ('rtr9-lab', 'C-9', 'C', 'S', 7, 1),
+                                        ('rtr10-lab', 'C-10', 'C', 'S', 0, None), ('rtr11-lab', 'C-11', 'C', 'S', 'x', 1)])
+    config = load_config(cfgfile)
+    config.dbpath = str(tmp_path / 'bad.db')
+    devices, failed = resolve_devices(hosts=['rtr1-lab', 'rtr8-lab', 'rtr9-lab', 'rtr10-lab', 'rtr11-lab', 'nope'], config=config)
+    assert [dev.host for dev in devices] == ['rtr1-lab']
+    failed = dict(failed)
+    assert sorted(failed) == ['nope', 'rtr10-lab', 'rtr11-lab', 'rtr8-lab', 'rtr9-lab']
+    assert failed['nope'] == 'ERROR: Device does not exist in DB'
+    assert failed['rtr10-lab'] == failed['rtr11-lab'] == 'ERROR: Invalid ProxyID/AuthID in DB'
+
+
+def test_fleet_failures(fake, cfgfile, tmp_path, monkeypatch, capsys):
+    # Unresolved hosts, login failures and non-RcmdError failures (no ssh binary) all count as
+    # failed without stopping the other devices
+    config = load_config(cfgfile)
+    devices, failed = resolve_devices(hosts=[row[0] for row in ROWS] + ['nope'], config=config)
+    monkeypatch.setattr(rcmdclass, 'SSH', str(tmp_path / 'missing-ssh'))
+    assert not run_fleet(devices, failed, CMDS, config, workers=1, timeout=5)
+    out = capsys.readouterr().out
+    # The telnet device still runs after both ssh devices fail on the same worker
+    assert '1 succeeded, 3 failed' in out
+    for host in ('rtr1-lab', 'sw1-lab', 'nope'):
+        assert f'FAILED {host} - ERROR' in out
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_fleet_login_failures(fake, cfgfile, monkeypatch, capsys, workers):
+    monkeypatch.setenv('FAKEDEV_PASSWORD', 'other')
+    config = load_config(cfgfile)
+    devices, failed = resolve_devices(hosts=[row[0] for row in ROWS], config=config)
+    assert not run_fleet(devices, failed, CMDS, config, workers=workers, timeout=5)
+    assert f'0 succeeded, {len(ROWS)} failed' in capsys.readouterr().out
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='needs /proc/self/fd')
+def test_fleet_closes_sessions(fake, cfgfile):
+    # Finished hosts must not keep their pty open - a large fleet would run out of fds
+    config = load_config(cfgfile)
+    devices, failed = resolve_devices(hosts=[row[0] for row in ROWS], config=config)
+    before = len(os.listdir('/proc/self/fd'))
+    assert run_fleet(devices, failed, CMDS, config, workers=1, timeout=5)
+    assert devices == []
+    assert len(os.listdir('/proc/self/fd')) <= before
+
+
+@pytest.mark.parametrize('maxsessions', ['0', '-1'])
+def test_bad_maxsessions(fake, cfgfile, tmp_path, maxsessions, capsys):
+    # Rejected with the section named, rather than the fleet run waiting forever for the proxy
+    write_db(str(tmp_path / 'proxy.db'), [('rtr1-lab', 'C-1', 'C', 'S', 3, 1), ('rtr2-lab', 'C-2', 'C', 'S', 0, 1)])
+    with open(cfgfile, 'a') as f:
+        f.write(f'\n[Proxy3]\nserver=127.0.0.1\nport=22\nsshconfig=/dev/null\nmaxsessions={maxsessions}\n')
+    config = load_config(cfgfile)
+    config.dbpath = str(tmp_path / 'proxy.db')
+    devices, failed = resolve_devices(hosts=['rtr1-lab', 'rtr2-lab'], config=config)
+    assert [dev.host for dev in devices] == ['rtr2-lab']
+    assert 'Invalid Proxy3 section in cfgfile - maxsessions must be at least 1' in dict(failed)['rtr1-lab']
+    assert not run_fleet(devices, failed, CMDS, config, workers=2, timeout=5)
+    assert '1 succeeded, 1 failed' in capsys.readouterr().out
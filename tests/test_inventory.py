@@ -0,0 +1,26 @@
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, redefined-outer-name, unused-argument
+
+import os
+import sqlite3
+import rcmdclass
+from rcmdclass import Device, get_inventory, lookup_host
+
+
+def test_lookup(cfgfile, dbpath):
+    # A one-off lookup is a single query - no snapshot of the whole table is loaded
+    dev = Device(cfgfile=cfgfile, host='RTR2-LAB')
+    assert (dev.host, dev.ip, dev.conn) == ('rtr2-lab', 'C-2', 'T')
+    assert os.path.abspath(dbpath) not in rcmdclass.INVENTORIES
+    assert lookup_host(dbpath, 'nope') is None
+
+
+def test_snapshot(dbpath):
+    inventory = get_inventory(dbpath)
+    assert lookup_host(dbpath, 'sw1-lab') == ('sw1-lab', 'N-1', 'N', 'S', 0, 1)
+    db = sqlite3.connect(dbpath)
+    db.execute('''UPDATE Devices SET MgmtIP = 'N-9' WHERE Hostname = 'sw1-lab' ''')
+    db.commit()
+    db.close()
+    # Reloaded when the DB file changes
+    assert lookup_host(dbpath, 'SW1-LAB')[1] == 'N-9'
+    assert inventory.get_ip('N-9')[0] == 'sw1-lab'
@@ -0,0 +1,25 @@
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long
+
+import os
+import json
+import pytest
+from rcmdclass import RcmdError
+from jsonsink import JsonSink
+
+
+def test_write(tmp_path):
+    sink = JsonSink(str(tmp_path / 'out.jsonl'))
+    for i in range(5):
+        sink.write({'n': i})
+    assert sink.close()
+    assert [json.loads(line)['n'] for line in (tmp_path / 'out.jsonl').read_text().splitlines()] == list(range(5))
+
+
+@pytest.mark.skipif(not os.path.exists('/dev/full'), reason='needs /dev/full')
+def test_write_error():
+    # e.g. disk full - reported by close() rather than lost with the writer thread
+    sink = JsonSink('/dev/full', interval=0.01)
+    sink.write({'n': 1})
+    with pytest.raises(RcmdError) as e:
+        sink.close()
+    assert 'No space left' in e.value.value
@@ -0,0 +1,80 @@
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, redefined-outer-name, unused-argument
+
+import time
+import asyncio
+import pytest
+from rcmdclass import Device, RcmdError
+from asyncrcmd import AsyncDevice
+
+
+REJECTIONS = [None, '% Authentication failed', '% Bad secrets']
+
+
+def custom(conn):
+    return f'rtr9-lab,C-9,C,{conn},0,1'
+
+
+@pytest.mark.parametrize('conn', ['S', 'T'])
+def test_login(fake, cfgfile, conn):
+    dev = Device(cfgfile=cfgfile, customhost=custom(conn))
+    dev.connect(timeout=5)
+    dev.do_sendline('show lines 3')
+    assert dev.do_getbuffer().count('10.') == 3
+    dev.disconnect()
+
+
+@pytest.mark.parametrize('reject', REJECTIONS)
+@pytest.mark.parametrize('conn', ['S', 'T'])
+def test_login_rejected(fake, cfgfile, monkeypatch, conn, reject):
+    # A rejected telnet login ("% Login invalid" etc.) must not be taken for the prompt
+    monkeypatch.setenv('FAKEDEV_PASSWORD', 'other')
+    if reject is not None:
+        monkeypatch.setenv('FAKEDEV_REJECT', reject)
+    dev = Device(cfgfile=cfgfile, customhost=custom(conn))
+    start = time.monotonic()
+    with pytest.raises(RcmdError) as e:
+        dev.connect(timeout=5)
+    assert 'Timeout' not in e.value.value
+    assert time.monotonic() - start < 4
+    dev.close()
+
+
+@pytest.mark.parametrize('reject', REJECTIONS)
+def test_async_login_rejected(fake, cfgfile, monkeypatch, reject):
+    monkeypatch.setenv('FAKEDEV_PASSWORD', 'other')
+    if reject is not None:
+        monkeypatch.setenv('FAKEDEV_REJECT', reject)
+
+    async def connect():
+        dev = AsyncDevice(cfgfile=cfgfile, customhost=custom('T'))
+        try:
+            await dev.connect(timeout=5)
+        finally:
+            dev.close()
+
+    start = time.monotonic()
+    with pytest.raises(RcmdError) as e:
+        asyncio.run(connect())
+    assert 'Timeout' not in e.value.value
+    assert time.monotonic() - start < 4
+
+
+def test_unknown_hostkey(fake, cfgfile, monkeypatch):
+    # Not accepted unless the cfgfile says so
+    monkeypatch.setenv('FAKEDEV_HOSTKEY', '1')
+    dev = Device(cfgfile=cfgfile, customhost=custom('S'))
+    with pytest.raises(RcmdError) as e:
+        dev.connect(timeout=5)
+    assert e.value.value == 'ERROR: Unknown host key'
+    dev.close()
+
+
+def test_accept_new_hostkey(fake, cfgfile, monkeypatch):
+    monkeypatch.setenv('FAKEDEV_HOSTKEY', '1')
+    with open(cfgfile, 'a') as f:
+        f.write('\n[SSH]\naccept_new_hostkeys = yes\n')
+    dev = Device(cfgfile=cfgfile, customhost=custom('S'))
+    dev.connect(timeout=5)
+    assert 'hostkey' in [stage for stage, _ in dev.login_timings]
+    dev.disconnect()
+    dev.close()
@@ -0,0 +1,55 @@
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, redefined-outer-name, unused-argument
+
+import re
+import pytest
+from rcmdclass import load_config, resolve_devices
+from rcmd import run_fleet
+from outstore import OutputStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = OutputStore(str(tmp_path / 'store'))
+    yield store
+    store.close()
+
+
+def test_same_timestamp(store):
+    # A second output at the same timestamp goes in after the first instead of replacing it
+    _, first = store.put('rtr1', 'show clock', 'one\n', 1000.0)
+    _, second = store.put('rtr1', 'show clock', 'two\n', 1000.0)
+    assert second > first
+    assert store.get('rtr1', 'show clock', first) == b'one\n'
+    assert store.get('rtr1', 'show clock', second) == b'two\n'
+    assert len(store.history('rtr1', 'show clock')) == 2
+
+
+def test_previous(store):
+    _, first = store.put('rtr1', 'show clock', 'one\n', 1000.0)
+    store.put('rtr1', 'show clock', 'two\n', 2000.0)
+    assert store.previous('rtr1', 'show clock', 1000.0) is None
+    assert store.previous('rtr1', 'show clock', 2000.0)[0] == first
+    assert store.find('rtr1', 'show clock', 2000.0)[0] == 2000.0
+
+
+def run(cfgfile, store, cmds, delta, stream=False):
+    config = load_config(cfgfile)
+    devices, failed = resolve_devices(hosts=['rtr1-lab'], config=config)
+    return run_fleet(devices, failed, cmds, config, workers=1, timeout=5, stream=stream, store=store, delta=delta)
+
+
+def counts(out):
+    return [tuple(map(int, match)) for match in re.findall(r'rtr1-lab: (\d+) changed, (\d+) unchanged', out)]
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_repeated_command(fake, cfgfile, store, capsys, stream):
+    # A command repeated in the cmdfile is stored each time, and delta mode compares each with the
+    # previous run rather than with its own earlier output in the same run
+    cmds = ['show lines 3', 'show lines 5', 'show lines 3']
+    assert run(cfgfile, store, cmds, True, stream)
+    assert run(cfgfile, store, cmds, True, stream)
+    assert counts(capsys.readouterr().out) == [(3, 0), (0, 3)]
+    history = store.history('rtr1-lab', 'show lines 3')
+    assert len(history) == 4
+    assert len({record[2] for record in history}) == 4
@@ -0,0 +1,42 @@
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, redefined-outer-name, unused-argument
+
+import pytest
+from rcmdclass import Device, load_config, resolve_devices
+from rcmd import run_fleet
+from conftest import ROWS
+
+
+CMDS = [f'show lines {n}' for n in range(1, 8)]
+
+
+@pytest.mark.parametrize('depth', [1, 3, 10])
+def test_batch(fake, cfgfile, depth):
+    # Each output is split off at its own prompt - the same as sending the commands one at a time
+    dev = Device(cfgfile=cfgfile, host='rtr1-lab')
+    dev.connect(timeout=5)
+    outputs = []
+    for line in CMDS:
+        dev.do_sendline(line)
+        outputs.append(dev.do_getbuffer())
+    times = []
+    assert dev.do_sendline_batch(CMDS, depth, times) == outputs
+    assert len(times) == len(CMDS)
+    # Still in step with the prompt afterwards
+    dev.do_sendline('show lines 2')
+    assert dev.do_getbuffer().count('10.') == 2
+    dev.disconnect()
+    dev.close()
+
+
+def test_fleet_pipeline(fake, cfgfile, tmp_path):
+    # Commands after a * line are run one at a time - the logfiles match a run without pipelining
+    cmds = CMDS[:3] + ['*', 'show lines 2'] + CMDS[3:]
+    config = load_config(cfgfile)
+    logs = {}
+    for pipeline in (0, 4):
+        devices, failed = resolve_devices(hosts=[row[0] for row in ROWS], config=config)
+        logdir = tmp_path / f'logs{pipeline}'
+        assert run_fleet(devices, failed, cmds, config, logdir=str(logdir), workers=3, timeout=5, pipeline=pipeline)
+        logs[pipeline] = {row[0]: (logdir / f'{row[0]}.log').read_text() for row in ROWS}
+    assert logs[0] == logs[4]
+    assert logs[4]['rtr1-lab'].count('### show lines') == len(CMDS) + 1
@@ -0,0 +1,46 @@
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, redefined-outer-name, unused-argument
+
+import io
+from rcmdclass import Device, OutputStream, load_config, resolve_devices
+from rcmd import run_fleet
+from conftest import ROWS
+
+
+def test_output_stream():
+    # The echoed command is dropped, and a \r\n split across writes still becomes \n
+    fout = io.StringIO()
+    stream = OutputStream(fout)
+    for chunk in ('show lin', 'es 2\r\n10.0.0.1\r', '\n10.0.0.2\r', '\n'):
+        stream.write(chunk)
+    stream.close()
+    assert fout.getvalue() == '10.0.0.1\n10.0.0.2\n'
+    assert stream.size == len(fout.getvalue())
+
+
+def test_stream(fake, cfgfile):
+    # Streamed output is the same as do_getbuffer() of the same command, without holding it in
+    # the session buffer, and the session is still in step with the prompt afterwards
+    dev = Device(cfgfile=cfgfile, host='rtr1-lab')
+    dev.connect(timeout=10)
+    dev.do_sendline('show lines 20000')
+    buffered = dev.do_getbuffer()
+    fout = io.StringIO()
+    dev.do_sendline_stream('show lines 20000', fout)
+    assert fout.getvalue() == buffered
+    assert dev.buffer == ''
+    dev.do_sendline('show lines 2')
+    assert dev.do_getbuffer().count('10.') == 2
+    dev.disconnect()
+    dev.close()
+
+
+def test_fleet_stream(fake, cfgfile, tmp_path):
+    cmds = ['show lines 3', 'show lines 5000', 'show version']
+    config = load_config(cfgfile)
+    logs = {}
+    for stream in (False, True):
+        devices, failed = resolve_devices(hosts=[row[0] for row in ROWS], config=config)
+        logdir = tmp_path / f'logs{stream}'
+        assert run_fleet(devices, failed, cmds, config, logdir=str(logdir), workers=3, timeout=10, stream=stream)
+        logs[stream] = {row[0]: (logdir / f'{row[0]}.log').read_text() for row in ROWS}
+    assert logs[False] == logs[True]
@@ -0,0 +1,19 @@
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, unused-argument
+
+from rcmdclass import Device
+from timings import PrometheusExporter
+
+
+def test_prometheus(fake, cfgfile, tmp_path):
+    dev = Device(cfgfile=cfgfile, host='rtr1-lab')
+    dev.connect(timeout=5, timings=True)
+    dev.do_sendline('show lines 3')
+    dev.close()
+    exporter = PrometheusExporter(str(tmp_path / 'rcmd.prom'))
+    exporter.export(dev)
+    exporter.close()
+    text = (tmp_path / 'rcmd.prom').read_text()
+    # Per run totals - gauges, as they reset every run
+    assert '# TYPE rcmd_phase_seconds gauge' in text
+    assert 'counter' not in text
+    assert 'rcmd_command_runs{host="rtr1-lab",command="show lines 3"} 1' in text
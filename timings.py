@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring, locally-disabled, invalid-name, line-too-long, anomalous-backslash-in-string, too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+
+# Exporters for the per-phase timings recorded by Device (connect(timings=True), rcmd.py -T and
+# --timings-export). An exporter has export(dev), called once a session is done with (whether it
+# succeeded or not), and close(). Any object with those two methods can be used.
+#
+#   TimingPrinter      - prints one line per host with the time spent in each phase
+#   JsonTimingExporter - appends one JSON line per phase and command e.g.
+#       {"host": "rtr1", "ip": "10.1.1.1", "phase": "command", "command": "show clock",
+#        "seconds": 0.084, "bytes": 61}
+#   PrometheusExporter - writes the run's totals per host and phase (and per host and command)
+#                        as gauges in a node_exporter textfile collector file on close()
+
+import os
+import threading
+from rcmdclass import RcmdError
+from jsonsink import JsonSink
+
+
+def breakdown(timer):
+    # e.g. "spawn 0.015s, password 0.088s, prompt 0.051s, set_prompt 0.050s, init 0.101s,
+    # command 1.234s (12 commands, 45678 bytes), total 1.539s"
+    parts = []
+    total = 0.0
+    for phase, (seconds, nbytes, count) in timer.totals().items():
+        total += seconds
+        if phase == 'command':
+            parts.append(f'{phase} {seconds:.3f}s ({count} commands, {nbytes} bytes)')
+        else:
+            parts.append(f'{phase} {seconds:.3f}s')
+    parts.append(f'total {total:.3f}s')
+    return ', '.join(parts)
+
+
+class TimingPrinter(object):
+
+    def export(self, dev):
+        print(f'!!! {dev.host} timings: {breakdown(dev.timer)} !!!')
+        return True
+
+
+    def close(self):
+        return True
+
+
+class JsonTimingExporter(object):
+
+    def __init__(self, path):
+        # Same batched background writer as rcmd.py -j
+        self.sink = JsonSink(path)
+
+
+    def export(self, dev):
+        for phase, command, seconds, nbytes in dev.timer.records:
+            self.sink.write({'host': dev.host, 'ip': dev.ip, 'phase': phase, 'command': command, 'seconds': round(seconds, 6), 'bytes': nbytes})
+        return True
+
+
+    def close(self):
+        return self.sink.close()
+
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class PrometheusExporter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.phases = {}
+        self.commands = {}
+        self.lock = threading.Lock()
+
+
+    def export(self, dev):
+        with self.lock:
+            for phase, command, seconds, nbytes in dev.timer.records:
+                total = self.phases.setdefault((dev.host, phase), [0.0, 0, 0])
+                total[0] += seconds
+                total[1] += nbytes
+                total[2] += 1
+                if command is not None:
+                    total = self.commands.setdefault((dev.host, command), [0.0, 0, 0])
+                    total[0] += seconds
+                    total[1] += nbytes
+                    total[2] += 1
+        return True
+
+
+    def close(self):
+        # Gauges, not counters - each run writes its own totals, so they go down as well as up
+        lines = []
+        for name, key, totals in (('phase', 'phase', self.phases), ('command', 'command', self.commands)):
+            for idx, metric, desc in ((0, 'seconds', 'Seconds spent'), (1, 'bytes', 'Bytes read'), (2, 'runs', 'Number of times run')):
+                lines.append(f'# HELP rcmd_{name}_{metric} {desc} per host and {name} in the last run.')
+                lines.append(f'# TYPE rcmd_{name}_{metric} gauge')
+                for (host, value), total in sorted(totals.items()):
+                    lines.append(f'rcmd_{name}_{metric}{{host="{label(host)}",{key}="{label(value)}"}} {total[idx]}')
+        # Written to a temporary file and renamed, so the collector never reads a partial file
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp, self.path)
+        except OSError:
+            raise RcmdError('ERROR: Error writing Prometheus timings file')
+        return True
+
+
+def get_exporter(spec):
+    # json:FILE or prom:FILE
+    kind, _, path = spec.partition(':')
+    if not path:
+        raise RcmdError('ERROR: Timings export should be json:FILE or prom:FILE')
+    if kind == 'json':
+        return JsonTimingExporter(path)
+    if kind == 'prom':
+        return PrometheusExporter(path)
+    raise RcmdError('ERROR: Timings export should be json:FILE or prom:FILE')